@@ -7,10 +7,15 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/wsgi/
 """
 
-import os, sys
+import os, sys, time
+load_started = time.perf_counter()
 site_user_root_dir = '/home/s/sashabgs/farm35.ru/public_html'
 sys.path.insert(0, site_user_root_dir + '/Farm35')
 sys.path.insert(1, site_user_root_dir + '/venv/lib/python3.11/site-packages')
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 from django.core.wsgi import get_wsgi_application
-application = get_wsgi_application()
\ No newline at end of file
+application = get_wsgi_application()
+
+# Прогрев процесса (KADR_WARMUP) и замер времени запуска
+from kadr.warmup import log_cold_start
+log_cold_start(load_started)
@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/5.2/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
+import hashlib
 import os
 from pathlib import Path
 
@@ -47,11 +48,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'kadr.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'kadr.middleware.KadrProfileMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -60,7 +63,9 @@ ROOT_URLCONF = 'core.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Шаблоны Django с замером рендеринга (kadr.middleware.RequestTimingMiddleware)
+        'BACKEND': 'kadr.middleware.TimedDjangoTemplates',
+        'NAME': 'django',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -76,6 +81,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'core.wsgi.application'
 
+# Тесты: общий кэш заменяется кэшем в памяти (kadr.test_runner)
+TEST_RUNNER = 'kadr.test_runner.KadrTestRunner'
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -84,9 +92,32 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Соединение процесса переиспользуется между запросами (и после прогрева,
+        # kadr.warmup), а не открывается и настраивается заново на каждый запрос
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # Пишущая транзакция сразу берет блокировку записи: иначе при
+            # одновременной записи SQLite отвечает "database is locked", не дожидаясь busy_timeout
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
+# SQLite (kadr.signals.configure_sqlite): журнал WAL - чтение не ждет записи
+# (только для базы 'default', в тестах выключен), ожидание блокировки записи
+# в миллисекундах
+KADR_SQLITE_WAL = True
+KADR_SQLITE_BUSY_TIMEOUT_MS = 5000
+
+# Поток записи посещаемости (kadr.writer): параллельные записи процесса
+# выполняются пачками до KADR_WRITER_MAX_BATCH записей, собранными
+# за KADR_WRITER_MAX_DELAY_MS миллисекунд, с одной фиксацией на пачку
+KADR_ATTENDANCE_WRITER = True
+KADR_WRITER_MAX_BATCH = 50
+KADR_WRITER_MAX_DELAY_MS = 5
+KADR_WRITER_TIMEOUT = 30
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -145,6 +176,129 @@ else:
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Учет посещаемости: при True панель заведующего не создает пустые записи
+# на сегодня, а показывает несохраненные строки до первого сохранения статуса
+KADR_DASHBOARD_VIRTUAL_ROWS = False
+
+# Пакетное сохранение посещаемости: не больше KADR_BATCH_SAVE_MAX_ENTRIES строк
+# в запросе и даты не дальше KADR_BATCH_SAVE_DATE_WINDOW дней от сегодня
+# (панель редактирует сегодняшний день, окно покрывает часовой пояс клиента)
+KADR_BATCH_SAVE_MAX_ENTRIES = 500
+KADR_BATCH_SAVE_DATE_WINDOW = 1
+
+# Хранение посещаемости (kadr.storage): 'daily' - строка на сотрудника и день,
+# 'monthly' - строка на сотрудника и месяц со статусами дней в одной строке.
+# Перед сменой режима данные переносятся командой convert_attendance_storage;
+# размер и скорость режимов сравнивает команда benchmark_attendance_storage
+KADR_ATTENDANCE_STORAGE = 'daily'
+
+# Подсчет статусов (kadr.aggregation) массивами NumPy; без установленного
+# пакета numpy или при False используется подсчет на чистом Python
+KADR_NUMPY_AGGREGATION = True
+
+# Фоновые отчеты (kadr.jobs): задания выполняет команда run_report_jobs
+# в KADR_REPORT_WORKERS процессах (постоянно работающий процесс или запуск
+# по cron с --once); готовые результаты хранятся KADR_REPORT_JOB_TTL секунд
+KADR_REPORT_WORKERS = 2
+KADR_REPORT_POLL_INTERVAL = 1
+KADR_REPORT_JOB_TTL = 24 * 3600
+
+# Допуск отчетов статистики (kadr.admission): стоимость - дни периода ×
+# (сотрудники + аптеки). До KADR_REPORT_INLINE_COST отчет строится по дням,
+# дороже - только по агрегатам; периоды длиннее KADR_REPORT_MAX_DAYS дней
+# и отчеты дороже KADR_REPORT_MAX_COST отклоняются. AJAX-отчеты руководителя
+# дороже KADR_REPORT_BACKGROUND_COST ставятся в фоновую очередь (kadr.jobs)
+KADR_REPORT_INLINE_COST = 1_000_000
+KADR_REPORT_BACKGROUND_COST = 5_000_000
+KADR_REPORT_MAX_COST = 20_000_000
+KADR_REPORT_MAX_DAYS = 3660
+
+# Файловые кэши общие для всех процессов Passenger. В 'default' хранятся
+# готовые фрагменты отчетов (kadr.fragment_cache) и профили (kadr.profiles):
+# записей много (аптеки × отчеты × периоды), при переполнении вытесняется
+# десятая часть (CULL_FREQUENCY), и вытесненное просто строится заново.
+# В 'kadr_state' - версии данных аптек, поколение профилей и блокировки
+# построения отчетов: их вытеснение сбрасывает кэш или пропускает двойное
+# построение, поэтому записей в нем немного (по одной на аптеку и на
+# строящийся отчет), а предел взят с запасом, чтобы вытеснения не было.
+# Префикс ключей привязан к файлу базы: записи, сделанные для другой базы
+# (копия, тестовая база), с этой базой не используются. Тесты работают
+# с кэшем в памяти (kadr.test_runner)
+CACHE_KEY_PREFIX = 'kadr-' + hashlib.sha1(str(DATABASES['default']['NAME']).encode()).hexdigest()[:12]
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'KEY_PREFIX': CACHE_KEY_PREFIX,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+            'CULL_FREQUENCY': 10,
+        },
+    },
+    'kadr_state': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'state',
+        'KEY_PREFIX': CACHE_KEY_PREFIX,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+KADR_FRAGMENT_CACHE = 'default'
+KADR_STATE_CACHE = 'kadr_state'
+KADR_FRAGMENT_CACHE_TIMEOUT = 3600
+# Одинаковые отчеты строятся одним запросом, остальные ждут его результат
+# не дольше KADR_FRAGMENT_BUILD_TIMEOUT секунд (и строят сами, если не дождались)
+KADR_FRAGMENT_BUILD_TIMEOUT = 30
+
+# Замеры запросов (kadr.middleware.RequestTimingMiddleware):
+# заголовок Server-Timing и порог медленного запроса в миллисекундах
+KADR_SERVER_TIMING = True
+KADR_SLOW_REQUEST_MS = 1000
+
+# Прогрев процесса при загрузке WSGI (kadr.warmup, core/passenger_wsgi.py):
+# URL и представления, шаблоны, соединение с базой, дерево аптек и календарь
+# готовятся до первого запроса
+KADR_WARMUP = False
+
+# Строки замеров всех запросов пишутся логгером kadr.performance с уровнем INFO
+# (для включения понизьте уровень), медленные запросы - в slow_requests.log
+# Время запуска процесса и его первого запроса - логгером kadr.performance.startup
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+        'slow_requests': {
+            'class': 'logging.FileHandler',
+            'filename': BASE_DIR / 'slow_requests.log',
+            'encoding': 'utf-8',
+            'delay': True,
+        },
+    },
+    'loggers': {
+        'kadr.performance': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'kadr.performance.slow': {
+            'handlers': ['slow_requests'],
+            'level': 'WARNING',
+        },
+        'kadr.performance.startup': {
+            'level': 'INFO',
+        },
+        # Ошибки представлений, фоновых отчетов и прогрева
+        'kadr': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+    },
+}
+
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'redirect_based_on_role'
 LOGOUT_REDIRECT_URL = 'login'
\ No newline at end of file
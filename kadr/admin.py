@@ -1,8 +1,10 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin, User
 from django.contrib.auth.models import User
-from .models import MyModel, Pharmacy, UserProfile, Leadership, Attendance
+from .models import MyModel, Pharmacy, UserProfile, Leadership, Attendance, AttendanceMonth, AttendanceRollup, ReportJob
+from .attendance import attendance_changed
 from django import forms
+from django.db import transaction
 
 admin.site.register(MyModel)
 
@@ -77,13 +79,80 @@ class LeadershipAdmin(admin.ModelAdmin):
 
 @admin.register(Attendance)
 class AttendanceAdmin(admin.ModelAdmin):
-    list_display = ['user', 'date', 'status', 'created_at']
-    list_filter = ['date', 'status', 'user__pharmacy']
+    list_display = ['user', 'pharmacy', 'date', 'status', 'created_at']
+    list_filter = ['date', 'status', 'pharmacy']
     search_fields = ['user__full_name', 'user__pharmacy__name']
     date_hierarchy = 'date'
     
     def get_readonly_fields(self, request, obj=None):
         # Запрещаем редактирование даты после создания
         if obj:
-            return ['user', 'date']
+            return ['user', 'pharmacy', 'date']
         return []
+    
+    # Любое изменение посещаемости через админку обновляет помесячную сводку
+    # и кэш отчетов аптеки записи и текущей аптеки сотрудника
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            attendance_changed([(obj.user_id, obj.date)], {obj.pharmacy_id, obj.user.pharmacy_id})
+    
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            super().delete_model(request, obj)
+            attendance_changed([(obj.user_id, obj.date)], {obj.pharmacy_id, obj.user.pharmacy_id})
+    
+    def delete_queryset(self, request, queryset):
+        rows = list(queryset.values_list('user_id', 'date', 'pharmacy_id', 'user__pharmacy_id'))
+        with transaction.atomic():
+            super().delete_queryset(request, queryset)
+            attendance_changed(
+                [(user_id, day) for user_id, day, _, _ in rows],
+                {pharmacy_id for row in rows for pharmacy_id in row[2:]}
+            )
+
+
+@admin.register(AttendanceMonth)
+class AttendanceMonthAdmin(admin.ModelAdmin):
+    list_display = ['user', 'pharmacy', 'month', 'codes', 'updated_at']
+    list_filter = ['month', 'pharmacy']
+    search_fields = ['user__full_name', 'user__pharmacy__name']
+    date_hierarchy = 'month'
+    
+    # Строки месяцев пишутся через kadr.storage (панель заведующего, AJAX),
+    # вручную не редактируются
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(AttendanceRollup)
+class AttendanceRollupAdmin(admin.ModelAdmin):
+    list_display = ['user', 'pharmacy', 'month', 'status', 'days_count', 'working_days_count']
+    list_filter = ['month', 'status', 'pharmacy']
+    search_fields = ['user__full_name', 'pharmacy__name']
+    date_hierarchy = 'month'
+    
+    # Сводка ведется автоматически, вручную не редактируется
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ReportJob)
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'report', 'format', 'status', 'user', 'created_at', 'finished_at']
+    list_filter = ['status', 'report', 'format']
+    search_fields = ['user__username']
+    exclude = ['result']
+    
+    # Задания ставятся из интерфейса отчетов и выполняются командой run_report_jobs
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
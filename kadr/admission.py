@@ -0,0 +1,74 @@
+from collections import namedtuple
+
+from django.conf import settings
+
+# Допуск отчетов за произвольный период.
+#
+# Период статистики приходит из параметров запроса без ограничений, поэтому
+# до построения отчета оценивается его стоимость: дни периода × (сотрудники +
+# аптеки) - столько дневных ячеек прошел бы расчет по дням. Отчеты дешевле
+# KADR_REPORT_INLINE_COST строятся как обычно, более дорогие - только по
+# агрегатам (помесячная сводка и групповые запросы, без данных по дням),
+# а периоды длиннее KADR_REPORT_MAX_DAYS и отчеты дороже KADR_REPORT_MAX_COST
+# отклоняются с сообщением до любых расчетов.
+#
+# AJAX-отчеты руководителя дороже KADR_REPORT_BACKGROUND_COST (в том числе
+# отклоненные по стоимости) не строятся в запросе, а ставятся в фоновую
+# очередь (kadr.jobs): ответом приходит номер задания для опроса.
+
+INLINE = 'inline'
+AGGREGATED = 'aggregated'
+REJECTED = 'rejected'
+
+Admission = namedtuple('Admission', ['mode', 'cost', 'message'])
+
+
+def get_cost_limits():
+    """(стоимость, до которой отчет строится по дням; наибольшая стоимость; наибольшая длина периода в днях)"""
+    return (
+        getattr(settings, 'KADR_REPORT_INLINE_COST', 1_000_000),
+        getattr(settings, 'KADR_REPORT_MAX_COST', 20_000_000),
+        getattr(settings, 'KADR_REPORT_MAX_DAYS', 3660),
+    )
+
+
+def estimate_report_cost(start_date, end_date, employees_count, pharmacies_count):
+    """Оценка работы отчета: дни периода × (сотрудники + аптеки)"""
+    return ((end_date - start_date).days + 1) * (employees_count + pharmacies_count)
+
+
+def admit_report(start_date, end_date, employees_count=0, pharmacies_count=0):
+    """Решение о построении отчета за период.
+
+    Без числа сотрудников и аптек проверяется только длина периода - это
+    можно сделать сразу после разбора параметров, до запросов к базе.
+    """
+    inline_cost, max_cost, max_days = get_cost_limits()
+    days = (end_date - start_date).days + 1
+    if days > max_days:
+        return Admission(
+            REJECTED, None,
+            f'Слишком длинный период: {days} дн. Выберите период не длиннее {max_days} дн.'
+        )
+
+    cost = estimate_report_cost(start_date, end_date, employees_count, pharmacies_count)
+    if cost > max_cost:
+        return Admission(
+            REJECTED, cost,
+            'Отчет за этот период слишком большой. Сократите период или выберите меньше аптек'
+        )
+    return Admission(AGGREGATED if cost > inline_cost else INLINE, cost, '')
+
+
+def get_background_cost():
+    """Стоимость, начиная с которой AJAX-отчет строится в фоне"""
+    return getattr(settings, 'KADR_REPORT_BACKGROUND_COST', 5_000_000)
+
+
+def needs_background(admission):
+    """Строить ли отчет фоновым заданием: стоимость известна и выше порога.
+
+    Отчет, отклоненный по длине периода (стоимость не оценивалась),
+    в фон не уходит - он отклоняется и там.
+    """
+    return admission.cost is not None and admission.cost > get_background_cost()
@@ -0,0 +1,137 @@
+from collections import defaultdict
+from datetime import date
+
+from django.conf import settings
+from .storage import CODE_STATUSES, STATUS_CODES, CODE_BLANK
+from .timesheet import period_day_types
+from .utils import get_calendar
+
+try:
+    import numpy as np
+except ImportError:  # NumPy - необязательная зависимость, без нее работает запасной путь
+    np = None
+
+# Подсчет статусов посещаемости.
+#
+# Статусы считаются по кодам kadr.storage.STATUS_CODES: строки посещаемости
+# превращаются в массивы (сотрудник, день, код), рабочие дни отбираются
+# маской производственного календаря, а счетчики по группам получаются
+# одним np.bincount вместо словаря и проверки праздника на каждую строку.
+# Без NumPy (или при KADR_NUMPY_AGGREGATION = False) те же результаты
+# считаются на чистом Python.
+
+CODES_COUNT = max(CODE_STATUSES) + 1
+FILLED_CODES = {code: status for code, status in CODE_STATUSES.items() if status}
+FILLED_STATUS_SET = set(FILLED_CODES.values())
+
+
+def use_numpy():
+    return np is not None and getattr(settings, 'KADR_NUMPY_AGGREGATION', True)
+
+
+def _group_counts(code_counts):
+    """Счетчики по кодам -> {статус: количество}; None, если заполненных статусов нет"""
+    counts = {status: int(code_counts[code]) for code, status in FILLED_CODES.items()}
+    return counts if any(counts.values()) else None
+
+
+def count_working_codes(codes, day_types, groups=None):
+    """Счетчики статусов за рабочие дни периода.
+
+    codes - {ключ: коды по дням периода} (как в kadr.storage.read_codes),
+    day_types - типы дней того же периода (0 - рабочий), groups - {ключ: группа}
+    (по умолчанию каждый ключ - своя группа). Возвращает {группа: {статус: количество}}
+    только для групп с заполненными статусами.
+    """
+    if groups is None:
+        groups = {key: key for key in codes}
+    group_ids = {}
+    for key in codes:
+        group_ids.setdefault(groups[key], len(group_ids))
+
+    if use_numpy() and codes:
+        working = np.frombuffer(bytes(day_types), dtype=np.uint8) == 0
+        matrix = np.frombuffer(b''.join(bytes(user_codes) for user_codes in codes.values()), dtype=np.uint8)
+        matrix = matrix.reshape(len(codes), len(day_types))[:, working]
+        rows_group = np.fromiter((group_ids[groups[key]] for key in codes), dtype=np.intp, count=len(codes))
+        flat = (rows_group[:, None] * CODES_COUNT + matrix).ravel()
+        totals = np.bincount(flat, minlength=len(group_ids) * CODES_COUNT).reshape(len(group_ids), CODES_COUNT)
+    else:
+        totals = [[0] * CODES_COUNT for _ in group_ids]
+        working = [index for index, day_flags in enumerate(day_types) if not day_flags]
+        for key, user_codes in codes.items():
+            group_totals = totals[group_ids[groups[key]]]
+            working_codes = bytes(user_codes[index] for index in working)
+            for code in FILLED_CODES:
+                group_totals[code] += working_codes.count(code)
+
+    result = {}
+    for group, group_id in group_ids.items():
+        counts = _group_counts(totals[group_id])
+        if counts:
+            result[group] = counts
+    return result
+
+
+def count_monthly_rows(rows):
+    """Сворачивает строки (id профиля, дата, статус) в счетчики по сотруднику и месяцу.
+
+    Возвращает {(id профиля, месяц, статус): [всего дней, рабочих дней]};
+    пустые статусы в счетчики не попадают.
+    """
+    if not use_numpy():
+        return _count_monthly_rows_python(rows)
+
+    rows = list(rows)
+    if not rows:
+        return {}
+    user_ids, dates, statuses = zip(*rows)
+    ordinals = np.fromiter((day.toordinal() for day in dates), dtype=np.int64, count=len(dates))
+    codes = np.fromiter((STATUS_CODES.get(status, CODE_BLANK) for status in statuses), dtype=np.intp, count=len(rows))
+    users, user_index = np.unique(np.asarray(user_ids), return_inverse=True)
+
+    # Тип дня и номер месяца берутся из таблиц на весь диапазон дат строк
+    first_ordinal = int(ordinals.min())
+    first_day = date.fromordinal(first_ordinal)
+    last_day = date.fromordinal(int(ordinals.max()))
+    day_offsets = ordinals - first_ordinal
+    working = np.frombuffer(bytes(period_day_types(first_day, last_day)), dtype=np.uint8)[day_offsets] == 0
+
+    first_month = first_day.year * 12 + first_day.month - 1
+    day_months = np.fromiter(
+        (day.year * 12 + day.month - 1 - first_month
+         for day in map(date.fromordinal, range(first_ordinal, last_day.toordinal() + 1))),
+        dtype=np.intp
+    )
+    months = [
+        date(month // 12, month % 12 + 1, 1)
+        for month in range(first_month, last_day.year * 12 + last_day.month)
+    ]
+
+    flat = (user_index * len(months) + day_months[day_offsets]) * CODES_COUNT + codes
+    size = len(users) * len(months) * CODES_COUNT
+    totals = np.bincount(flat, minlength=size)
+    working_totals = np.bincount(flat, weights=working, minlength=size)
+
+    counters = {}
+    for index in np.flatnonzero(totals):
+        user_position, code = divmod(int(index), CODES_COUNT)
+        if code not in FILLED_CODES:
+            continue
+        user_position, month_position = divmod(user_position, len(months))
+        counters[(int(users[user_position]), months[month_position], FILLED_CODES[code])] = [
+            int(totals[index]), int(working_totals[index])
+        ]
+    return counters
+
+
+def _count_monthly_rows_python(rows):
+    counters = defaultdict(lambda: [0, 0])
+    for user_id, attendance_date, status in rows:
+        if status not in FILLED_STATUS_SET:
+            continue
+        counter = counters[(user_id, attendance_date.replace(day=1), status)]
+        counter[0] += 1
+        if get_calendar(attendance_date.year).is_working_day(attendance_date):
+            counter[1] += 1
+    return counters
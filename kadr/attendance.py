@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.db import transaction
+from .fragment_cache import bump_pharmacy_versions, bump_profile_versions
+from .models import Attendance
+from .rollup import refresh_attendance_rollup
+from .storage import read_day, write_statuses
+from .writer import WritePending, coalesce_writes, run_write
+
+
+def attendance_changed(keys, pharmacy_ids=None):
+    """Обновляет производные данные после записи посещаемости.
+
+    keys - пары (id профиля, дата) измененных записей: пересчитывается
+    помесячная сводка и сбрасываются кэшированные отчеты аптек - переданных
+    в pharmacy_ids (см. kadr.storage.write_statuses) или текущих аптек сотрудников.
+    """
+    keys = list(keys)
+    refresh_attendance_rollup(keys)
+    if pharmacy_ids is None:
+        bump_profile_versions(user_id for user_id, _ in keys)
+    else:
+        bump_pharmacy_versions(pharmacy_ids)
+
+
+def open_attendance_day(employees, day):
+    """Создает недостающие пустые записи посещаемости на день одним запросом"""
+    pharmacy_ids = write_statuses({(employee.id, day): '' for employee in employees}, keep_existing=True)
+    # Пустые записи не попадают в сводку, но отображаются в табеле
+    bump_pharmacy_versions(pharmacy_ids)
+
+
+def get_day_attendances(employees, day):
+    """Записи посещаемости сотрудников на день в порядке списка сотрудников.
+
+    Записи собираются из статусов хранилища (kadr.storage) и сами не сохранены:
+    панели нужны только статусы. Недостающие пустые записи создаются одним
+    запросом; при KADR_DASHBOARD_VIRTUAL_ROWS = True они не создаются вовсе.
+    """
+    statuses = read_day(day, user__in=employees)
+
+    missing = [employee for employee in employees if employee.id not in statuses]
+    if missing and not getattr(settings, 'KADR_DASHBOARD_VIRTUAL_ROWS', False):
+        try:
+            run_write(open_attendance_day, missing, day)
+        except WritePending:
+            # Пустые записи еще создаются; до фиксации строки показываются пустыми
+            pass
+        statuses.update(read_day(day, user__in=missing))
+
+    # Профиль уже загружен вместе с пользователем и аптекой
+    return [
+        Attendance(user=employee, date=day, status=statuses.get(employee.id) or '')
+        for employee in employees
+    ]
+
+
+def save_attendance_status(profile_id, day, status):
+    """Сохраняет статус сотрудника на день; возвращает (запись, создана ли она)"""
+    created = profile_id not in read_day(day, user_id=profile_id)
+    pharmacy_ids = write_statuses({(profile_id, day): status})
+    attendance_changed([(profile_id, day)], pharmacy_ids)
+    return Attendance(user_id=profile_id, date=day, status=status), created
+
+
+@coalesce_writes
+def upsert_attendances(entries):
+    """Записывает статусы пачкой: [(id профиля, дата, статус), ...].
+
+    Все строки пишутся одним INSERT ... ON CONFLICT DO UPDATE, месячная сводка
+    обновляется в той же транзакции. Повторы одной пары сотрудник/дата
+    схлопываются, побеждает последний.
+    """
+    statuses = {(user_id, day): status for user_id, day, status in entries}
+    if not statuses:
+        return
+
+    with transaction.atomic():
+        pharmacy_ids = write_statuses(statuses)
+        attendance_changed(statuses.keys(), pharmacy_ids)
@@ -0,0 +1,50 @@
+from functools import wraps
+
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from .fragment_cache import scope_digest
+
+# Условные GET-запросы отчетов (ETag / Last-Modified).
+#
+# Валидатор строится из тех же версий данных аптек, что и ключи кэша
+# фрагментов: версия меняется при любом изменении посещаемости, состава
+# сотрудников или самой аптеки, поэтому сверка стоит одного обращения к кэшу
+# и выполняется до построения отчета.
+
+
+def check_not_modified(request, view_name, pharmacy_ids, *params):
+    """Ответ 304, если у клиента актуальная версия отчета, иначе None.
+
+    Валидаторы запоминаются в запросе и добавляются к ответу
+    декоратором conditional_report.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+
+    # Ответ зависит от пользователя и от формы запроса (страница, HTML-фрагмент или данные)
+    digest, last_modified = scope_digest(
+        view_name, f'user:{request.user.pk}', pharmacy_ids,
+        request.headers.get('X-Requested-With', ''), *params
+    )
+    request.kadr_validators = (quote_etag(digest), last_modified)
+    return get_conditional_response(request, etag=quote_etag(digest), last_modified=last_modified)
+
+
+def conditional_report(view):
+    """Добавляет к успешному ответу отчета ETag и Last-Modified (см. check_not_modified)"""
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        validators = getattr(request, 'kadr_validators', None)
+        if validators and response.status_code in (200, 304):
+            etag, last_modified = validators
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            # Браузер хранит отчет, но перед каждым показом сверяет его с сервером
+            patch_cache_control(response, private=True, no_cache=True)
+            patch_vary_headers(response, ['X-Requested-With'])
+        return response
+
+    return wrapper
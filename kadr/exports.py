@@ -0,0 +1,162 @@
+import csv
+import tempfile
+from datetime import date
+
+from django.http import FileResponse, StreamingHttpResponse
+from .models import Pharmacy, ATTENDANCE_CHOICES
+from .reports import FILLED_STATUSES, get_pharmacy_employee_status_counts
+from .storage import CODE_STATUSES
+from .timesheet import MONTH_NAMES, TimesheetMatrix, group_employees_by_pharmacy, month_bounds, month_day_types
+from .utils import count_working_days
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # XLSX - необязательная возможность
+    Workbook = None
+
+# Аптеки выгружаются порциями по EXPORT_CHUNK_SIZE: сотрудники и посещаемость
+# порции читаются несколькими запросами, и выгрузка всей сети за год держит
+# в памяти коды одной порции (около тысячи сотрудников), а не всей сети.
+# Дни относятся к аптеке записи (Attendance.pharmacy): переведенный
+# сотрудник выгружается в каждой аптеке со своими днями в ней
+EXPORT_CHUNK_SIZE = 100
+
+# Обозначения в табеле (как в форме Т-13)
+EXPORT_STATUS_LABELS = {
+    'full': 'Я',
+    'half': 'Я/2',
+    'vacation': 'ОТ',
+    'sick': 'Б',
+}
+NON_WORKING_LABEL = 'В'
+
+
+class Echo:
+    """Псевдофайл для csv.writer: возвращает записанную строку вместо буферизации"""
+
+    def write(self, value):
+        return value
+
+
+def csv_stream(rows):
+    writer = csv.writer(Echo(), delimiter=';')
+    # BOM и ";" - чтобы Excel с русской локалью открыл файл без мастера импорта
+    yield '\ufeff'
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def export_response(rows, filename, export_format='csv'):
+    """Ответ с выгрузкой: CSV отдается потоком, XLSX собирается во временном файле"""
+    if export_format == 'xlsx':
+        if Workbook is None:
+            raise ValueError('Выгрузка в XLSX недоступна: не установлен пакет openpyxl')
+        # В режиме write_only openpyxl сбрасывает строки на диск по мере записи
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        for row in rows:
+            sheet.append(row)
+        output = tempfile.TemporaryFile()
+        workbook.save(output)
+        output.seek(0)
+        return FileResponse(output, as_attachment=True, filename=f'{filename}.xlsx')
+
+    response = StreamingHttpResponse(csv_stream(rows), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
+
+
+def _scope_pharmacies(pharmacy_ids):
+    """Порции аптек выгрузки в порядке id; при pharmacy_ids = None - все аптеки"""
+    pharmacies = Pharmacy.objects.order_by('id')
+    if pharmacy_ids is not None:
+        pharmacies = pharmacies.filter(id__in=pharmacy_ids)
+
+    chunk = []
+    for pharmacy in pharmacies.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        chunk.append(pharmacy)
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _employee_month_rows(pharmacy_name, employee_name, codes, year, months, first_day, day_types):
+    """Строки табеля сотрудника в аптеке по месяцам"""
+    for month in months:
+        types = day_types[month]
+        start = (date(year, month, 1) - first_day).days
+        cells = []
+        filled_working_days = 0
+        for code, day_flags in zip(codes[start:start + len(types)], types):
+            status = CODE_STATUSES[code]
+            if day_flags:
+                cells.append(NON_WORKING_LABEL)
+                continue
+            if status is not None:
+                filled_working_days += 1
+            cells.append(EXPORT_STATUS_LABELS.get(status, ''))
+        cells += [''] * (31 - len(cells))
+
+        total_working_days = types.count(0)
+        percentage = filled_working_days / total_working_days * 100 if total_working_days else 0
+        yield (
+            [pharmacy_name, employee_name, f'{MONTH_NAMES[month]} {year}']
+            + cells
+            + [total_working_days, filled_working_days, round(percentage, 1)]
+        )
+
+
+def timesheet_rows(pharmacy_ids, year, months):
+    """Строки табеля: по строке на сотрудника в аптеке и месяц.
+
+    pharmacy_ids - аптеки выгрузки (None - все аптеки), months - номера месяцев года.
+    """
+    yield (
+        ['Аптека', 'Сотрудник', 'Месяц']
+        + [str(day) for day in range(1, 32)]
+        + ['Рабочих дней', 'Заполнено рабочих дней', 'Процент заполнения']
+    )
+
+    first_day = month_bounds(year, months[0])[0]
+    last_day = month_bounds(year, months[-1])[1]
+    day_types = {month: month_day_types(year, month) for month in months}
+
+    for pharmacies in _scope_pharmacies(pharmacy_ids):
+        matrix = TimesheetMatrix(pharmacies, first_day, last_day)
+        for pharmacy in pharmacies:
+            for employee in matrix.get_employees(pharmacy):
+                yield from _employee_month_rows(
+                    pharmacy.name, employee.full_name, matrix.employee_codes(pharmacy, employee),
+                    year, months, first_day, day_types
+                )
+
+
+def statistics_rows(pharmacy_ids, start_date, end_date):
+    """Строки статистики за период: по строке на сотрудника в аптеке"""
+    status_names = dict(ATTENDANCE_CHOICES)
+    yield (
+        ['Аптека', 'Сотрудник', 'Рабочих дней']
+        + [status_names[status] for status in FILLED_STATUSES]
+        + ['Пропущено', 'Процент посещаемости']
+    )
+
+    total_working_days = count_working_days(start_date, end_date)
+    for pharmacies in _scope_pharmacies(pharmacy_ids):
+        pharmacy_ids_chunk = [pharmacy.id for pharmacy in pharmacies]
+        # Счетчики статусов порции - по одной записи на аптеку и сотрудника (полные месяцы из сводки)
+        status_counts = get_pharmacy_employee_status_counts(pharmacy_ids_chunk, start_date, end_date)
+        employees_by_pharmacy = group_employees_by_pharmacy(pharmacy_ids_chunk, status_counts)
+
+        for pharmacy in pharmacies:
+            for employee in employees_by_pharmacy.get(pharmacy.id, []):
+                employee_counts = status_counts.get((pharmacy.id, employee.id), {})
+                counts = [employee_counts.get(status, 0) for status in FILLED_STATUSES]
+                filled_days = sum(counts)
+                percentage = filled_days / total_working_days * 100 if total_working_days else 0
+                yield (
+                    [pharmacy.name, employee.full_name, total_working_days]
+                    + counts
+                    + [total_working_days - filled_days, round(percentage, 1)]
+                )
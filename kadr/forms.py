@@ -99,11 +99,13 @@ class LeaderTimesheetForm(forms.Form):
     
     def __init__(self, *args, **kwargs):
         user = kwargs.pop('user', None)
+        profile = kwargs.pop('profile', None)
         super().__init__(*args, **kwargs)
         
         # Динамически заполняем выбор аптек в зависимости от прав пользователя
         if user:
-            profile = UserProfile.objects.get(user=user)
+            if profile is None:
+                profile = UserProfile.objects.get(user=user)
             if profile.is_leader:
                 # Руководитель видит все аптеки
                 pharmacies = Pharmacy.objects.all()
@@ -0,0 +1,195 @@
+import hashlib
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from .models import UserProfile
+
+# Кэш готовых фрагментов отчетов (HTML и сопутствующие поля AJAX-ответа).
+#
+# Ключ фрагмента включает версии данных всех аптек, попавших в отчет.
+# Версия аптеки - случайная метка, которая заменяется новой при любом
+# изменении посещаемости, сотрудников или самой аптеки, поэтому устаревшие
+# фрагменты не удаляются, а просто перестают находиться и вытесняются по сроку.
+# Метка начинается со времени изменения, поэтому по версиям можно получить и
+# дату последнего изменения данных (для Last-Modified).
+#
+# Версии хранятся отдельно от фрагментов (KADR_STATE_CACHE): фрагментов
+# много, и при переполнении кэш вытесняет случайные записи - вытесненная
+# версия сбрасывала бы все фрагменты аптеки.
+#
+# Одинаковые отчеты, запрошенные одновременно (или сразу после вытеснения
+# фрагмента), строятся один раз: первый запрос берет в кэше блокировку
+# построения фрагмента, остальные ждут, пока фрагмент появится в кэше
+# (см. get_fragment с wait=True). Блокировка живет в общем кэше версий
+# (KADR_STATE_CACHE), поэтому действует между процессами и не вытесняется
+# вместе с фрагментами. Снимает блокировку только взявший ее запрос (по метке):
+# если она истекла и ее взял другой запрос, первый ее не тронет. У файлового
+# кэша add() не атомарна: в узком окне отчет могут построить два процесса -
+# результат тот же, лишняя только работа.
+
+VERSION_KEY_PREFIX = 'kadr:pharmacy_version:'
+FRAGMENT_KEY_PREFIX = 'kadr:fragment:'
+LOCK_KEY_PREFIX = 'kadr:fragment_lock:'
+
+# Пауза между проверками фрагмента, пока его строит другой запрос, в секундах
+BUILD_POLL_INTERVAL = 0.05
+
+# Блокировки построения, взятые текущим потоком: {ключ блокировки: метка}
+_build_locks = threading.local()
+
+
+def get_cache():
+    return caches[getattr(settings, 'KADR_FRAGMENT_CACHE', 'default')]
+
+
+def get_state_cache():
+    """Кэш версий и блокировок, в котором записи не вытесняются переполнением"""
+    return caches[getattr(settings, 'KADR_STATE_CACHE', getattr(settings, 'KADR_FRAGMENT_CACHE', 'default'))]
+
+
+def get_fragment_timeout():
+    return getattr(settings, 'KADR_FRAGMENT_CACHE_TIMEOUT', 3600)
+
+
+def get_build_timeout():
+    """Срок блокировки построения и наибольшее время ожидания чужого построения, в секундах"""
+    return getattr(settings, 'KADR_FRAGMENT_BUILD_TIMEOUT', 30)
+
+
+def _version_key(pharmacy_id):
+    return f'{VERSION_KEY_PREFIX}{pharmacy_id}'
+
+
+def _new_version():
+    return f'{int(time.time())}.{uuid.uuid4().hex}'
+
+
+def version_timestamp(version):
+    """Время изменения (Unix), с которого начинается версия; None для версий без времени"""
+    timestamp, separator, _ = version.partition('.')
+    return int(timestamp) if separator and timestamp.isdigit() else None
+
+
+def get_pharmacy_versions(pharmacy_ids):
+    """Текущие версии данных аптек; отсутствующие версии создаются.
+
+    Новая версия всегда случайная, поэтому после вытеснения метки из кэша
+    старые фрагменты этой аптеки не могут быть выданы повторно.
+    """
+    cache = get_state_cache()
+    keys = {pharmacy_id: _version_key(pharmacy_id) for pharmacy_id in pharmacy_ids}
+    versions = cache.get_many(keys.values())
+
+    missing = {key: _new_version() for key in keys.values() if key not in versions}
+    for key, version in missing.items():
+        # add() не перезаписывает версию, созданную параллельным процессом
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key, version)
+        versions[key] = version
+
+    return [versions[keys[pharmacy_id]] for pharmacy_id in pharmacy_ids]
+
+
+def bump_pharmacy_versions(pharmacy_ids):
+    """Делает недействительными фрагменты отчетов по аптекам.
+
+    Внутри транзакции версии меняются только после фиксации, чтобы
+    параллельный запрос не закэшировал старые данные под новой версией.
+    """
+    pharmacy_ids = {pharmacy_id for pharmacy_id in pharmacy_ids if pharmacy_id is not None}
+    if not pharmacy_ids:
+        return
+
+    def bump():
+        get_state_cache().set_many(
+            {_version_key(pharmacy_id): _new_version() for pharmacy_id in pharmacy_ids},
+            timeout=None
+        )
+
+    transaction.on_commit(bump)
+
+
+def bump_profile_versions(profile_ids):
+    """Делает недействительными фрагменты аптек, где работают указанные сотрудники"""
+    bump_pharmacy_versions(
+        UserProfile.objects.filter(id__in=set(profile_ids)).values_list('pharmacy_id', flat=True).distinct()
+    )
+
+
+def scope_digest(view_name, role, pharmacy_ids, *params):
+    """Отпечаток данных отчета: представление, роль, набор аптек с версиями и параметры.
+
+    Возвращает (md5, время последнего изменения данных аптек или None).
+    """
+    pharmacy_ids = sorted(pharmacy_ids)
+    versions = get_pharmacy_versions(pharmacy_ids)
+    parts = [view_name, role] + [f'{pharmacy_id}.{version}' for pharmacy_id, version in zip(pharmacy_ids, versions)]
+    parts += [str(param) for param in params]
+    digest = hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()
+    timestamps = [version_timestamp(version) for version in versions]
+    last_modified = None if None in timestamps else max(timestamps, default=None)
+    return digest, last_modified
+
+
+def fragment_key(view_name, role, pharmacy_ids, *params):
+    """Ключ фрагмента: представление, роль, набор аптек с версиями и параметры отчета"""
+    digest, _ = scope_digest(view_name, role, pharmacy_ids, *params)
+    return f'{FRAGMENT_KEY_PREFIX}{view_name}:{digest}'
+
+
+def _held_locks():
+    if not hasattr(_build_locks, 'tokens'):
+        _build_locks.tokens = {}
+    return _build_locks.tokens
+
+
+def get_fragment(key, wait=False):
+    """Готовый фрагмент или None.
+
+    wait=True - фрагмент строится одним запросом на все одновременные:
+    None получает только запрос, взявший блокировку построения (или не
+    дождавшийся ее за KADR_FRAGMENT_BUILD_TIMEOUT), он строит фрагмент и
+    сохраняет его set_fragment. Остальные ждут и получают его результат.
+    Блокировка снимается в set_fragment, а если фрагмент не сохранен
+    (ошибка) - по окончании запроса (release_build_locks).
+    """
+    cache = get_cache()
+    payload = cache.get(key)
+    if payload is not None or not wait:
+        return payload
+
+    locks = get_state_cache()
+    lock_key = f'{LOCK_KEY_PREFIX}{key}'
+    timeout = get_build_timeout()
+    deadline = time.monotonic() + timeout
+    while True:
+        token = uuid.uuid4().hex
+        if locks.add(lock_key, token, timeout=timeout):
+            _held_locks()[lock_key] = token
+            return None
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(BUILD_POLL_INTERVAL)
+        payload = cache.get(key)
+        if payload is not None:
+            return payload
+
+
+def set_fragment(key, payload):
+    get_cache().set(key, payload, timeout=get_fragment_timeout())
+    release_build_locks([f'{LOCK_KEY_PREFIX}{key}'])
+
+
+def release_build_locks(lock_keys=None):
+    """Снимает блокировки построения, взятые текущим потоком (по умолчанию все)"""
+    held = _held_locks()
+    locks = get_state_cache()
+    for lock_key in list(held if lock_keys is None else lock_keys):
+        token = held.pop(lock_key, None)
+        # Истекшую и перехваченную другим запросом блокировку не трогаем
+        if token is not None and locks.get(lock_key) == token:
+            locks.delete(lock_key)
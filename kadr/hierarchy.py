@@ -0,0 +1,51 @@
+from django.db.models import Q
+from .models import Pharmacy, UserProfile
+
+# Иерархия аптек хранится материализованными путями (Pharmacy.path, "/1/5/12/").
+# Пути состоят из цифр и "/", а "/" в кодировке идет сразу перед "0", поэтому
+# поддерево с путем P - это диапазон P <= path < P без последнего "/" плюс "0".
+# Такое условие, в отличие от LIKE, использует обычный индекс по path.
+
+
+def subtree_q(path, field='path', include_self=True):
+    """Условие "путь лежит в поддереве path" для поля field (например, pharmacy__path)"""
+    lower = {f'{field}__gte' if include_self else f'{field}__gt': path}
+    return Q(**lower, **{f'{field}__lt': path[:-1] + '0'})
+
+
+def get_pharmacies_under(pharmacy, include_self=True):
+    """Все аптеки поддерева (на любой глубине) одним запросом"""
+    return Pharmacy.objects.filter(subtree_q(pharmacy.path, include_self=include_self))
+
+
+def get_employees_under(pharmacy):
+    """Все сотрудники аптеки и ее филиалов на любой глубине одним запросом"""
+    return UserProfile.objects.filter(subtree_q(pharmacy.path, field='pharmacy__path'))
+
+
+def rebuild_pharmacy_paths():
+    """Пересчитывает пути всех аптек (после пакетной загрузки или удаления ветки).
+
+    Аптеки с неизвестной или зацикленной цепочкой подчинения считаются корнями.
+    Возвращает число измененных аптек.
+    """
+    parents = dict(Pharmacy.objects.values_list('id', 'main_pharmacy_id'))
+    paths = {}
+
+    def build(pharmacy_id, chain=()):
+        if pharmacy_id not in paths:
+            parent_id = parents.get(pharmacy_id)
+            if parent_id is None or parent_id not in parents or parent_id in chain:
+                paths[pharmacy_id] = f'/{pharmacy_id}/'
+            else:
+                paths[pharmacy_id] = f'{build(parent_id, chain + (pharmacy_id,))}{pharmacy_id}/'
+        return paths[pharmacy_id]
+
+    changed = []
+    for pharmacy in Pharmacy.objects.only('id', 'path'):
+        path = build(pharmacy.id)
+        if pharmacy.path != path:
+            pharmacy.path = path
+            changed.append(pharmacy)
+    Pharmacy.objects.bulk_update(changed, ['path'], batch_size=500)
+    return len(changed)
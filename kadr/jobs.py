@@ -0,0 +1,311 @@
+import json
+import logging
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.template.loader import render_to_string
+from django.utils import timezone
+from .exports import csv_stream, statistics_rows, timesheet_rows
+from .fragment_cache import scope_digest
+from .hierarchy import get_pharmacies_under
+from .models import Pharmacy, ReportJob
+from .report_data import DATA_FORMAT, employee_stats_data, network_stats_data, statistics_data, timesheet_data
+from .reports import collect_employee_statistics, collect_network_statistics, count_network_employees
+from .timesheet import TimesheetMatrix, build_year_timesheet, month_bounds
+from .utils import count_working_days, get_working_days
+
+# Фоновые отчеты.
+#
+# Тяжелые отчеты (табель всех аптек за год, статистика дороже
+# KADR_REPORT_BACKGROUND_COST, см. kadr.admission) не строятся в запросе: запрос
+# ставит задание ReportJob в очередь и получает его номер, а команда
+# run_report_jobs выполняет задания в пуле процессов и сохраняет результат
+# (HTML, JSON или CSV) в строке задания. Клиент опрашивает состояние задания
+# и забирает готовый результат.
+#
+# Ключ данных задания строится из тех же версий данных аптек, что и ключи
+# кэша фрагментов (kadr.fragment_cache): пока данные аптек отчета не менялись,
+# тот же запрос получает уже готовое (или еще выполняемое) задание, после
+# изменения - ставится новое. Задания и их результаты видит только
+# заказавший их пользователь.
+
+logger = logging.getLogger('kadr.jobs')
+
+# Ошибка задания для клиента; подробности исключения пишутся только в журнал
+JOB_FAILED_ERROR = 'Не удалось построить отчет'
+
+CONTENT_TYPES = {
+    'html': 'text/html; charset=utf-8',
+    'json': 'application/json',
+    'csv': 'text/csv; charset=utf-8',
+}
+REPORT_FORMATS = tuple(CONTENT_TYPES)
+
+
+def get_job_ttl():
+    """Сколько секунд хранятся завершенные задания"""
+    return getattr(settings, 'KADR_REPORT_JOB_TTL', 24 * 3600)
+
+
+def timesheet_params(data, today):
+    """Параметры табеля из запроса: аптека (None - все аптеки), год, тип периода и месяцы.
+
+    Месяцы года определяются при постановке задания, поэтому результат не зависит
+    от дня выполнения. При некорректных параметрах бросает ValueError.
+    """
+    year = int(data.get('year') or today.year)
+    period_type = data.get('period_type', 'month')
+    if period_type == 'year':
+        months = list(range(1, (today.month if year == today.year else 12) + 1))
+    elif period_type == 'month':
+        months = [int(data.get('month') or today.month)]
+    else:
+        raise ValueError('Некорректный тип периода')
+    date(year, months[0], 1)
+
+    pharmacy_id = data.get('pharmacy') or None
+    if pharmacy_id is not None:
+        pharmacy_id = int(pharmacy_id)
+        if not Pharmacy.objects.filter(id=pharmacy_id).exists():
+            raise ValueError('Аптека не найдена')
+    return {'pharmacy': pharmacy_id, 'year': year, 'period_type': period_type, 'months': months}
+
+
+def timesheet_pharmacies(params):
+    """Аптеки табеля: выбранная или все аптеки в порядке иерархии"""
+    if params['pharmacy']:
+        return list(Pharmacy.objects.filter(id=params['pharmacy']))
+    return list(Pharmacy.objects.order_by('path', 'id'))
+
+
+def build_timesheet(params, report_format):
+    """Табель аптеки или всех аптек в формате задания"""
+    year, months = params['year'], params['months']
+
+    if report_format == 'csv':
+        pharmacy_ids = [params['pharmacy']] if params['pharmacy'] else None
+        return ''.join(csv_stream(timesheet_rows(pharmacy_ids, year, months)))
+
+    # Все аптеки отчета - одной матрицей за весь период
+    pharmacies = timesheet_pharmacies(params)
+    first_day = month_bounds(year, months[0])[0]
+    last_day = month_bounds(year, months[-1])[1]
+    matrix = TimesheetMatrix(pharmacies, first_day, last_day)
+
+    if report_format == 'json':
+        return json.dumps({
+            'success': True,
+            'format': DATA_FORMAT,
+            'timesheets': [timesheet_data(pharmacy, year, months, matrix=matrix) for pharmacy in pharmacies],
+        }, cls=DjangoJSONEncoder, ensure_ascii=False)
+
+    if params['period_type'] == 'month':
+        month = months[0]
+        working_days, non_working_days = get_working_days(year, month)
+        context = {
+            'timesheet_data': [
+                {
+                    'pharmacy': pharmacy,
+                    'is_main': pharmacy.main_pharmacy_id is None,
+                    'employees': matrix.month_rows(pharmacy, year, month),
+                    'period': f"{first_day.strftime('%d.%m.%Y')} - {last_day.strftime('%d.%m.%Y')}"
+                }
+                for pharmacy in pharmacies
+            ],
+            'working_days_set': set(working_days),
+            'days_in_month': list(range(1, last_day.day + 1)),
+        }
+    else:
+        context = {
+            'timesheet_data': [
+                pharmacy_month
+                for pharmacy in pharmacies
+                for pharmacy_month in build_year_timesheet(pharmacy, year, months[-1], matrix=matrix)
+            ],
+        }
+    context['period_type'] = params['period_type']
+    return render_to_string('includes/timesheet_results.html', context)
+
+
+def timesheet_pharmacy_ids(params):
+    """Аптеки, от данных которых зависит табель"""
+    if params['pharmacy']:
+        return [params['pharmacy']]
+    return list(Pharmacy.objects.values_list('id', flat=True))
+
+
+def statistics_params(data, today):
+    """Параметры статистики из запроса: аптека (None - вся сеть), филиалы и период.
+
+    При некорректных параметрах бросает ValueError.
+    """
+    start_date = date.fromisoformat(data.get('start_date') or '')
+    end_date = date.fromisoformat(data.get('end_date') or '')
+    if start_date > end_date:
+        start_date, end_date = end_date, start_date
+
+    pharmacy_id = data.get('pharmacy') or None
+    if pharmacy_id is not None:
+        pharmacy_id = int(pharmacy_id)
+        if not Pharmacy.objects.filter(id=pharmacy_id).exists():
+            raise ValueError('Аптека не найдена')
+    return {
+        'pharmacy': pharmacy_id,
+        'include_branches': bool(pharmacy_id and data.get('include_branches')),
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+    }
+
+
+def statistics_pharmacy_ids(params):
+    """Аптеки, от данных которых зависит статистика"""
+    if not params['pharmacy']:
+        return list(Pharmacy.objects.values_list('id', flat=True))
+    if params['include_branches']:
+        pharmacy = Pharmacy.objects.get(id=params['pharmacy'])
+        return list(get_pharmacies_under(pharmacy).order_by('path').values_list('id', flat=True))
+    return [params['pharmacy']]
+
+
+def build_statistics(params, report_format):
+    """Статистика аптеки (с филиалами) или сводка сети в формате задания"""
+    start_date = date.fromisoformat(params['start_date'])
+    end_date = date.fromisoformat(params['end_date'])
+
+    if report_format == 'csv':
+        pharmacy_ids = statistics_pharmacy_ids(params) if params['pharmacy'] else None
+        return ''.join(csv_stream(statistics_rows(pharmacy_ids, start_date, end_date)))
+
+    working_days_count = count_working_days(start_date, end_date)
+    selected_pharmacy = Pharmacy.objects.get(id=params['pharmacy']) if params['pharmacy'] else None
+    employee_stats = []
+    network_stats = []
+    if selected_pharmacy:
+        employee_stats, totals = collect_employee_statistics(
+            statistics_pharmacy_ids(params), start_date, end_date, working_days_count
+        )
+    else:
+        network_stats, totals = collect_network_statistics(
+            Pharmacy.objects.order_by('path'), count_network_employees(), start_date, end_date, working_days_count
+        )
+
+    if report_format == 'json':
+        return json.dumps(statistics_data(
+            working_days_count,
+            pharmacy_name=selected_pharmacy.name if selected_pharmacy else None,
+            employees=employee_stats_data(employee_stats),
+            pharmacies=network_stats_data(network_stats)
+        ), cls=DjangoJSONEncoder, ensure_ascii=False)
+
+    return render_to_string('includes/leader_statistics_results.html', {
+        'start_date': start_date,
+        'end_date': end_date,
+        'employee_stats': employee_stats,
+        'network_stats': network_stats,
+        'pharmacy_stats': totals,
+        'selected_pharmacy': selected_pharmacy,
+        'include_branches': params['include_branches'],
+        'working_days_count': working_days_count,
+    })
+
+
+# Отчеты, которые можно заказать в фоне: разбор параметров запроса,
+# аптеки отчета (для ключа данных) и построение результата
+REPORTS = {
+    'timesheet': {
+        'params': timesheet_params,
+        'pharmacy_ids': timesheet_pharmacy_ids,
+        'build': build_timesheet,
+    },
+    'statistics': {
+        'params': statistics_params,
+        'pharmacy_ids': statistics_pharmacy_ids,
+        'build': build_statistics,
+    },
+}
+
+
+def submit_report_job(user, report, report_format, data, today):
+    """Ставит отчет пользователя user в очередь; возвращает задание.
+
+    data - параметры запроса. Если у пользователя задание с тем же ключом
+    данных уже выполнено или выполняется, возвращается оно. При неизвестном
+    отчете, формате или некорректных параметрах бросает ValueError.
+    """
+    if report not in REPORTS:
+        raise ValueError('Неизвестный отчет')
+    if report_format not in REPORT_FORMATS:
+        raise ValueError('Неизвестный формат отчета')
+    params = REPORTS[report]['params'](data, today)
+
+    data_key, _ = scope_digest(
+        'report_job', report, REPORTS[report]['pharmacy_ids'](params),
+        report_format, json.dumps(params, sort_keys=True)
+    )
+    job = ReportJob.objects.filter(
+        user=user,
+        data_key=data_key,
+        status__in=[ReportJob.PENDING, ReportJob.RUNNING, ReportJob.DONE]
+    ).order_by('-created_at').first()
+    if job is None:
+        job = ReportJob.objects.create(
+            user=user, report=report, params=params, format=report_format, data_key=data_key
+        )
+    return job
+
+
+def claim_jobs(limit):
+    """Забирает до limit заданий из очереди (в порядке поступления); возвращает их id"""
+    claimed = []
+    pending = ReportJob.objects.filter(status=ReportJob.PENDING).order_by('created_at', 'id')
+    for job_id in pending.values_list('id', flat=True)[:limit]:
+        # Условное обновление: задание, забранное другим обработчиком, пропускается
+        if ReportJob.objects.filter(id=job_id, status=ReportJob.PENDING).update(
+            status=ReportJob.RUNNING, started_at=timezone.now()
+        ):
+            claimed.append(job_id)
+    return claimed
+
+
+def requeue_running_jobs():
+    """Возвращает в очередь задания, прерванные остановкой обработчика"""
+    return ReportJob.objects.filter(status=ReportJob.RUNNING).update(status=ReportJob.PENDING, started_at=None)
+
+
+def finish_job(job_id, result='', content_type='', error=''):
+    ReportJob.objects.filter(id=job_id).update(
+        status=ReportJob.FAILED if error else ReportJob.DONE,
+        result=result,
+        content_type=content_type,
+        error=error,
+        finished_at=timezone.now()
+    )
+
+
+def run_report_job(job_id):
+    """Строит отчет задания и сохраняет результат (выполняется в процессе пула)"""
+    close_old_connections()
+    try:
+        job = ReportJob.objects.get(id=job_id)
+        report = REPORTS[job.report]
+        try:
+            result = report['build'](job.params, job.format)
+        except Exception:
+            logger.exception('Ошибка фонового отчета #%s', job_id)
+            finish_job(job_id, error=JOB_FAILED_ERROR)
+            return False
+        finish_job(job_id, result=result, content_type=CONTENT_TYPES[job.format])
+        return True
+    finally:
+        close_old_connections()
+
+
+def purge_expired_jobs():
+    """Удаляет завершенные задания старше KADR_REPORT_JOB_TTL; возвращает их число"""
+    deleted, _ = ReportJob.objects.filter(
+        status__in=[ReportJob.DONE, ReportJob.FAILED],
+        finished_at__lt=timezone.now() - timedelta(seconds=get_job_ttl())
+    ).delete()
+    return deleted
@@ -0,0 +1,117 @@
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.test.utils import override_settings
+from kadr.attendance import upsert_attendances
+from kadr.models import Attendance, AttendanceMonth, Pharmacy, UserProfile
+from kadr.reports import get_pharmacy_status_counts
+from kadr.storage import DAILY, MONTHLY, STORAGE_MODES, convert_storage, is_monthly, read_codes
+from kadr.timesheet import build_year_timesheet, month_bounds
+
+STORAGE_MODELS = {DAILY: Attendance, MONTHLY: AttendanceMonth}
+
+
+def table_size(model):
+    """Размер таблицы модели вместе с индексами в байтах (None, если СУБД не сообщает)"""
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            try:
+                cursor.execute(
+                    'SELECT SUM(s.pgsize) FROM dbstat s JOIN sqlite_master m ON m.name = s.name '
+                    'WHERE m.tbl_name = %s', [table]
+                )
+            except Exception:  # SQLite собран без DBSTAT
+                return None
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_total_relation_size(%s)', [table])
+        else:
+            return None
+        return cursor.fetchone()[0]
+
+
+def best_time(func, repeat):
+    """Лучшее время выполнения func из repeat запусков, в миллисекундах"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+class Command(BaseCommand):
+    help = 'Сравнение режимов хранения посещаемости: размер таблиц и время отчетов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, default=None,
+                            help='Год отчетов (по умолчанию - год последней записи)')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Сколько раз повторять каждый замер (по умолчанию 5)')
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+
+        # Обе таблицы заполняются внутри транзакции, которая в конце откатывается:
+        # данные и режим хранения базы не меняются
+        with transaction.atomic():
+            if is_monthly():
+                convert_storage(DAILY, keep_source=True)
+            else:
+                convert_storage(MONTHLY, keep_source=True)
+
+            last_date = Attendance.objects.aggregate(last=Max('date'))['last'] or date.today()
+            year = options['year'] or last_date.year
+            pharmacy = Pharmacy.objects.annotate(
+                employees_count=Count('userprofile')
+            ).order_by('-employees_count', 'id').first()
+            if pharmacy is None:
+                self.stdout.write('Нет аптек для замеров')
+                transaction.set_rollback(True)
+                return
+
+            month_first_day, month_last_day = month_bounds(year, last_date.month if last_date.year == year else 12)
+            # Период статистики с неполными месяцами по краям
+            period_start = month_first_day - timedelta(days=45)
+            period_end = month_first_day + timedelta(days=14)
+            employees = list(UserProfile.objects.filter(pharmacy=pharmacy).values_list('id', flat=True))
+
+            checks = [
+                (f'Табель аптеки за {year} год',
+                 lambda: build_year_timesheet(pharmacy, year)),
+                ('Посещаемость сети за месяц',
+                 lambda: read_codes(month_first_day, month_last_day, pharmacy__isnull=False)),
+                (f'Статистика сети {period_start:%d.%m.%Y} - {period_end:%d.%m.%Y}',
+                 lambda: get_pharmacy_status_counts(period_start, period_end)),
+                ('Запись дня аптеки',
+                 lambda: upsert_attendances([(user_id, month_first_day, 'full') for user_id in employees])),
+            ]
+
+            self.stdout.write(f'Аптека табеля: {pharmacy.name}, сотрудников: {len(employees)}')
+            results = {}
+            for mode in STORAGE_MODES:
+                model = STORAGE_MODELS[mode]
+                with override_settings(KADR_ATTENDANCE_STORAGE=mode):
+                    results[mode] = [model.objects.count(), table_size(model)] + [
+                        best_time(func, repeat) for _, func in checks
+                    ]
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(f'{"":48}' + ''.join(f'{mode:>14}' for mode in STORAGE_MODES))
+        rows = [('Строк в таблице', '{:.0f}'), ('Размер таблицы и индексов, КБ', None)]
+        rows += [(f'{title}, мс', '{:.1f}') for title, _ in checks]
+        for index, (title, value_format) in enumerate(rows):
+            values = []
+            for mode in STORAGE_MODES:
+                value = results[mode][index]
+                if value is None:
+                    values.append('-')
+                elif value_format is None:
+                    values.append(f'{value / 1024:.0f}')
+                else:
+                    values.append(value_format.format(value))
+            self.stdout.write(f'{title[:48]:48}' + ''.join(f'{value:>14}' for value in values))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from kadr.storage import DAILY, MONTHLY, convert_storage, storage_mode
+
+
+class Command(BaseCommand):
+    help = 'Перенос посещаемости между режимами хранения (по дням / по месяцам)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=[DAILY, MONTHLY], required=True, dest='target',
+                            help='Режим, в который переносятся данные')
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='Размер пакета при чтении и записи (по умолчанию 2000)')
+        parser.add_argument('--keep-source', action='store_true',
+                            help='Не удалять строки исходного режима')
+
+    def handle(self, *args, **options):
+        target = options['target']
+        self.stdout.write(f'Перенос посещаемости в режим {target}...')
+        created = convert_storage(target, batch_size=options['batch_size'], keep_source=options['keep_source'])
+        self.stdout.write(self.style.SUCCESS(f'Создано {created} строк'))
+
+        # Данные те же, поэтому сводка и кэш отчетов остаются верными
+        if storage_mode() != target:
+            self.stdout.write(self.style.WARNING(
+                f'Установите KADR_ATTENDANCE_STORAGE = {target!r} в настройках и перезапустите приложение'
+            ))
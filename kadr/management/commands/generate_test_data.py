@@ -1,48 +1,119 @@
 # your_app/management/commands/generate_test_data.py
 from django.core.management.base import BaseCommand
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from django.db import connection, transaction
 from django.utils import timezone
-from datetime import timedelta
+from datetime import date, timedelta
+from itertools import repeat
+from multiprocessing import Pool
 import random
-from kadr.models import Pharmacy, UserProfile, Attendance
+from kadr.fragment_cache import get_cache, get_state_cache
+from kadr.hierarchy import rebuild_pharmacy_paths
+from kadr.models import Pharmacy, UserProfile, Attendance, AttendanceMonth, AttendanceRollup
+from kadr.rollup import rebuild_attendance_rollup
+from kadr.storage import MONTHLY, convert_storage, is_monthly
+
+STATUS_CHOICES = ['full', 'half', 'vacation', 'sick', '']
+STATUS_WEIGHTS = [0.6, 0.2, 0.05, 0.05, 0.1]
+
+# Сколько сотрудников обрабатывает один пакет генерации посещаемости
+USERS_PER_CHUNK = 50
+
+
+def generate_attendance_chunk(args):
+    """Генерирует готовые к записи строки посещаемости для группы сотрудников.
+
+    Выполняется в рабочих процессах, поэтому не обращается к базе данных.
+    Собственное зерно у каждого пакета делает результат воспроизводимым
+    при любом числе процессов.
+    """
+    employees, start_date, end_date, seed, timestamp = args
+    user_ids, pharmacy_ids = zip(*employees)
+    rng = random.Random(seed)
+    rows = []
+
+    current_date = start_date
+    while current_date <= end_date:
+        if current_date.weekday() < 5:  # Только рабочие дни
+            statuses = rng.choices(STATUS_CHOICES, weights=STATUS_WEIGHTS, k=len(user_ids))
+            rows.extend(zip(
+                user_ids, pharmacy_ids, repeat(current_date.isoformat()), statuses, repeat(timestamp), repeat(timestamp)
+            ))
+        current_date += timedelta(days=1)
+
+    return rows
+
+
+def insert_attendance_rows(rows, batch_size):
+    """Записывает строки посещаемости напрямую через executemany.
+
+    Для миллионов строк создание объектов модели и bulk_create занимают
+    большую часть времени генерации, поэтому строки пишутся готовыми кортежами.
+    """
+    meta = Attendance._meta
+    columns = [meta.get_field(name).column for name in ('user', 'pharmacy', 'date', 'status', 'created_at', 'updated_at')]
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        connection.ops.quote_name(meta.db_table),
+        ', '.join(connection.ops.quote_name(column) for column in columns),
+        ', '.join(['%s'] * len(columns))
+    )
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), batch_size):
+            cursor.executemany(sql, rows[i:i + batch_size])
 
 
 class Command(BaseCommand):
     help = 'Генерация тестовых данных для аптек и посещаемости'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--pharmacies', type=int, default=7,
+                            help='Общее количество аптек (по умолчанию 7)')
+        parser.add_argument('--networks', type=int, default=1,
+                            help='Количество главных аптек (по умолчанию 1)')
+        parser.add_argument('--depth', type=int, default=1,
+                            help='Глубина подчинения филиалов (по умолчанию 1 - только прямые филиалы)')
+        parser.add_argument('--employees', type=int, default=None,
+                            help='Сотрудников на аптеку без заведующего (по умолчанию случайно 2-3)')
+        parser.add_argument('--years', type=int, default=0,
+                            help='Глубина истории посещаемости в годах (по умолчанию - последние 30 дней)')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Зерно генератора случайных чисел')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Размер пакета при записи посещаемости (по умолчанию 5000)')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Количество процессов для генерации посещаемости (по умолчанию 1)')
+        parser.add_argument('--password', default='pharmacy123',
+                            help='Общий пароль заведующих и сотрудников (по умолчанию pharmacy123)')
+
     def handle(self, *args, **options):
         self.stdout.write('Создание тестовых данных...')
 
+        seed = options['seed'] if options['seed'] is not None else random.randrange(2 ** 32)
+        rng = random.Random(seed)
+        batch_size = options['batch_size']
+
         # Очистка старых данных в правильном порядке
         Attendance.objects.all().delete()
+        AttendanceMonth.objects.all().delete()
+        AttendanceRollup.objects.all().delete()
         UserProfile.objects.all().delete()
-        User.objects.filter(
-            username__in=['leader', 'manager_1', 'manager_2', 'manager_3', 'manager_4', 'manager_5', 'manager_6',
-                          'manager_7']).delete()
+        User.objects.filter(username='leader').delete()
+        User.objects.filter(username__startswith='manager_').delete()
         User.objects.filter(username__startswith='employee_').delete()
         Pharmacy.objects.all().delete()
 
-        # Создание главной аптеки
-        main_pharmacy = Pharmacy.objects.create(
-            name='Аптека №1 (Главная)',
-            address='ул. Центральная, д. 1',
-            phone='+79990000001',
-            is_main=True
+        # Данные создаются пакетами в обход сигналов, а номера аптек могут
+        # повториться - кэшированные отчеты и версии прежних данных больше не нужны
+        get_cache().clear()
+        get_state_cache().clear()
+
+        all_pharmacies = self.create_pharmacies(
+            max(options['pharmacies'], 1),
+            max(min(options['networks'], options['pharmacies']), 1),
+            max(options['depth'], 1)
         )
-        self.stdout.write(f'Создана главная аптека: {main_pharmacy}')
-
-        # Создание аптечных пунктов (6 штук)
-        branch_pharmacies = []
-        for i in range(1, 7):
-            pharmacy = Pharmacy.objects.create(
-                name=f'Аптека №{i + 1} (Филиал)',
-                address=f'ул. Филиальная, д. {i}',
-                phone=f'+7999000001{i}',
-                is_main=False,
-                main_pharmacy=main_pharmacy
-            )
-            branch_pharmacies.append(pharmacy)
-            self.stdout.write(f'Создан филиал: {pharmacy}')
+        self.stdout.write(f'Создано аптек: {len(all_pharmacies)}')
 
         # Создание пользователя-руководителя
         leader_user = User.objects.create_user(
@@ -62,95 +133,98 @@ class Command(BaseCommand):
         )
         self.stdout.write(f'Создан руководитель: {leader_profile}')
 
-        # Создание заведующих для каждой аптеки
-        managers = []
-        all_pharmacies = [main_pharmacy] + branch_pharmacies
+        # Заведующие и сотрудники создаются пакетами с одним заранее
+        # вычисленным хэшем пароля вместо PBKDF2 на каждого пользователя
+        password_hash = make_password(options['password'])
+        users = []
+        profiles = []
+        employee_count = 0
 
         for i, pharmacy in enumerate(all_pharmacies, 1):
-            manager_user = User.objects.create_user(
+            users.append(User(
                 username=f'manager_{i}',
                 email=f'manager{i}@pharmacy.ru',
-                password=f'manager{i}123',
+                password=password_hash,
                 first_name=f'Менеджер{i}',
                 last_name='Аптечный'
-            )
-
-            manager_profile = UserProfile.objects.create(
-                user=manager_user,
+            ))
+            profiles.append(dict(
                 full_name=f'Аптечный Менеджер {i} Иванович',
                 pharmacy=pharmacy,
                 is_manager=True,
                 is_leader=False
-            )
-            managers.append(manager_profile)
-            self.stdout.write(f'Создан заведующий: {manager_profile}')
+            ))
 
-        # Создание обычных сотрудников (по 2-3 на аптеку)
-        employees = []
-        employee_count = 1
-
-        for pharmacy in all_pharmacies:
-            for j in range(random.randint(2, 3)):
-                employee_user = User.objects.create_user(
+            pharmacy_employees = options['employees']
+            if pharmacy_employees is None:
+                pharmacy_employees = rng.randint(2, 3)
+            for j in range(pharmacy_employees):
+                employee_count += 1
+                users.append(User(
                     username=f'employee_{employee_count}',
                     email=f'employee{employee_count}@pharmacy.ru',
-                    password=f'employee{employee_count}123',
+                    password=password_hash,
                     first_name=f'Сотрудник{employee_count}',
                     last_name='Аптечный'
-                )
-
-                employee_profile = UserProfile.objects.create(
-                    user=employee_user,
+                ))
+                profiles.append(dict(
                     full_name=f'Аптечный Сотрудник {employee_count} Петрович',
                     pharmacy=pharmacy,
                     is_manager=False,
                     is_leader=False
-                )
-                employees.append(employee_profile)
-                employee_count += 1
-                self.stdout.write(f'Создан сотрудник: {employee_profile}')
+                ))
 
-        # УПРОЩЕННАЯ генерация данных о посещаемости (только последний месяц)
-        all_users = managers + employees
-        status_choices = ['full', 'half', 'vacation', 'sick', '']
-        status_weights = [0.6, 0.2, 0.05, 0.05, 0.1]
+        with transaction.atomic():
+            users = User.objects.bulk_create(users, batch_size=batch_size)
+            profiles = UserProfile.objects.bulk_create(
+                [UserProfile(user=user, **profile) for user, profile in zip(users, profiles)],
+                batch_size=batch_size
+            )
+        self.stdout.write(f'Создано заведующих: {len(all_pharmacies)}, сотрудников: {employee_count}')
 
-        # Генерируем данные только за последний месяц (30 дней)
-        start_date = timezone.now().date() - timedelta(days=30)
+        # Генерация данных о посещаемости
         end_date = timezone.now().date()
+        if options['years']:
+            start_date = end_date - timedelta(days=365 * options['years'])
+        else:
+            start_date = end_date - timedelta(days=30)
 
-        current_date = start_date
-        attendance_count = 0
-
-        # Создаем записи пакетами для оптимизации
-        attendance_batch = []
+        employees = [(profile.id, profile.pharmacy_id) for profile in profiles]
+        timestamp = connection.ops.adapt_datetimefield_value(timezone.now())
+        chunks = [
+            (employees[i:i + USERS_PER_CHUNK], start_date, end_date, seed + i, timestamp)
+            for i in range(0, len(employees), USERS_PER_CHUNK)
+        ]
 
-        while current_date <= end_date:
-            if current_date.weekday() < 5:  # Только рабочие дни
-                for user_profile in all_users:
-                    status = random.choices(status_choices, weights=status_weights, k=1)[0]
-
-                    attendance_batch.append(Attendance(
-                        user=user_profile,
-                        date=current_date,
-                        status=status
-                    ))
-
-                    attendance_count += 1
+        attendance_count = 0
+        with transaction.atomic():
+            if options['workers'] > 1:
+                pool = Pool(options['workers'])
+                chunk_rows = pool.imap(generate_attendance_chunk, chunks)
+            else:
+                pool = None
+                chunk_rows = map(generate_attendance_chunk, chunks)
 
-                    # Сохраняем пакетами по 100 записей
-                    if len(attendance_batch) >= 100:
-                        Attendance.objects.bulk_create(attendance_batch)
-                        attendance_batch = []
-                        self.stdout.write(f'Создано {attendance_count} записей...')
+            try:
+                for rows in chunk_rows:
+                    insert_attendance_rows(rows, batch_size)
+                    attendance_count += len(rows)
+                    self.stdout.write(f'Создано {attendance_count} записей...')
+            finally:
+                if pool:
+                    pool.close()
+                    pool.join()
 
-            current_date += timedelta(days=1)
+        self.stdout.write(f'Создано {attendance_count} записей о посещаемости')
 
-        # Сохраняем оставшиеся записи
-        if attendance_batch:
-            Attendance.objects.bulk_create(attendance_batch)
+        if is_monthly():
+            # Строки генерируются по дням и упаковываются в месяцы одним проходом
+            month_count = convert_storage(MONTHLY, batch_size=batch_size)
+            self.stdout.write(f'Посещаемость упакована в {month_count} строк по месяцам')
 
-        self.stdout.write(f'Создано {attendance_count} записей о посещаемости')
+        # bulk_create не обновляет помесячную сводку - пересобираем ее целиком
+        rollup_count = rebuild_attendance_rollup(batch_size=batch_size)
+        self.stdout.write(f'Создано {rollup_count} строк помесячной сводки')
 
         # Вывод данных для входа
         self.stdout.write('\n' + '=' * 50)
@@ -162,18 +236,58 @@ class Command(BaseCommand):
         self.stdout.write('Email: leader@pharmacy.ru')
         self.stdout.write('')
 
-        self.stdout.write('Заведующие аптек:')
-        for i in range(1, 8):
-            self.stdout.write(f'Аптека {i}: логин=manager_{i}, пароль=manager{i}123')
+        self.stdout.write(f'Заведующие аптек (пароль {options["password"]}):')
+        for i in range(1, min(8, len(all_pharmacies) + 1)):
+            self.stdout.write(f'Аптека {i}: логин=manager_{i}')
+        if len(all_pharmacies) > 7:
+            self.stdout.write(f'... и еще {len(all_pharmacies) - 7} заведующих')
 
         self.stdout.write('')
-        self.stdout.write('Обычные сотрудники (первые 5):')
-        for i in range(1, min(6, employee_count)):
-            self.stdout.write(f'employee_{i} / employee{i}123')
+        self.stdout.write(f'Обычные сотрудники (первые 5, пароль {options["password"]}):')
+        for i in range(1, min(6, employee_count + 1)):
+            self.stdout.write(f'employee_{i}')
 
-        if employee_count > 6:
-            self.stdout.write(f'... и еще {employee_count - 6} сотрудников')
+        if employee_count > 5:
+            self.stdout.write(f'... и еще {employee_count - 5} сотрудников')
 
+        self.stdout.write(f'Зерно генератора: {seed}')
         self.stdout.write('\n' + '=' * 50)
         self.stdout.write('Тестовые данные успешно созданы!')
-        self.stdout.write('=' * 50)
\ No newline at end of file
+        self.stdout.write('=' * 50)
+
+    def create_pharmacies(self, total, networks, depth):
+        """Создает дерево аптек: главные аптеки и филиалы до заданной глубины"""
+        number = 0
+
+        def make_pharmacy(is_main, parent=None):
+            nonlocal number
+            number += 1
+            return Pharmacy(
+                name=f'Аптека №{number} ({"Главная" if is_main else "Филиал"})',
+                address=f'ул. {"Центральная" if is_main else "Филиальная"}, д. {number}',
+                phone=f'+7999{number:07d}',
+                is_main=is_main,
+                main_pharmacy=parent
+            )
+
+        with transaction.atomic():
+            level = Pharmacy.objects.bulk_create([make_pharmacy(True) for _ in range(networks)])
+            all_pharmacies = list(level)
+
+            # Оставшиеся аптеки поровну распределяются по уровням подчинения,
+            # каждая присоединяется к аптекам предыдущего уровня по кругу
+            remaining = total - networks
+            for depth_level in range(depth):
+                level_size = remaining // (depth - depth_level)
+                if not level_size:
+                    continue
+                level = Pharmacy.objects.bulk_create([
+                    make_pharmacy(False, level[i % len(level)]) for i in range(level_size)
+                ])
+                all_pharmacies.extend(level)
+                remaining -= level_size
+
+            # bulk_create не вызывает Pharmacy.save - пути иерархии строим отдельно
+            rebuild_pharmacy_paths()
+
+        return all_pharmacies
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from kadr.rollup import rebuild_attendance_rollup
+
+
+class Command(BaseCommand):
+    help = 'Пересборка помесячной сводки посещаемости из таблицы посещаемости'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help='Размер пакета при чтении и записи (по умолчанию 2000)')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Пересборка помесячной сводки посещаемости...')
+        created = rebuild_attendance_rollup(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Создано {created} строк сводки'))
@@ -0,0 +1,89 @@
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from kadr.jobs import claim_jobs, finish_job, purge_expired_jobs, requeue_running_jobs, run_report_job
+
+
+class Command(BaseCommand):
+    help = 'Обработчик фоновых отчетов: выполняет задания ReportJob в пуле процессов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'KADR_REPORT_WORKERS', 2),
+                            help='Число процессов пула; 0 - выполнять задания в этом процессе')
+        parser.add_argument('--poll-interval', type=float,
+                            default=getattr(settings, 'KADR_REPORT_POLL_INTERVAL', 1.0),
+                            help='Пауза между проверками очереди в секундах')
+        parser.add_argument('--once', action='store_true',
+                            help='Выполнить задания из очереди и завершиться (для запуска по cron)')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        # Один обработчик на базу: задания, прерванные прошлой остановкой, выполняются заново
+        requeued = requeue_running_jobs()
+        if requeued:
+            self.stdout.write(f'Возвращено в очередь: {requeued}')
+        purge_expired_jobs()
+
+        if workers <= 0:
+            self.run_inline(options)
+            return
+
+        # Процессы пула запускаются заново (spawn) и настраивают Django сами:
+        # соединения с базой и потоки этого процесса им не передаются
+        connections.close_all()
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup
+        )
+        running = {}
+        try:
+            while True:
+                for job_id in claim_jobs(workers - len(running)):
+                    running[pool.submit(run_report_job, job_id)] = job_id
+                if not running:
+                    if options['once']:
+                        break
+                    purge_expired_jobs()
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                done, _ = wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id = running.pop(future)
+                    try:
+                        self.report(job_id, future.result())
+                    except BrokenProcessPool as e:
+                        finish_job(job_id, error='Процесс обработчика завершился аварийно')
+                        raise CommandError(f'Пул процессов остановлен: {e}')
+                    except Exception as e:
+                        finish_job(job_id, error=str(e) or e.__class__.__name__)
+                        self.report(job_id, False)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.shutdown(cancel_futures=True)
+            # Невыполненные задания вернутся в очередь при следующем запуске
+
+    def run_inline(self, options):
+        while True:
+            claimed = claim_jobs(1)
+            if claimed:
+                self.report(claimed[0], run_report_job(claimed[0]))
+                continue
+            if options['once']:
+                return
+            purge_expired_jobs()
+            time.sleep(options['poll_interval'])
+
+    def report(self, job_id, success):
+        if success:
+            self.stdout.write(self.style.SUCCESS(f'Отчет #{job_id} готов'))
+        else:
+            self.stdout.write(self.style.ERROR(f'Отчет #{job_id}: ошибка'))
@@ -0,0 +1,159 @@
+import json
+import logging
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template as DjangoBackendTemplate
+from .profiles import load_profile
+
+logger = logging.getLogger('kadr.performance')
+slow_logger = logging.getLogger('kadr.performance.slow')
+startup_logger = logging.getLogger('kadr.performance.startup')
+
+# Замеры текущего запроса; вне запроса (команды, тесты шаблонов) - None
+_current_timings = ContextVar('kadr_request_timings', default=None)
+
+# Первый запрос процесса пишется и в лог запуска (kadr.warmup) - по нему
+# видно, сколько первый запрос платит за непрогретый процесс
+_first_request_lock = threading.Lock()
+_first_request_logged = False
+
+
+class RequestTimings:
+    """Счетчики одного запроса: SQL (время и число запросов) и рендеринг шаблонов"""
+
+    def __init__(self):
+        self.sql_time = 0.0
+        self.sql_count = 0
+        self.template_time = 0.0
+        self.template_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        """Обертка выполнения SQL (connection.execute_wrapper)"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - started
+            self.sql_count += 1
+
+
+class TimedTemplate(DjangoBackendTemplate):
+    """Шаблон, время рендеринга которого учитывается в замерах текущего запроса.
+
+    Вложенные вызовы (render_to_string внутри шаблонных тегов) не суммируются
+    повторно - учитывается только внешний рендеринг.
+    """
+
+    def render(self, context=None, request=None):
+        timings = _current_timings.get()
+        if timings is None or timings.template_depth:
+            return super().render(context, request)
+
+        timings.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings.template_time += time.perf_counter() - started
+            timings.template_depth -= 1
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Бэкенд шаблонов Django с замером рендеринга (TEMPLATES в core/settings.py)"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
+
+
+def _claim_first_request():
+    """True только для первого завершенного запроса процесса"""
+    global _first_request_logged
+    with _first_request_lock:
+        if _first_request_logged:
+            return False
+        _first_request_logged = True
+        return True
+
+
+class RequestTimingMiddleware:
+    """Замеры производительности каждого запроса.
+
+    Общее время, время и число SQL-запросов, время рендеринга шаблонов
+    и имя представления отдаются заголовком Server-Timing и строкой лога
+    kadr.performance (JSON). Запросы дольше KADR_SLOW_REQUEST_MS
+    дополнительно пишутся в лог медленных запросов kadr.performance.slow.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.server_timing = getattr(settings, 'KADR_SERVER_TIMING', True)
+        self.slow_request_ms = getattr(settings, 'KADR_SLOW_REQUEST_MS', 1000)
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings))
+                response = self.get_response(request)
+        finally:
+            _current_timings.reset(token)
+        total_ms = (time.perf_counter() - started) * 1000
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        view_name = resolver_match.view_name if resolver_match else ''
+        sql_ms = timings.sql_time * 1000
+        template_ms = timings.template_time * 1000
+
+        if self.server_timing:
+            response['Server-Timing'] = ', '.join([
+                f'total;dur={total_ms:.1f};desc="{view_name}"',
+                f'db;dur={sql_ms:.1f};desc="SQL x{timings.sql_count}"',
+                f'tpl;dur={template_ms:.1f};desc="templates"',
+            ])
+
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': view_name,
+            'status': response.status_code,
+            'total_ms': round(total_ms, 1),
+            'sql_ms': round(sql_ms, 1),
+            'sql_count': timings.sql_count,
+            'template_ms': round(template_ms, 1),
+            'user_id': getattr(getattr(request, 'user', None), 'pk', None),
+        }
+        line = json.dumps(record, ensure_ascii=False)
+        logger.info(line)
+        if self.slow_request_ms is not None and total_ms >= self.slow_request_ms:
+            slow_logger.warning(line)
+        if _claim_first_request():
+            startup_logger.info(json.dumps(dict(record, event='first_request'), ensure_ascii=False))
+
+        return response
+
+
+class KadrProfileMiddleware:
+    """Загружает профиль текущего пользователя в request.kadr_profile.
+
+    Профиль берется из общего кэша вместе с аптекой и филиалами
+    (kadr.profiles.load_profile); для анонимных пользователей и
+    пользователей без профиля - None. Ставится после AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.kadr_profile = load_profile(request.user) if request.user.is_authenticated else None
+        return self.get_response(request)
@@ -0,0 +1,87 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:05
+
+from datetime import date
+
+import django.db.models.deletion
+from dateutil.easter import easter
+from django.db import migrations, models
+
+# Логика заполнения сводки зафиксирована здесь на момент миграции: код
+# приложения (kadr.rollup, календарь kadr.utils) может меняться вместе с моделями
+
+BATCH_SIZE = 2000
+
+
+def holidays(year):
+    """Праздники производственного календаря на момент миграции"""
+    days = {date(year, 1, day) for day in range(1, 9)}
+    days.update(date(year, month, day) for month, day in ((2, 23), (3, 8), (5, 1), (5, 9), (6, 12), (11, 4)))
+    days.add(easter(year))
+    return days
+
+
+def backfill_rollup(apps, schema_editor):
+    """Сводка по сотрудникам, месяцам и статусам из построчной посещаемости.
+
+    Строки читаются потоком по сотрудникам, и счетчики сотрудника
+    записываются, как только начинаются строки следующего.
+    """
+    Attendance = apps.get_model('kadr', 'Attendance')
+    AttendanceRollup = apps.get_model('kadr', 'AttendanceRollup')
+    holidays_by_year = {}
+    counters = {}
+    pending = []
+
+    def flush():
+        pending.extend(
+            AttendanceRollup(user_id=user_id, month=month, status=status,
+                             days_count=days_count, working_days_count=working_days_count)
+            for (user_id, month, status), (days_count, working_days_count) in counters.items()
+        )
+        counters.clear()
+        if len(pending) >= BATCH_SIZE:
+            AttendanceRollup.objects.bulk_create(pending)
+            pending.clear()
+
+    current_user_id = None
+    rows = Attendance.objects.exclude(status='').order_by('user_id', 'date').values_list('user_id', 'date', 'status')
+    for user_id, day, status in rows.iterator(chunk_size=BATCH_SIZE):
+        if user_id != current_user_id:
+            flush()
+            current_user_id = user_id
+        if day.year not in holidays_by_year:
+            holidays_by_year[day.year] = holidays(day.year)
+        counts = counters.setdefault((user_id, day.replace(day=1), status), [0, 0])
+        counts[0] += 1
+        if day.weekday() < 5 and day not in holidays_by_year[day.year]:
+            counts[1] += 1
+    flush()
+    AttendanceRollup.objects.bulk_create(pending)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kadr', '0003_userprofile_is_leader_alter_userprofile_is_manager_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttendanceRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='Первое число месяца', verbose_name='Месяц')),
+                ('status', models.CharField(choices=[('', '--- Выберите статус ---'), ('full', 'Весь день'), ('half', 'Пол дня'), ('vacation', 'В отпуске'), ('sick', 'На больничном')], max_length=10, verbose_name='Статус')),
+                ('days_count', models.PositiveIntegerField(default=0, verbose_name='Всего дней')),
+                ('working_days_count', models.PositiveIntegerField(default=0, verbose_name='Рабочих дней')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='kadr.userprofile')),
+            ],
+            options={
+                'verbose_name': 'Сводка посещаемости за месяц',
+                'verbose_name_plural': 'Сводки посещаемости за месяц',
+                'indexes': [models.Index(fields=['month', 'user'], name='kadr_rollup_month_user_idx')],
+                'unique_together': {('user', 'month', 'status')},
+            },
+        ),
+        migrations.RunPython(backfill_rollup, migrations.RunPython.noop),
+    ]
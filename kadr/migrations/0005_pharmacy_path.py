@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:19
+
+from django.db import migrations, models
+
+
+def backfill_paths(apps, schema_editor):
+    """Материализованные пути "/1/5/12/" всех аптек по цепочкам подчинения.
+
+    Логика зафиксирована на момент миграции (в приложении ее ведет
+    kadr.hierarchy): аптеки с неизвестной или зацикленной цепочкой - корни.
+    """
+    Pharmacy = apps.get_model('kadr', 'Pharmacy')
+    parents = dict(Pharmacy.objects.values_list('id', 'main_pharmacy_id'))
+    paths = {}
+
+    def build(pharmacy_id, chain=()):
+        if pharmacy_id not in paths:
+            parent_id = parents.get(pharmacy_id)
+            if parent_id is None or parent_id not in parents or parent_id in chain:
+                paths[pharmacy_id] = f'/{pharmacy_id}/'
+            else:
+                paths[pharmacy_id] = f'{build(parent_id, chain + (pharmacy_id,))}{pharmacy_id}/'
+        return paths[pharmacy_id]
+
+    pharmacies = list(Pharmacy.objects.only('id', 'path'))
+    for pharmacy in pharmacies:
+        pharmacy.path = build(pharmacy.id)
+    Pharmacy.objects.bulk_update(pharmacies, ['path'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kadr', '0004_attendancerollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pharmacy',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255, verbose_name='Путь в иерархии'),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kadr', '0005_pharmacy_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttendanceMonth',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='Первое число месяца', verbose_name='Месяц')),
+                ('codes', models.CharField(max_length=31, verbose_name='Статусы по дням')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='kadr.userprofile')),
+            ],
+            options={
+                'verbose_name': 'Посещаемость за месяц',
+                'verbose_name_plural': 'Посещаемость за месяц',
+                'indexes': [models.Index(fields=['month', 'user'], name='kadr_attmonth_month_user_idx')],
+                'unique_together': {('user', 'month')},
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_pharmacies(apps, schema_editor):
+    """Старым записям - текущая аптека сотрудника (одним UPDATE на таблицу)"""
+    UserProfile = apps.get_model('kadr', 'UserProfile')
+    profile_pharmacy = Subquery(UserProfile.objects.filter(pk=OuterRef('user_id')).values('pharmacy_id')[:1])
+    for model_name in ('Attendance', 'AttendanceMonth'):
+        apps.get_model('kadr', model_name).objects.update(pharmacy_id=profile_pharmacy)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kadr', '0006_attendancemonth'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attendance',
+            name='pharmacy',
+            field=models.ForeignKey(blank=True, db_index=False, help_text='Аптека сотрудника на момент записи', null=True, on_delete=django.db.models.deletion.SET_NULL, to='kadr.pharmacy', verbose_name='Аптека'),
+        ),
+        migrations.AddField(
+            model_name='attendancemonth',
+            name='pharmacy',
+            field=models.ForeignKey(blank=True, db_index=False, help_text='Аптека сотрудника на момент первой записи месяца', null=True, on_delete=django.db.models.deletion.SET_NULL, to='kadr.pharmacy', verbose_name='Аптека'),
+        ),
+        migrations.RunPython(backfill_pharmacies, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='attendance',
+            index=models.Index(fields=['pharmacy', 'date'], name='kadr_att_pharmacy_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='attendance',
+            index=models.Index(fields=['date', 'status'], name='kadr_att_date_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='attendancemonth',
+            index=models.Index(fields=['pharmacy', 'month'], name='kadr_attmonth_pharmacy_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kadr', '0007_attendance_pharmacy'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('report', models.CharField(max_length=50, verbose_name='Отчет')),
+                ('params', models.JSONField(default=dict, verbose_name='Параметры')),
+                ('format', models.CharField(choices=[('html', 'HTML'), ('json', 'JSON'), ('csv', 'CSV')], max_length=10, verbose_name='Формат')),
+                ('data_key', models.CharField(help_text='Отпечаток отчета, параметров и версий данных его аптек', max_length=32, verbose_name='Ключ данных')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('done', 'Готов'), ('failed', 'Ошибка')], default='pending', max_length=10, verbose_name='Состояние')),
+                ('result', models.TextField(blank=True, verbose_name='Результат')),
+                ('content_type', models.CharField(blank=True, max_length=100, verbose_name='Тип содержимого')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начато')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершено')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Заказчик')),
+            ],
+            options={
+                'verbose_name': 'Фоновый отчет',
+                'verbose_name_plural': 'Фоновые отчеты',
+                'indexes': [models.Index(fields=['status', 'created_at'], name='kadr_reportjob_queue_idx'), models.Index(fields=['data_key', 'status'], name='kadr_reportjob_key_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,109 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:24
+
+from datetime import date
+
+import django.db.models.deletion
+from dateutil.easter import easter
+from django.conf import settings
+from django.db import migrations, models
+
+# Сводка пересобирается по аптекам записей. Логика зафиксирована здесь
+# на момент миграции: код приложения (kadr.rollup, kadr.storage, календарь
+# kadr.utils) может меняться вместе с моделями
+
+BATCH_SIZE = 2000
+# Коды статусов помесячного хранения (AttendanceMonth.codes): "0" - записи нет, "1" - статус не выбран
+MONTH_CODE_STATUSES = {'2': 'full', '3': 'half', '4': 'vacation', '5': 'sick'}
+
+
+def holidays(year):
+    """Праздники производственного календаря на момент миграции"""
+    days = {date(year, 1, day) for day in range(1, 9)}
+    days.update(date(year, month, day) for month, day in ((2, 23), (3, 8), (5, 1), (5, 9), (6, 12), (11, 4)))
+    days.add(easter(year))
+    return days
+
+
+def stored_statuses(apps):
+    """Заполненные статусы (id профиля, id аптеки записи, дата, статус) по сотрудникам"""
+    if getattr(settings, 'KADR_ATTENDANCE_STORAGE', 'daily') != 'monthly':
+        yield from apps.get_model('kadr', 'Attendance').objects.exclude(
+            status=''
+        ).order_by('user_id', 'date').values_list(
+            'user_id', 'pharmacy_id', 'date', 'status'
+        ).iterator(chunk_size=BATCH_SIZE)
+        return
+
+    rows = apps.get_model('kadr', 'AttendanceMonth').objects.order_by(
+        'user_id', 'month'
+    ).values_list('user_id', 'pharmacy_id', 'month', 'codes')
+    for user_id, pharmacy_id, month, codes in rows.iterator(chunk_size=BATCH_SIZE):
+        for index, code in enumerate(codes):
+            if code in MONTH_CODE_STATUSES:
+                yield user_id, pharmacy_id, month.replace(day=index + 1), MONTH_CODE_STATUSES[code]
+
+
+def rebuild_rollup(apps, schema_editor):
+    """Сводка по сотрудникам, аптекам записей, месяцам и статусам.
+
+    Строки читаются потоком по сотрудникам, и счетчики сотрудника
+    записываются, как только начинаются строки следующего.
+    """
+    AttendanceRollup = apps.get_model('kadr', 'AttendanceRollup')
+    AttendanceRollup.objects.all().delete()
+    holidays_by_year = {}
+    counters = {}
+    pending = []
+
+    def flush():
+        pending.extend(
+            AttendanceRollup(user_id=user_id, pharmacy_id=pharmacy_id, month=month, status=status,
+                             days_count=days_count, working_days_count=working_days_count)
+            for (user_id, pharmacy_id, month, status), (days_count, working_days_count) in counters.items()
+        )
+        counters.clear()
+        if len(pending) >= BATCH_SIZE:
+            AttendanceRollup.objects.bulk_create(pending)
+            pending.clear()
+
+    current_user_id = None
+    for user_id, pharmacy_id, day, status in stored_statuses(apps):
+        if user_id != current_user_id:
+            flush()
+            current_user_id = user_id
+        if day.year not in holidays_by_year:
+            holidays_by_year[day.year] = holidays(day.year)
+        counts = counters.setdefault((user_id, pharmacy_id, day.replace(day=1), status), [0, 0])
+        counts[0] += 1
+        if day.weekday() < 5 and day not in holidays_by_year[day.year]:
+            counts[1] += 1
+    flush()
+    AttendanceRollup.objects.bulk_create(pending)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kadr', '0008_reportjob'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='attendancerollup',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='attendancerollup',
+            name='pharmacy',
+            field=models.ForeignKey(blank=True, db_index=False, help_text='Аптека записей посещаемости', null=True, on_delete=django.db.models.deletion.SET_NULL, to='kadr.pharmacy', verbose_name='Аптека'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='attendancerollup',
+            unique_together={('user', 'pharmacy', 'month', 'status')},
+        ),
+        migrations.RunPython(rebuild_rollup, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='attendancerollup',
+            index=models.Index(fields=['month', 'pharmacy'], name='kadr_rollup_month_pharm_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kadr', '0009_attendancerollup_pharmacy'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pharmacy',
+            name='main_pharmacy',
+            field=models.ForeignKey(blank=True, help_text='Выберите аптеку, которой подчиняется этот филиал (на любом уровне сети)', null=True, on_delete=django.db.models.deletion.SET_NULL, to='kadr.pharmacy', verbose_name='Подчиняется аптеке'),
+        ),
+    ]
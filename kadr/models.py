@@ -17,8 +17,23 @@ class User(models.Model): # стандартная модель пользова
 
 
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
 from django.contrib.auth.models import User
 
+
+class ProfileCacheQuerySet(models.QuerySet):
+    """Массовое обновление аптек и профилей (update, bulk_update, действия админки)
+    не вызывает post_save, поэтому кэш профилей (kadr.profiles) сбрасывается здесь"""
+
+    def update(self, **kwargs):
+        rows = super().update(**kwargs)
+        if rows:
+            from .profiles import invalidate_all_profiles
+            invalidate_all_profiles()
+        return rows
+
+
 class Pharmacy(models.Model):
     name = models.CharField('Название аптеки', max_length=100)
     address = models.CharField('Адрес', max_length=200)
@@ -28,8 +43,12 @@ class Pharmacy(models.Model):
     main_pharmacy = models.ForeignKey('self', on_delete=models.SET_NULL,
                                      null=True, blank=True, 
                                      verbose_name='Подчиняется аптеке',
-                                     limit_choices_to={'is_main': True},
-                                     help_text='Выберите главную аптеку, если эта аптека является филиалом')
+                                     help_text='Выберите аптеку, которой подчиняется этот филиал (на любом уровне сети)')
+    # Материализованный путь от корня сети: "/1/5/12/". Поддерево аптеки - все пути
+    # с ее префиксом, поэтому выбирается одним диапазонным запросом по индексу
+    path = models.CharField('Путь в иерархии', max_length=255, blank=True, editable=False, db_index=True)
+    
+    objects = ProfileCacheQuerySet.as_manager()
     
     class Meta:
         verbose_name = 'Аптека'
@@ -54,6 +73,38 @@ class Pharmacy(models.Model):
             raise ValidationError({
                 'main_pharmacy': 'Аптека не может подчиняться самой себе'
             })
+        
+        # Подчиняться можно любой аптеке, кроме своих филиалов на любой глубине
+        # (иначе в иерархии появится цикл)
+        if self.pk and self.main_pharmacy and f'/{self.pk}/' in self.main_pharmacy.path:
+            raise ValidationError({
+                'main_pharmacy': 'Аптека не может подчиняться своему филиалу'
+            })
+    
+    def save(self, *args, **kwargs):
+        parent_path = '/'
+        if self.main_pharmacy_id:
+            parent_path = Pharmacy.objects.filter(
+                pk=self.main_pharmacy_id
+            ).values_list('path', flat=True).first() or '/'
+            if self.pk and f'/{self.pk}/' in parent_path:
+                raise ValueError('Аптека не может подчиняться своему филиалу')
+        
+        super().save(*args, **kwargs)
+        
+        # Путь зависит от id, поэтому пересчитывается после сохранения
+        new_path = f'{parent_path}{self.pk}/'
+        if new_path != self.path:
+            old_path = self.path
+            Pharmacy.objects.filter(pk=self.pk).update(path=new_path)
+            if old_path:
+                # Переносим все поддерево: заменяем старый префикс путей новым
+                Pharmacy.objects.filter(
+                    path__gt=old_path, path__lt=old_path[:-1] + '0'
+                ).update(
+                    path=Concat(Value(new_path), Substr('path', len(old_path) + 1))
+                )
+            self.path = new_path
 
 class UserProfile(models.Model):
     # Валидатор для русских букв в ФИО
@@ -100,6 +151,8 @@ class UserProfile(models.Model):
         help_text='Отметьте, если пользователь является руководителем'
     )
     
+    objects = ProfileCacheQuerySet.as_manager()
+    
     class Meta:
         verbose_name = 'Профиль пользователя'
         verbose_name_plural = 'Профили пользователей'
@@ -135,6 +188,17 @@ ATTENDANCE_CHOICES = [
 
 class Attendance(models.Model):
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
+    # Аптека сотрудника на момент создания записи: отчеты аптек отбирают дни
+    # по ней без соединения с профилями, а перевод сотрудника не переносит его прошлые дни
+    pharmacy = models.ForeignKey(
+        Pharmacy,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        db_index=False,  # покрывается индексом (pharmacy, date)
+        verbose_name='Аптека',
+        help_text='Аптека сотрудника на момент записи'
+    )
     date = models.DateField('Дата')
     status = models.CharField('Статус', max_length=10, choices=ATTENDANCE_CHOICES, blank=True)  # Разрешаем пустое значение
     created_at = models.DateTimeField('Создано', auto_now_add=True)
@@ -144,12 +208,144 @@ class Attendance(models.Model):
         verbose_name = 'Посещаемость'
         verbose_name_plural = 'Посещаемость'
         unique_together = ['user', 'date']
+        indexes = [
+            # Табели аптек за период
+            models.Index(fields=['pharmacy', 'date'], name='kadr_att_pharmacy_date_idx'),
+            # Счетчики статусов по сети за неполные месяцы
+            models.Index(fields=['date', 'status'], name='kadr_att_date_status_idx'),
+        ]
+    
+    def save(self, *args, **kwargs):
+        if self.pharmacy_id is None and self.user_id is not None:
+            self.pharmacy_id = self.user.pharmacy_id
+        super().save(*args, **kwargs)
     
     def __str__(self):
         if self.status:
             return f"{self.user} - {self.date} - {self.get_status_display()}"
         return f"{self.user} - {self.date} - Не указано"
 
+class AttendanceRollup(models.Model):
+    """Помесячная сводка посещаемости сотрудника по статусам.
+
+    Поддерживается при каждой записи посещаемости (см. kadr.rollup) и
+    пересобирается командой rebuild_attendance_rollup. Дни считаются
+    по аптеке записи: у переведенного в течение месяца сотрудника
+    по строке на каждую аптеку.
+    """
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
+    pharmacy = models.ForeignKey(
+        Pharmacy,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        db_index=False,  # покрывается индексом (month, pharmacy)
+        verbose_name='Аптека',
+        help_text='Аптека записей посещаемости'
+    )
+    month = models.DateField('Месяц', help_text='Первое число месяца')
+    status = models.CharField('Статус', max_length=10, choices=ATTENDANCE_CHOICES)
+    days_count = models.PositiveIntegerField('Всего дней', default=0)
+    working_days_count = models.PositiveIntegerField('Рабочих дней', default=0)
+    
+    class Meta:
+        verbose_name = 'Сводка посещаемости за месяц'
+        verbose_name_plural = 'Сводки посещаемости за месяц'
+        unique_together = ['user', 'pharmacy', 'month', 'status']
+        indexes = [
+            models.Index(fields=['month', 'user'], name='kadr_rollup_month_user_idx'),
+            # Счетчики статусов по аптекам сети
+            models.Index(fields=['month', 'pharmacy'], name='kadr_rollup_month_pharm_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user} - {self.month:%m.%Y} - {self.get_status_display()}: {self.working_days_count}"
+
+class AttendanceMonth(models.Model):
+    """Посещаемость сотрудника за месяц одной строкой.
+
+    Используется при KADR_ATTENDANCE_STORAGE = 'monthly' (см. kadr.storage):
+    codes - строка фиксированной длины, по цифре-коду статуса на каждый
+    день месяца ("0" - записи нет).
+    """
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
+    # Как Attendance.pharmacy, но с точностью до месяца: аптека при первой записи месяца
+    pharmacy = models.ForeignKey(
+        Pharmacy,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        db_index=False,  # покрывается индексом (pharmacy, month)
+        verbose_name='Аптека',
+        help_text='Аптека сотрудника на момент первой записи месяца'
+    )
+    month = models.DateField('Месяц', help_text='Первое число месяца')
+    codes = models.CharField('Статусы по дням', max_length=31)
+    updated_at = models.DateTimeField('Обновлено', auto_now=True)
+    
+    class Meta:
+        verbose_name = 'Посещаемость за месяц'
+        verbose_name_plural = 'Посещаемость за месяц'
+        unique_together = ['user', 'month']
+        indexes = [
+            models.Index(fields=['month', 'user'], name='kadr_attmonth_month_user_idx'),
+            models.Index(fields=['pharmacy', 'month'], name='kadr_attmonth_pharmacy_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user} - {self.month:%m.%Y}"
+
+class ReportJob(models.Model):
+    """Отчет, построенный в фоне командой run_report_jobs (см. kadr.jobs).
+
+    Готовый результат хранится в строке и выдается повторно тем же
+    запросам заказчика, пока не изменятся данные аптек отчета (data_key).
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Готов'),
+        (FAILED, 'Ошибка'),
+    ]
+    FORMAT_CHOICES = [
+        ('html', 'HTML'),
+        ('json', 'JSON'),
+        ('csv', 'CSV'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='Заказчик')
+    report = models.CharField('Отчет', max_length=50)
+    params = models.JSONField('Параметры', default=dict)
+    format = models.CharField('Формат', max_length=10, choices=FORMAT_CHOICES)
+    data_key = models.CharField(
+        'Ключ данных',
+        max_length=32,
+        help_text='Отпечаток отчета, параметров и версий данных его аптек'
+    )
+    status = models.CharField('Состояние', max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    result = models.TextField('Результат', blank=True)
+    content_type = models.CharField('Тип содержимого', max_length=100, blank=True)
+    error = models.TextField('Ошибка', blank=True)
+    created_at = models.DateTimeField('Создано', auto_now_add=True)
+    started_at = models.DateTimeField('Начато', null=True, blank=True)
+    finished_at = models.DateTimeField('Завершено', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Фоновый отчет'
+        verbose_name_plural = 'Фоновые отчеты'
+        indexes = [
+            # Очередь обработчика и поиск готового результата
+            models.Index(fields=['status', 'created_at'], name='kadr_reportjob_queue_idx'),
+            models.Index(fields=['data_key', 'status'], name='kadr_reportjob_key_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.report} #{self.pk} - {self.get_status_display()}"
+
 class Leadership(models.Model): # рабочая модель руководители
     # Валидатор для русских букв в ФИО
     russian_letters_validator = RegexValidator(
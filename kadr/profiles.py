@@ -0,0 +1,129 @@
+import uuid
+from bisect import bisect_left, bisect_right
+
+from django.db import transaction
+from django.urls import reverse
+from .fragment_cache import get_cache, get_state_cache
+from .hierarchy import get_employees_under, get_pharmacies_under
+from .models import Pharmacy, UserProfile
+
+# Профиль пользователя вместе с аптекой и списком ее филиалов хранится в общем
+# кэше: ключ включает поколение справочника аптек, которое меняется при любом
+# изменении аптеки, а запись пользователя удаляется при изменении его профиля.
+# Поколение хранится вместе с версиями аптек (KADR_STATE_CACHE), где записи
+# не вытесняются.
+
+GENERATION_KEY = 'kadr:profile_generation'
+PROFILE_TIMEOUT = 24 * 3600
+
+# Отметка "профиля нет", чтобы не ходить в базу за отсутствующим профилем
+NO_PROFILE = 'none'
+
+
+def _generation():
+    cache = get_state_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(GENERATION_KEY, generation, timeout=None):
+            generation = cache.get(GENERATION_KEY, generation)
+    return generation
+
+
+def _profile_key(user_id, generation=None):
+    return f'kadr:profile:{generation or _generation()}:{user_id}'
+
+
+def load_profile(user):
+    """Профиль пользователя с аптекой и филиалами (profile.branch_pharmacies) или None"""
+    cache = get_cache()
+    key = _profile_key(user.pk)
+    profile = cache.get(key)
+
+    if profile is None:
+        profile = UserProfile.objects.select_related('pharmacy').filter(user_id=user.pk).first()
+        if profile is not None:
+            # Филиалы аптеки профиля на любой глубине (для профиля без аптеки -
+            # как и раньше, аптеки верхнего уровня)
+            if profile.pharmacy:
+                branches = get_pharmacies_under(profile.pharmacy, include_self=False)
+            else:
+                branches = Pharmacy.objects.filter(main_pharmacy=None)
+            profile.branch_pharmacies = list(branches.order_by('id'))
+        cache.set(key, profile if profile is not None else NO_PROFILE, timeout=PROFILE_TIMEOUT)
+    elif profile == NO_PROFILE:
+        profile = None
+
+    if profile is not None:
+        # Связываем профиль с уже загруженным пользователем в обе стороны,
+        # чтобы user.userprofile в шаблонах не делал запросов
+        user.userprofile = profile
+    return profile
+
+
+def prime_profiles(profiles):
+    """Кладет в кэш профили с филиалами так же, как их собирает load_profile.
+
+    profiles - профили с select_related('pharmacy'). Аптеки читаются одним
+    запросом, филиалы каждой аптеки выбираются из него по тому же диапазону
+    путей, что и subtree_q. Возвращает число профилей в кэше.
+    """
+    pharmacies = sorted(Pharmacy.objects.all(), key=lambda pharmacy: pharmacy.path)
+    paths = [pharmacy.path for pharmacy in pharmacies]
+    roots = sorted((pharmacy for pharmacy in pharmacies if pharmacy.main_pharmacy_id is None), key=lambda pharmacy: pharmacy.id)
+    branches = {}
+    generation = _generation()
+    entries = {}
+    for profile in profiles:
+        if profile.pharmacy:
+            path = profile.pharmacy.path
+            if path not in branches:
+                subtree = pharmacies[bisect_right(paths, path):bisect_left(paths, path[:-1] + '0')]
+                branches[path] = sorted(subtree, key=lambda pharmacy: pharmacy.id)
+            profile.branch_pharmacies = branches[path]
+        else:
+            profile.branch_pharmacies = roots
+        entries[_profile_key(profile.user_id, generation)] = profile
+    get_cache().set_many(entries, timeout=PROFILE_TIMEOUT)
+    return len(entries)
+
+
+def get_request_profile(request):
+    """Профиль текущего пользователя (request.kadr_profile).
+
+    Как и UserProfile.objects.get, при отсутствии профиля бросает
+    UserProfile.DoesNotExist.
+    """
+    if not hasattr(request, 'kadr_profile'):
+        request.kadr_profile = load_profile(request.user) if request.user.is_authenticated else None
+    if request.kadr_profile is None:
+        raise UserProfile.DoesNotExist('Профиль пользователя не найден')
+    return request.kadr_profile
+
+
+def get_scope_employees(profile):
+    """Сотрудники аптеки профиля и всех ее филиалов (одним запросом по иерархии)"""
+    if profile.pharmacy:
+        return get_employees_under(profile.pharmacy)
+    return UserProfile.objects.filter(pharmacy__in=profile.branch_pharmacies)
+
+
+def invalidate_profile(user_id):
+    """Сбрасывает кэш профиля пользователя после фиксации транзакции"""
+    transaction.on_commit(lambda: get_cache().delete(_profile_key(user_id)))
+
+
+def invalidate_all_profiles():
+    """Сбрасывает кэш всех профилей (изменился справочник аптек)"""
+    transaction.on_commit(lambda: get_state_cache().set(GENERATION_KEY, uuid.uuid4().hex, timeout=None))
+
+
+def role_redirect_url(profile):
+    """Стартовая страница пользователя по роли"""
+    if profile is None:
+        return reverse('access_denied')
+    if profile.is_manager:
+        return reverse('manager_dashboard')
+    if profile.is_leader:
+        return reverse('leader_statistics')
+    return reverse('statistics_employee')
@@ -0,0 +1,93 @@
+from .reports import FILLED_STATUSES
+from .storage import STATUS_CODES, encode_digits
+from .timesheet import MONTH_NAMES, TimesheetMatrix, month_bounds, month_day_types, period_day_types
+
+# Компактный формат AJAX-ответов (format=data) для отрисовки отчетов на клиенте.
+#
+# Табель передается строками по одному символу на день: для каждого месяца -
+# общая маска календаря (флаги выходного/праздника, "0" - рабочий день)
+# и по строке кодов статусов на сотрудника (коды storage.STATUS_CODES).
+# Статистика передается таблицей: счетчики статусов идут в порядке "statuses".
+
+DATA_FORMAT = 'data'
+
+
+def wants_data(request):
+    """Запрошен ли компактный формат вместо готового HTML"""
+    return (request.GET.get('format') or request.POST.get('format')) == DATA_FORMAT
+
+
+def timesheet_data(pharmacy, year, months, period=None, matrix=None):
+    """Табель аптеки за месяцы года в компактном формате.
+
+    period - подпись единственного месяца (по умолчанию "Месяц год"),
+    matrix - уже загруженный TimesheetMatrix за эти месяцы, общий для нескольких аптек.
+    """
+    first_day = month_bounds(year, months[0])[0]
+    last_day = month_bounds(year, months[-1])[1]
+    if matrix is None:
+        matrix = TimesheetMatrix([pharmacy], first_day, last_day)
+    employees = matrix.get_employees(pharmacy)
+
+    month_data = []
+    for month in months:
+        month_first_day, month_last_day = month_bounds(year, month)
+        start = (month_first_day - first_day).days
+        end = start + month_last_day.day
+        month_data.append({
+            'month': month,
+            'title': period if period and len(months) == 1 else f'{MONTH_NAMES[month]} {year}',
+            'mask': encode_digits(month_day_types(year, month)),
+            'codes': [encode_digits(matrix.employee_codes(pharmacy, employee)[start:end]) for employee in employees],
+        })
+
+    return {
+        'pharmacy': {
+            'id': pharmacy.id,
+            'name': pharmacy.name,
+            'is_main': pharmacy.main_pharmacy_id is None,
+        },
+        'status_codes': STATUS_CODES,
+        'employees': [[employee.full_name, employee.is_manager] for employee in employees],
+        'months': month_data,
+    }
+
+
+def period_mask(start_date, end_date):
+    """Маска календаря за произвольный период (по символу на день)"""
+    return encode_digits(period_day_types(start_date, end_date))
+
+
+def status_row(status_counts):
+    """Счетчики статусов в порядке FILLED_STATUSES"""
+    return [status_counts.get(status, 0) for status in FILLED_STATUSES]
+
+
+def employee_stats_data(employee_stats):
+    """Строки статистики сотрудников: [ФИО, заведующий, счетчики статусов...]"""
+    return [
+        [stat['employee'].full_name, stat['employee'].is_manager] + status_row(stat['status_counts'])
+        for stat in employee_stats
+    ]
+
+
+def network_stats_data(network_stats):
+    """Строки сводки сети: [id аптеки, название, глубина, сотрудников, счетчики статусов...]"""
+    return [
+        [stat['pharmacy'].id, stat['pharmacy'].name, stat['depth'], stat['total_employees']]
+        + status_row(stat['status_counts'])
+        for stat in network_stats
+    ]
+
+
+def statistics_data(total_working_days, **tables):
+    """Ответ статистики в компактном формате.
+
+    Пропущенные дни и проценты явки клиент считает сам по числу
+    рабочих дней и счетчикам статусов.
+    """
+    return dict(
+        {'success': True, 'format': DATA_FORMAT, 'statuses': FILLED_STATUSES,
+         'total_working_days': total_working_days},
+        **tables
+    )
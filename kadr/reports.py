@@ -0,0 +1,255 @@
+from datetime import timedelta
+from django.db.models import Count, Q, Sum
+from .aggregation import count_working_codes
+from .models import Attendance, AttendanceRollup, UserProfile, ATTENDANCE_CHOICES
+from .storage import is_monthly, read_codes
+from .timesheet import group_employees_by_pharmacy, period_day_types
+from .utils import get_holiday_dates
+
+# Заполненные статусы посещаемости (без пустого выбора)
+FILLED_STATUSES = [choice[0] for choice in ATTENDANCE_CHOICES if choice[0]]
+
+
+def empty_status_counts():
+    """Словарь счетчиков по всем статусам, включая пустой"""
+    return {choice[0]: 0 for choice in ATTENDANCE_CHOICES}
+
+
+def split_by_full_months(start_date, end_date):
+    """Делит период на полные месяцы и неполные края.
+
+    Возвращает (первый полный месяц, последний полный месяц, неполные диапазоны);
+    если полных месяцев нет, оба месяца равны None.
+    """
+    first_full = start_date if start_date.day == 1 else (start_date.replace(day=28) + timedelta(days=4)).replace(day=1)
+    next_day = end_date + timedelta(days=1)
+    last_full_end = end_date if next_day.day == 1 else end_date.replace(day=1) - timedelta(days=1)
+
+    if first_full > last_full_end:
+        return None, None, [(start_date, end_date)]
+
+    edges = []
+    if start_date < first_full:
+        edges.append((start_date, first_full - timedelta(days=1)))
+    if end_date > last_full_end:
+        edges.append((last_full_end + timedelta(days=1), end_date))
+    return first_full, last_full_end.replace(day=1), edges
+
+
+def filter_working_days(queryset, ranges):
+    """Ограничивает выборку посещаемости рабочими днями указанных диапазонов"""
+    date_filter = Q()
+    holiday_dates = []
+    for start_date, end_date in ranges:
+        date_filter |= Q(date__range=[start_date, end_date])
+        holiday_dates.extend(get_holiday_dates(start_date, end_date))
+
+    return queryset.filter(
+        date_filter
+    ).exclude(
+        date__week_day__in=[1, 7]  # 1 = воскресенье, 7 = суббота
+    ).exclude(
+        date__in=holiday_dates
+    )
+
+
+def group_key(row, group_by):
+    """Значение группировки строки values(): поле или кортеж полей"""
+    if isinstance(group_by, tuple):
+        return tuple(row[field] for field in group_by)
+    return row[group_by]
+
+
+def count_stored_statuses(ranges, group_by, **filters):
+    """Счетчики статусов за рабочие дни диапазонов при помесячном хранении.
+
+    Строки месяцев не разбираются в SQL, поэтому коды читаются через
+    kadr.storage и считаются в памяти (kadr.aggregation). Формат - как
+    у get_grouped_status_counts.
+    """
+    counts = {}
+    for start_date, end_date in ranges:
+        # Ключи кодов - id профиля или пары (id аптеки записи, id профиля)
+        codes = read_codes(start_date, end_date, by_pharmacy=group_by != 'user_id', **filters)
+        groups = None
+        if group_by == 'pharmacy_id':
+            groups = {key: key[0] for key in codes}
+
+        range_counts = count_working_codes(codes, period_day_types(start_date, end_date), groups)
+        for group, group_counts in range_counts.items():
+            total_counts = counts.setdefault(group, dict.fromkeys(FILLED_STATUSES, 0))
+            for status, count in group_counts.items():
+                total_counts[status] += count
+    return counts
+
+
+def get_grouped_status_counts(start_date, end_date, group_by, **filters):
+    """Считает статусы посещаемости за рабочие дни периода с группировкой.
+
+    group_by - поле посещаемости, по которому группируются счетчики:
+    'user_id', 'pharmacy_id' (аптека записи) или ('pharmacy_id', 'user_id');
+    filters - условия отбора, общие для посещаемости и сводки
+    (user__in=..., pharmacy__in=...). Полные месяцы периода берутся из помесячной
+    сводки (AttendanceRollup), неполные края - одним групповым запросом
+    по посещаемости (при помесячном хранении - см. count_stored_statuses). Возвращает словарь {значение group_by: {статус: количество}}
+    только для групп, у которых есть заполненные записи.
+    """
+    first_month, last_month, edges = split_by_full_months(start_date, end_date)
+    fields = group_by if isinstance(group_by, tuple) else (group_by,)
+    counts = {}
+
+    if edges and is_monthly():
+        counts = count_stored_statuses(edges, group_by, **filters)
+    elif edges:
+        annotations = {
+            status: Count('id', filter=Q(status=status))
+            for status in FILLED_STATUSES
+        }
+        rows = filter_working_days(
+            Attendance.objects.filter(status__in=FILLED_STATUSES, **filters),
+            edges
+        ).values(*fields).annotate(**annotations).order_by()
+
+        for row in rows:
+            counts[group_key(row, group_by)] = {status: row[status] for status in FILLED_STATUSES}
+
+    if first_month:
+        rollup_rows = AttendanceRollup.objects.filter(
+            month__range=[first_month, last_month],
+            **filters
+        ).values(*fields, 'status').annotate(total=Sum('working_days_count')).order_by()
+
+        for row in rollup_rows:
+            group_counts = counts.setdefault(group_key(row, group_by), dict.fromkeys(FILLED_STATUSES, 0))
+            group_counts[row['status']] += row['total']
+
+    return counts
+
+
+def get_status_counts(employees, start_date, end_date):
+    """Статусы посещаемости сотрудников за рабочие дни периода во всех аптеках.
+
+    Для личной статистики сотрудника: его дни считаются вместе с днями,
+    отработанными до перевода. Отчеты по аптекам считают дни по аптеке
+    записи (get_pharmacy_employee_status_counts). Возвращает словарь
+    {id профиля: {статус: количество}} только для сотрудников,
+    у которых есть заполненные записи.
+    """
+    return get_grouped_status_counts(start_date, end_date, 'user_id', user__in=employees)
+
+
+def get_pharmacy_status_counts(start_date, end_date):
+    """Статусы посещаемости по аптекам сети за рабочие дни периода.
+
+    Счетчики группируются по аптеке записи в самой базе, поэтому
+    число запросов не зависит ни от числа аптек, ни от числа сотрудников,
+    а дни переведенного сотрудника остаются в аптеке, где он работал.
+    Возвращает словарь {id аптеки: {статус: количество}}.
+    """
+    return get_grouped_status_counts(start_date, end_date, 'pharmacy_id', pharmacy__isnull=False)
+
+
+def get_pharmacy_employee_status_counts(pharmacy_ids, start_date, end_date):
+    """Статусы посещаемости сотрудников в аптеках за рабочие дни периода.
+
+    Дни считаются по аптеке записи. Возвращает словарь
+    {(id аптеки, id профиля): {статус: количество}}.
+    """
+    return get_grouped_status_counts(start_date, end_date, ('pharmacy_id', 'user_id'), pharmacy__in=pharmacy_ids)
+
+
+def empty_statistics_totals(working_days_count):
+    """Итог статистики аптеки или сети до подсчета"""
+    return {
+        'total_employees': 0,
+        'total_days': working_days_count,
+        'status_counts': dict.fromkeys(FILLED_STATUSES, 0),
+        'attendance_percentage': 0
+    }
+
+
+def collect_employee_statistics(pharmacy_ids, start_date, end_date, working_days_count):
+    """Статистика сотрудников аптек за период: (строки сотрудников, итог аптек).
+
+    Дни считаются по аптеке записи одним вызовом get_pharmacy_employee_status_counts:
+    переведенный сотрудник получает строку в каждой аптеке, где у него есть дни,
+    и старые дни остаются в прежней аптеке. Строки идут по аптекам в порядке
+    pharmacy_ids.
+    """
+    totals = empty_statistics_totals(working_days_count)
+    status_counts_by_key = get_pharmacy_employee_status_counts(pharmacy_ids, start_date, end_date)
+    employees_by_pharmacy = group_employees_by_pharmacy(pharmacy_ids, status_counts_by_key)
+
+    employee_stats = []
+    employee_ids = set()
+    total_attendances = 0
+    for pharmacy_id in pharmacy_ids:
+        for employee in employees_by_pharmacy.get(pharmacy_id, []):
+            employee_ids.add(employee.id)
+            status_counts = dict.fromkeys(FILLED_STATUSES, 0)
+            status_counts.update(status_counts_by_key.get((pharmacy_id, employee.id), {}))
+            for status, count in status_counts.items():
+                totals['status_counts'][status] += count
+            filled_working_days = sum(status_counts.values())
+            total_attendances += filled_working_days
+
+            employee_stats.append({
+                'employee': employee,
+                'pharmacy_id': pharmacy_id,
+                'status_counts': status_counts,
+                'total_days': working_days_count,
+                'missing_days': working_days_count - filled_working_days,
+                'attendance_count': filled_working_days,
+                'attendance_percentage': (filled_working_days / working_days_count * 100) if working_days_count > 0 else 0
+            })
+
+    totals['total_employees'] = len(employee_ids)
+    total_possible_days = len(employee_stats) * working_days_count
+    if total_possible_days > 0:
+        totals['attendance_percentage'] = total_attendances / total_possible_days * 100
+    return employee_stats, totals
+
+
+def count_network_employees():
+    """Число сотрудников по аптекам сети: {id аптеки: сотрудников} одним групповым запросом"""
+    return dict(
+        UserProfile.objects.filter(pharmacy__isnull=False).values_list('pharmacy_id').annotate(
+            total=Count('id')
+        ).order_by()
+    )
+
+
+def collect_network_statistics(pharmacies, employee_counts, start_date, end_date, working_days_count):
+    """Сводка по аптекам сети за период: (строки аптек, итог сети).
+
+    employee_counts - результат count_network_employees; статусы сгруппированы
+    по аптекам записей в самой базе (get_pharmacy_status_counts).
+    """
+    totals = empty_statistics_totals(working_days_count)
+    status_counts_by_pharmacy = get_pharmacy_status_counts(start_date, end_date)
+
+    network_stats = []
+    for pharmacy in pharmacies:
+        total_employees = employee_counts.get(pharmacy.id, 0)
+        status_counts = dict.fromkeys(FILLED_STATUSES, 0)
+        status_counts.update(status_counts_by_pharmacy.get(pharmacy.id, {}))
+        for status, count in status_counts.items():
+            totals['status_counts'][status] += count
+        totals['total_employees'] += total_employees
+
+        filled_working_days = sum(status_counts.values())
+        possible_days = total_employees * working_days_count
+        network_stats.append({
+            'pharmacy': pharmacy,
+            'depth': pharmacy.path.count('/') - 2,
+            'total_employees': total_employees,
+            'status_counts': status_counts,
+            'attendance_count': filled_working_days,
+            'missing_days': possible_days - filled_working_days,
+            'attendance_percentage': (filled_working_days / possible_days * 100) if possible_days > 0 else 0
+        })
+
+    total_possible_days = totals['total_employees'] * working_days_count
+    if total_possible_days > 0:
+        totals['attendance_percentage'] = sum(totals['status_counts'].values()) / total_possible_days * 100
+    return network_stats, totals
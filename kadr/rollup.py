@@ -0,0 +1,88 @@
+from collections import defaultdict
+from django.db import transaction
+from .aggregation import count_monthly_rows
+from .models import AttendanceRollup
+from .storage import codes_to_statuses, iter_statuses, month_start, read_codes
+from .timesheet import month_bounds
+
+
+def build_rollup_objects(counters, pharmacy_id):
+    return [
+        AttendanceRollup(
+            user_id=user_id,
+            pharmacy_id=pharmacy_id,
+            month=month,
+            status=status,
+            days_count=days_count,
+            working_days_count=working_days_count
+        )
+        for (user_id, month, status), (days_count, working_days_count) in counters.items()
+    ]
+
+
+def count_rollup(rows):
+    """Строки (id профиля, id аптеки записи, дата, статус) -> строки сводки по аптекам записей"""
+    rows_by_pharmacy = defaultdict(list)
+    for user_id, pharmacy_id, attendance_date, status in rows:
+        rows_by_pharmacy[pharmacy_id].append((user_id, attendance_date, status))
+
+    objects = []
+    for pharmacy_id, pharmacy_rows in rows_by_pharmacy.items():
+        objects.extend(build_rollup_objects(count_monthly_rows(pharmacy_rows), pharmacy_id))
+    return objects
+
+
+def refresh_attendance_rollup(keys):
+    """Пересчитывает сводку для затронутых пар (id профиля, дата).
+
+    Вызывается сразу после записи посещаемости: месяц каждого затронутого
+    сотрудника пересчитывается из хранимых статусов в одной транзакции с записью.
+    """
+    users_by_month = defaultdict(set)
+    for user_id, attendance_date in keys:
+        users_by_month[month_start(attendance_date)].add(user_id)
+
+    with transaction.atomic():
+        for month, user_ids in users_by_month.items():
+            first_day, last_day = month_bounds(month.year, month.month)
+            codes = read_codes(first_day, last_day, by_pharmacy=True, user_id__in=user_ids)
+            rows = (
+                (user_id, pharmacy_id, attendance_date, status)
+                for (pharmacy_id, user_id), attendance_date, status in codes_to_statuses(codes, first_day)
+            )
+
+            AttendanceRollup.objects.filter(user_id__in=user_ids, month=month).delete()
+            AttendanceRollup.objects.bulk_create(count_rollup(rows))
+
+
+def rebuild_attendance_rollup(batch_size=2000):
+    """Полностью пересобирает сводку из хранимой посещаемости.
+
+    Строки читаются потоком, отсортированными по сотруднику, и считаются
+    порциями по целым сотрудникам (не меньше batch_size строк), поэтому
+    в памяти держится одна порция. Возвращает число строк сводки.
+    """
+    created = 0
+    with transaction.atomic():
+        AttendanceRollup.objects.all().delete()
+        rows = iter_statuses(batch_size)
+
+        pending = []
+        chunk_rows = []
+        current_user_id = None
+        for row in rows:
+            if row[0] != current_user_id and len(chunk_rows) >= batch_size:
+                pending.extend(count_rollup(chunk_rows))
+                chunk_rows = []
+            current_user_id = row[0]
+            chunk_rows.append(row)
+
+            if len(pending) >= batch_size:
+                AttendanceRollup.objects.bulk_create(pending)
+                created += len(pending)
+                pending = []
+
+        pending.extend(count_rollup(chunk_rows))
+        AttendanceRollup.objects.bulk_create(pending)
+        created += len(pending)
+    return created
@@ -0,0 +1,71 @@
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .fragment_cache import bump_pharmacy_versions, release_build_locks
+from .hierarchy import rebuild_pharmacy_paths
+from .models import Pharmacy, UserProfile
+from .profiles import invalidate_all_profiles, invalidate_profile
+
+# Изменения посещаемости сбрасывают кэш явно (kadr.attendance.attendance_changed):
+# обработчик удаления на Attendance заставил бы Django загружать каждую
+# удаляемую запись вместо одного DELETE.
+
+
+@receiver(pre_save, sender=UserProfile)
+def remember_profile_pharmacy(sender, instance, **kwargs):
+    """Запоминает прежнюю аптеку сотрудника, чтобы при переводе сбросить кэш обеих"""
+    instance._previous_pharmacy_id = None
+    if instance.pk:
+        instance._previous_pharmacy_id = UserProfile.objects.filter(
+            pk=instance.pk
+        ).values_list('pharmacy_id', flat=True).first()
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def profile_changed(sender, instance, **kwargs):
+    bump_pharmacy_versions([instance.pharmacy_id, getattr(instance, '_previous_pharmacy_id', None)])
+    invalidate_profile(instance.user_id)
+
+
+@receiver(post_save, sender=Pharmacy)
+@receiver(post_delete, sender=Pharmacy)
+def pharmacy_changed(sender, instance, **kwargs):
+    bump_pharmacy_versions([instance.pk])
+    # Аптека профиля и списки филиалов хранятся в кэше профилей
+    invalidate_all_profiles()
+
+
+@receiver(post_delete, sender=Pharmacy)
+def pharmacy_deleted(sender, instance, **kwargs):
+    """Филиалы удаленной аптеки становятся корнями (SET_NULL) - пересчитываем их пути"""
+    rebuild_pharmacy_paths()
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """Настройки SQLite для параллельной работы: WAL, ожидание блокировки, synchronous=NORMAL"""
+    if connection.vendor != 'sqlite':
+        return
+    # Режим WAL записывается в сам файл базы, поэтому включается только для
+    # рабочей базы (не для других подключений и не в тестах, см. kadr.test_runner)
+    use_wal = (
+        getattr(settings, 'KADR_SQLITE_WAL', True)
+        and connection.alias == DEFAULT_DB_ALIAS
+        and not connection.creation.is_in_memory_db(connection.settings_dict['NAME'])
+    )
+    with connection.cursor() as cursor:
+        if use_wal:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            # В режиме WAL NORMAL не теряет целостность, но не ждет fsync на каждой фиксации
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(getattr(settings, "KADR_SQLITE_BUSY_TIMEOUT_MS", 5000))}')
+
+
+@receiver(request_finished)
+def release_fragment_locks(sender, **kwargs):
+    """Снимает блокировки построения отчетов, не снятые сохранением фрагмента (ошибка в отчете)"""
+    release_build_locks()
@@ -0,0 +1,319 @@
+from calendar import monthrange
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from .models import Attendance, AttendanceMonth, UserProfile
+
+# Хранение посещаемости.
+#
+# KADR_ATTENDANCE_STORAGE = 'daily' (по умолчанию) - строка Attendance
+# на сотрудника и день. 'monthly' - строка AttendanceMonth на сотрудника
+# и месяц: статусы дней упакованы в строку цифр фиксированной длины,
+# поэтому табель за год читается 12 строками на сотрудника вместо 365,
+# а таблица и ее индексы в разы меньше. Время записи по дням в этом
+# режиме не хранится.
+#
+# Отчеты и записи обращаются к посещаемости через функции этого модуля;
+# данные между режимами переносит команда convert_attendance_storage.
+# В обоих режимах строка хранит аптеку сотрудника на момент записи (pharmacy):
+# табели аптек отбирают дни по ней.
+
+DAILY = 'daily'
+MONTHLY = 'monthly'
+STORAGE_MODES = (DAILY, MONTHLY)
+
+# Коды статусов (один байт на сотрудника и день) - общие для матрицы табеля,
+# компактного формата отчетов и помесячного хранения
+CODE_NONE = 0   # записи нет
+CODE_BLANK = 1  # запись есть, статус не выбран
+STATUS_CODES = {
+    '': CODE_BLANK,
+    'full': 2,
+    'half': 3,
+    'vacation': 4,
+    'sick': 5,
+}
+CODE_STATUSES = {code: status for status, code in STATUS_CODES.items()}
+CODE_STATUSES[CODE_NONE] = None
+
+# Коды меньше 10 - хранятся и передаются одной цифрой
+DIGITS = bytes.maketrans(bytes(range(10)), b'0123456789')
+UNDIGITS = bytes.maketrans(b'0123456789', bytes(range(10)))
+
+MONTH_WIDTH = 31
+EMPTY_MONTH = '0' * MONTH_WIDTH
+
+# Строки посещаемости читаются из курсора порциями и не копятся в кэше
+# запроса: в памяти остаются только коды, по байту на сотрудника и день
+READ_CHUNK_SIZE = 2000
+
+
+def encode_digits(values):
+    """bytes/bytearray с кодами 0-9 -> строка цифр"""
+    return bytes(values).translate(DIGITS).decode('ascii')
+
+
+def decode_digits(text):
+    """Строка цифр -> bytearray кодов"""
+    return bytearray(text.encode('ascii').translate(UNDIGITS))
+
+
+def storage_mode():
+    mode = getattr(settings, 'KADR_ATTENDANCE_STORAGE', DAILY)
+    if mode not in STORAGE_MODES:
+        raise ImproperlyConfigured(f'KADR_ATTENDANCE_STORAGE: ожидается одно из {STORAGE_MODES}, получено {mode!r}')
+    return mode
+
+
+def is_monthly():
+    return storage_mode() == MONTHLY
+
+
+def month_start(day):
+    """Первое число месяца, к которому относится дата"""
+    return day.replace(day=1)
+
+
+def read_codes(first_day, last_day, by_pharmacy=False, **filters):
+    """Коды статусов за период: {id профиля: bytearray по байту на день}.
+
+    filters - условия отбора (pharmacy__in=..., user_id__in=...), одинаковые
+    для обоих режимов. При by_pharmacy=True ключи - пары (id аптеки записи,
+    id профиля). В ответ попадают только сотрудники, у которых есть записи за период.
+    """
+    days_count = (last_day - first_day).days + 1
+    key_fields = ('pharmacy_id', 'user_id') if by_pharmacy else ('user_id',)
+    codes = {}
+
+    if is_monthly():
+        rows = AttendanceMonth.objects.filter(
+            month__range=[month_start(first_day), last_day],
+            **filters
+        ).values_list(*key_fields, 'month', 'codes')
+        for row in rows.iterator(chunk_size=READ_CHUNK_SIZE):
+            key = row[:2] if by_pharmacy else row[0]
+            month, month_codes = row[-2:]
+            user_codes = codes.get(key)
+            if user_codes is None:
+                user_codes = codes[key] = bytearray(days_count)
+            # Пересечение месяца с периодом в координатах месяца
+            offset = (month - first_day).days
+            start = max(0, -offset)
+            end = min(monthrange(month.year, month.month)[1], days_count - offset)
+            user_codes[offset + start:offset + end] = decode_digits(month_codes[start:end])
+        return codes
+
+    first_ordinal = first_day.toordinal()
+    rows = Attendance.objects.filter(
+        date__range=[first_day, last_day],
+        **filters
+    ).values_list(*key_fields, 'date', 'status')
+    for row in rows.iterator(chunk_size=READ_CHUNK_SIZE):
+        key = row[:2] if by_pharmacy else row[0]
+        attendance_date, status = row[-2:]
+        user_codes = codes.get(key)
+        if user_codes is None:
+            user_codes = codes[key] = bytearray(days_count)
+        user_codes[attendance_date.toordinal() - first_ordinal] = STATUS_CODES.get(status, CODE_BLANK)
+    return codes
+
+
+def codes_to_statuses(codes, first_day):
+    """Коды read_codes -> строки (ключ, дата, статус) для дней с записями.
+
+    Ключ - id профиля (при by_pharmacy=True - пара (id аптеки, id профиля)).
+    """
+    for key, user_codes in codes.items():
+        for index, code in enumerate(user_codes):
+            if code != CODE_NONE:
+                yield key, first_day + timedelta(days=index), CODE_STATUSES[code]
+
+
+def read_day(day, **filters):
+    """Статусы сотрудников на день: {id профиля: статус} для сотрудников с записями"""
+    return {
+        user_id: CODE_STATUSES[user_codes[0]]
+        for user_id, user_codes in read_codes(day, day, **filters).items()
+    }
+
+
+def read_attendances(employee, first_day, last_day):
+    """Записи сотрудника за период по датам и коды его статусов по дням.
+
+    Записи собираются из кодов одним запросом и в базе не сохранены.
+    Возвращает (записи, коды).
+    """
+    codes = read_codes(first_day, last_day, user_id=employee.id).get(employee.id)
+    if codes is None:
+        codes = bytearray((last_day - first_day).days + 1)
+    attendances = [
+        Attendance(user=employee, date=attendance_date, status=status)
+        for _, attendance_date, status in codes_to_statuses({employee.id: codes}, first_day)
+    ]
+    return attendances, codes
+
+
+def iter_statuses(batch_size=2000):
+    """Заполненные статусы всей посещаемости по сотрудникам и датам.
+
+    Строки - (id профиля, id аптеки записи, дата, статус).
+    """
+    if not is_monthly():
+        yield from Attendance.objects.exclude(
+            status=''
+        ).order_by('user_id', 'date').values_list(
+            'user_id', 'pharmacy_id', 'date', 'status'
+        ).iterator(chunk_size=batch_size)
+        return
+
+    rows = AttendanceMonth.objects.order_by('user_id', 'month').values_list('user_id', 'pharmacy_id', 'month', 'codes')
+    for user_id, pharmacy_id, month, month_codes in rows.iterator(chunk_size=batch_size):
+        for _, attendance_date, status in codes_to_statuses({user_id: decode_digits(month_codes)}, month):
+            if status:
+                yield user_id, pharmacy_id, attendance_date, status
+
+
+def write_statuses(statuses, keep_existing=False):
+    """Записывает статусы {(id профиля, дата): статус}.
+
+    keep_existing=True - создаются только недостающие записи, существующие
+    статусы не меняются. Новым строкам проставляется текущая аптека сотрудника,
+    у существующих аптека остается прежней. Вызывается внутри транзакции записи.
+    Возвращает id аптек, отчеты которых затронуты записью: текущие аптеки
+    сотрудников и аптеки уже существовавших строк.
+    """
+    if not statuses:
+        return set()
+
+    user_ids = {user_id for user_id, _ in statuses}
+    pharmacies = dict(UserProfile.objects.filter(id__in=user_ids).values_list('id', 'pharmacy_id'))
+    touched = set(pharmacies.values())
+
+    if not is_monthly():
+        # После перевода сотрудника его прежние дни относятся к прежней аптеке
+        touched.update(Attendance.objects.filter(
+            user_id__in=user_ids,
+            date__in={day for _, day in statuses}
+        ).values_list('pharmacy_id', flat=True).distinct())
+
+        if keep_existing:
+            options = {'ignore_conflicts': True}
+        else:
+            options = {'update_conflicts': True, 'unique_fields': ['user', 'date'],
+                       'update_fields': ['status', 'updated_at']}
+        Attendance.objects.bulk_create(
+            [
+                Attendance(user_id=user_id, pharmacy_id=pharmacies.get(user_id), date=day, status=status)
+                for (user_id, day), status in statuses.items()
+            ],
+            **options
+        )
+        touched.discard(None)
+        return touched
+
+    day_codes = defaultdict(dict)
+    for (user_id, day), status in statuses.items():
+        day_codes[(user_id, month_start(day))][day.day - 1] = STATUS_CODES.get(status, CODE_BLANK)
+
+    # Строка месяца меняется чтением и записью целиком: в SQLite транзакция записи
+    # уже держит блокировку базы, в других СУБД строки блокируются select_for_update
+    existing = {}
+    for user_id, month, pharmacy_id, month_codes in AttendanceMonth.objects.select_for_update().filter(
+        user_id__in=user_ids,
+        month__in={month for _, month in day_codes}
+    ).values_list('user_id', 'month', 'pharmacy_id', 'codes'):
+        existing[(user_id, month)] = month_codes
+        touched.add(pharmacy_id)
+
+    months = []
+    for (user_id, month), changes in day_codes.items():
+        month_codes = decode_digits(existing.get((user_id, month), EMPTY_MONTH))
+        for index, code in changes.items():
+            if not (keep_existing and month_codes[index] != CODE_NONE):
+                month_codes[index] = code
+        months.append(AttendanceMonth(
+            user_id=user_id, pharmacy_id=pharmacies.get(user_id), month=month, codes=encode_digits(month_codes)
+        ))
+
+    AttendanceMonth.objects.bulk_create(
+        months,
+        update_conflicts=True,
+        unique_fields=['user', 'month'],
+        update_fields=['codes', 'updated_at']
+    )
+    touched.discard(None)
+    return touched
+
+
+def convert_storage(target, batch_size=2000, keep_source=False):
+    """Переносит всю посещаемость в таблицу режима target ('daily' или 'monthly').
+
+    Таблица назначения очищается и заполняется из другой таблицы потоком;
+    исходные строки удаляются, если не указано keep_source. Возвращает
+    число созданных строк.
+    """
+    if target not in STORAGE_MODES:
+        raise ValueError(f'Неизвестный режим хранения: {target}')
+
+    created = 0
+    with transaction.atomic():
+        if target == MONTHLY:
+            AttendanceMonth.objects.all().delete()
+            rows = Attendance.objects.order_by(
+                'user_id', 'date'
+            ).values_list('user_id', 'pharmacy_id', 'date', 'status')
+
+            pending = []
+            current_key = None
+            month_pharmacy_id = None
+            month_codes = None
+            for user_id, pharmacy_id, attendance_date, status in rows.iterator(chunk_size=batch_size):
+                key = (user_id, month_start(attendance_date))
+                if key != current_key:
+                    if current_key is not None:
+                        pending.append(AttendanceMonth(user_id=current_key[0], pharmacy_id=month_pharmacy_id,
+                                                       month=current_key[1], codes=encode_digits(month_codes)))
+                    current_key = key
+                    # Месяц относится к аптеке его первой записи
+                    month_pharmacy_id = pharmacy_id
+                    month_codes = bytearray(MONTH_WIDTH)
+                month_codes[attendance_date.day - 1] = STATUS_CODES.get(status, CODE_BLANK)
+
+                if len(pending) >= batch_size:
+                    AttendanceMonth.objects.bulk_create(pending)
+                    created += len(pending)
+                    pending = []
+
+            if current_key is not None:
+                pending.append(AttendanceMonth(user_id=current_key[0], pharmacy_id=month_pharmacy_id,
+                                               month=current_key[1], codes=encode_digits(month_codes)))
+            AttendanceMonth.objects.bulk_create(pending)
+            created += len(pending)
+            source = Attendance
+        else:
+            Attendance.objects.all().delete()
+            rows = AttendanceMonth.objects.order_by(
+                'user_id', 'month'
+            ).values_list('user_id', 'pharmacy_id', 'month', 'codes')
+
+            pending = []
+            for user_id, pharmacy_id, month, month_codes in rows.iterator(chunk_size=batch_size):
+                pending.extend(
+                    Attendance(user_id=user_id, pharmacy_id=pharmacy_id, date=attendance_date, status=status)
+                    for _, attendance_date, status in codes_to_statuses({user_id: decode_digits(month_codes)}, month)
+                )
+                if len(pending) >= batch_size:
+                    Attendance.objects.bulk_create(pending, batch_size=batch_size)
+                    created += len(pending)
+                    pending = []
+
+            Attendance.objects.bulk_create(pending, batch_size=batch_size)
+            created += len(pending)
+            source = AttendanceMonth
+
+        if not keep_source:
+            source.objects.all().delete()
+    return created
@@ -0,0 +1,50 @@
+import logging
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+# Запуск тестов (TEST_RUNNER в core/settings.py).
+#
+# Тесты не должны видеть общий файловый кэш рабочей копии: номера аптек
+# и пользователей в тестовой базе совпадают с рабочими, и профиль или
+# фрагмент из теста был бы выдан рабочему пользователю (и наоборот),
+# а get_cache().clear() в тестах очищал бы рабочий кэш. Поэтому на время
+# всех тестов кэш заменяется кэшем в памяти процесса. Режим WAL тоже
+# выключается: он сохраняется в файле базы, к которому подключились тесты.
+#
+# Замеры производительности (тег 'benchmark') по умолчанию не запускаются:
+# они долгие и зависят от машины. Запуск: python manage.py test kadr --tag=benchmark
+
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'kadr-tests',
+    },
+    'kadr_state': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'kadr-tests-state',
+    },
+}
+
+
+class KadrTestRunner(DiscoverRunner):
+    """Тесты с кэшем в памяти вместо общего файлового кэша и без режима WAL"""
+
+    def __init__(self, *args, tags=None, exclude_tags=None, **kwargs):
+        if not tags or 'benchmark' not in tags:
+            exclude_tags = set(exclude_tags or ()) | {'benchmark'}
+        super().__init__(*args, tags=tags, exclude_tags=exclude_tags, **kwargs)
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_override = override_settings(CACHES=TEST_CACHES, KADR_SQLITE_WAL=False)
+        self.cache_override.enable()
+        # Строки о запуске и первом запросе процесса не выводятся в консоль тестов
+        self.startup_logger = logging.getLogger('kadr.performance.startup')
+        self.startup_propagate = self.startup_logger.propagate
+        self.startup_logger.propagate = False
+
+    def teardown_test_environment(self, **kwargs):
+        self.cache_override.disable()
+        self.startup_logger.propagate = self.startup_propagate
+        super().teardown_test_environment(**kwargs)
@@ -1,3 +1,1603 @@
-from django.test import TestCase
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import date, timedelta
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.db.models import F
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .exports import Workbook, statistics_rows, timesheet_rows
+from .fragment_cache import (
+    LOCK_KEY_PREFIX, fragment_key, get_cache, get_fragment, get_state_cache, release_build_locks, set_fragment
+)
+from .aggregation import count_monthly_rows, count_working_codes
+from .attendance import get_day_attendances, open_attendance_day, save_attendance_status, upsert_attendances
+from .hierarchy import get_employees_under, get_pharmacies_under
+from .models import Attendance, AttendanceMonth, AttendanceRollup, Pharmacy, ReportJob, UserProfile
+from .profiles import load_profile
+from .reports import FILLED_STATUSES, get_pharmacy_status_counts, get_status_counts
+from .rollup import rebuild_attendance_rollup
+from .storage import DAILY, MONTHLY, convert_storage, read_codes, read_day
+from .timesheet import TimesheetMatrix, build_year_timesheet, month_bounds, period_day_types
+from .utils import RussianHolidays, count_working_days, get_calendar, get_holiday_dates, get_working_days
+from .warmup import log_cold_start, warm_hierarchy
+from .writer import AttendanceWriter, WritePending, WriteTimeout
+
+# Сохраненные результаты замеров, с которыми сравнивается каждый прогон.
+# Замеры запускаются только явно (kadr.test_runner): python manage.py test kadr --tag=benchmark
+# Обновление: KADR_BENCHMARK_UPDATE=1 python manage.py test kadr --tag=benchmark
+BASELINE_PATH = Path(__file__).resolve().parent / 'benchmark_baseline.json'
+
+# Допустимое превышение времени и памяти относительно сохраненных замеров
+# и абсолютный запас на шум измерений
+TOLERANCE = float(os.environ.get('KADR_BENCHMARK_TOLERANCE', '2.0'))
+TIME_SLACK_MS = 25
+MEMORY_SLACK_KB = 256
+
+# Сотрудников на аптеку (без заведующего) в наборах данных разного масштаба
+SCALES = [2, 6, 12]
+BRANCHES = 2
+TIMING_RUNS = 5
+
+BENCH_YEAR = date.today().year - 1
+PERIOD = {'start_date': f'{BENCH_YEAR}-05-01', 'end_date': f'{BENCH_YEAR}-07-31'}
+XHR = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+
+
+def clear_caches():
+    """Очищает кэш фрагментов и кэш версий (у каждого теста свои аптеки)"""
+    get_cache().clear()
+    get_state_cache().clear()
+
+
+def seed_dataset(headcount):
+    """Создает сеть из главной аптеки и филиалов с посещаемостью за май-июль.
+
+    Возвращает словарь с главной аптекой для подстановки в параметры запросов.
+    """
+    rng = random.Random(headcount)
+    password_hash = make_password(None)
+    main = Pharmacy.objects.create(name='Главная', address='ул. Центральная, 1', is_main=True)
+    pharmacies = [main] + [
+        Pharmacy.objects.create(name=f'Филиал {i}', address=f'ул. Филиальная, {i}', main_pharmacy=main)
+        for i in range(1, BRANCHES + 1)
+    ]
+
+    profiles = []
+    for pharmacy in pharmacies:
+        for i in range(headcount + 1):
+            user = User.objects.create(
+                username=f'user_{pharmacy.id}_{i}',
+                password=password_hash,
+                first_name=f'Сотрудник{i}',
+                last_name=f'Аптечный{i}'
+            )
+            profiles.append(UserProfile(
+                user=user,
+                full_name=f'Аптечный Сотрудник {pharmacy.id}-{i}',
+                pharmacy=pharmacy,
+                is_manager=(pharmacy == main and i == 0)
+            ))
+    profiles = UserProfile.objects.bulk_create(profiles)
+
+    leader = User.objects.create(username='leader', password=password_hash)
+    UserProfile.objects.create(user=leader, full_name='Руководитель', is_leader=True)
+
+    attendances = []
+    day = date(BENCH_YEAR, 5, 1)
+    while day <= date(BENCH_YEAR, 7, 31):
+        for profile in profiles:
+            status = rng.choice(['full', 'full', 'half', 'vacation', 'sick', ''])
+            attendances.append(Attendance(user=profile, pharmacy_id=profile.pharmacy_id, date=day, status=status))
+        day += timedelta(days=1)
+    Attendance.objects.bulk_create(attendances, batch_size=2000)
+    rebuild_attendance_rollup()
+
+    return {'main': main, 'employee': profiles[1].user}
+
+
+def benchmark_cases(dataset):
+    """Замеряемые представления: (имя, пользователь, метод, URL, параметры, заголовки)"""
+    manager = dataset['main'].userprofile_set.get(is_manager=True).user
+    leader = User.objects.get(username='leader')
+    pharmacy_id = str(dataset['main'].id)
+    timesheet = {'pharmacy': pharmacy_id, 'year': str(BENCH_YEAR), 'month': '6', 'period_type': 'month'}
+    return [
+        ('manager_dashboard', manager, 'get', '/manager/', {}, {}),
+        ('statistics', manager, 'get', '/statistics/', PERIOD, {}),
+        ('statistics_employee', dataset['employee'], 'get', '/employee-statistics/', PERIOD, {}),
+        ('leader_statistics', leader, 'get', '/leader-statistics/', dict(PERIOD, pharmacy=pharmacy_id), {}),
+        ('leader_statistics_network', leader, 'get', '/leader-statistics/', PERIOD, {}),
+        ('manager_timesheet', manager, 'post', '/manager/timesheet/', {'year': str(BENCH_YEAR), 'month': '6'}, {}),
+        ('leader_timesheet_report', leader, 'post', '/leader/timesheet-report/', timesheet, {}),
+        ('leader_timesheet_report_year', leader, 'post', '/leader/timesheet-report/',
+         dict(timesheet, period_type='year', month='12'), {}),
+        ('leader_timesheet_report_ajax', leader, 'post', '/leader/timesheet-report/ajax/', timesheet, XHR),
+        ('leader_timesheet_report_data', leader, 'post', '/leader/timesheet-report/ajax/',
+         dict(timesheet, period_type='year', month='12', format='data'), XHR),
+    ]
+
+
+def measure(user, method, url, data, headers):
+    """Время (медиана, мс), число SQL-запросов и пик памяти (КБ) для одного запроса"""
+    client = Client()
+    client.force_login(user)
+
+    def request():
+        response = getattr(client, method)(url, data, **headers)
+        assert response.status_code == 200, f'{url}: HTTP {response.status_code}'
+
+    # Прогревочный запрос: компиляция шаблонов, кэш производственного календаря
+    request()
+
+    with CaptureQueriesContext(connection) as queries:
+        request()
+    query_count = len(queries)
+
+    timings = []
+    for _ in range(TIMING_RUNS):
+        started = time.perf_counter()
+        request()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    try:
+        request()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'queries': query_count,
+        'time_ms': round(sorted(timings)[len(timings) // 2], 2),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def run_benchmarks(headcount):
+    """Замеры всех представлений на наборе данных заданного масштаба.
+
+    Набор данных создается во вложенной транзакции и откатывается после замеров.
+    """
+    clear_caches()
+    with transaction.atomic():
+        dataset = seed_dataset(headcount)
+        results = {
+            name: measure(user, method, url, data, headers)
+            for name, user, method, url, data, headers in benchmark_cases(dataset)
+        }
+        transaction.set_rollback(True)
+    return results
+
+
+def create_pharmacy(name='Аптека', main_pharmacy=None):
+    """Главная аптека или филиал аптеки main_pharmacy"""
+    if main_pharmacy is None:
+        return Pharmacy.objects.create(name=name, address='ул. Центральная, 1', is_main=True)
+    return Pharmacy.objects.create(name=name, address='ул. Филиальная, 1', main_pharmacy=main_pharmacy)
+
+
+def create_employee(username, pharmacy, full_name='Сотрудник', last_name='', **fields):
+    """Сотрудник аптеки: пользователь и профиль"""
+    user = User.objects.create(username=username, last_name=last_name)
+    return UserProfile.objects.create(user=user, full_name=full_name, pharmacy=pharmacy, **fields)
+
+
+class ProductionCalendarTests(SimpleTestCase):
+    """Производственный календарь: совпадение с подсчетом по дням"""
+
+    @staticmethod
+    def count_by_days(start, end):
+        holidays = set()
+        for year in range(start.year, end.year + 1):
+            holidays.update(RussianHolidays.get_holidays(year))
+        days = (date.fromordinal(ordinal) for ordinal in range(start.toordinal(), end.toordinal() + 1))
+        return sum(1 for day in days if day.weekday() < 5 and day not in holidays)
+
+    def test_working_days_match_day_by_day_count(self):
+        periods = [
+            (date(2024, 1, 1), date(2024, 12, 31)),
+            (date(2024, 2, 20), date(2024, 3, 10)),
+            (date(2023, 12, 25), date(2025, 1, 15)),
+            (date(2025, 5, 9), date(2025, 5, 9)),
+            (date(2025, 5, 10), date(2025, 5, 11)),
+        ]
+        for start, end in periods:
+            with self.subTest(start=start, end=end):
+                self.assertEqual(count_working_days(start, end), self.count_by_days(start, end))
+        self.assertEqual(count_working_days(date(2025, 2, 1), date(2025, 1, 1)), 0)
+
+    def test_month_days(self):
+        working_days, non_working_days = get_working_days(2025, 6)
+        self.assertEqual(len(working_days) + len(non_working_days), 30)
+        self.assertNotIn(12, working_days)
+        self.assertIn({'day': 12, 'is_weekend': False, 'is_holiday': True}, non_working_days)
+        self.assertIn({'day': 1, 'is_weekend': True, 'is_holiday': False}, non_working_days)
+        # Изменение выданного списка не портит кэш месяца
+        non_working_days[0]['day'] = 0
+        self.assertEqual(get_working_days(2025, 6)[1][0]['day'], 1)
+
+    def test_holiday_dates(self):
+        self.assertEqual(
+            get_holiday_dates(date(2024, 12, 30), date(2025, 1, 3)),
+            [date(2025, 1, day) for day in range(1, 4)]
+        )
+        # Пасха 2025 - 20 апреля
+        self.assertIn(date(2025, 4, 20), get_holiday_dates(date(2025, 4, 1), date(2025, 4, 30)))
+
+    def test_last_supported_year(self):
+        calendar = get_calendar(9999)
+        self.assertTrue(calendar.is_holiday(date(9999, 1, 1)))
+        self.assertEqual(
+            count_working_days(date(9999, 12, 1), date(9999, 12, 31)),
+            self.count_by_days(date(9999, 12, 1), date(9999, 12, 31))
+        )
+
+
+class ManagerStatisticsTests(TestCase):
+    """Статистика заведующего: счетчики статусов одним групповым запросом"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.employees = [create_employee(f'employee{i}', self.pharmacy, f'Сотрудник {i}') for i in range(2)]
+        self.employees.append(create_employee('manager', self.pharmacy, 'Заведующий', is_manager=True))
+        statuses = ['full', 'half', 'vacation', 'sick', '']
+        self.attendances = []
+        day = date(2025, 5, 1)
+        while day <= date(2025, 7, 10):
+            for i, employee in enumerate(self.employees):
+                self.attendances.append(Attendance(
+                    user=employee, pharmacy=self.pharmacy, date=day, status=statuses[(day.day + i) % len(statuses)]
+                ))
+            day += timedelta(days=1)
+        Attendance.objects.bulk_create(self.attendances)
+        rebuild_attendance_rollup()
+        self.client.force_login(self.employees[-1].user)
+
+    def expected_counts(self, start, end):
+        """Счетчики по дням: заполненные статусы в рабочие дни периода"""
+        counts = {}
+        for attendance in self.attendances:
+            if attendance.status and start <= attendance.date <= end and count_working_days(attendance.date, attendance.date):
+                user_counts = counts.setdefault(attendance.user_id, dict.fromkeys(FILLED_STATUSES, 0))
+                user_counts[attendance.status] += 1
+        return counts
+
+    def test_counts_match_day_by_day_count(self):
+        # Неполные края (май, июль) и полный месяц из сводки (июнь)
+        start, end = date(2025, 5, 15), date(2025, 7, 10)
+        self.assertEqual(get_status_counts(self.employees, start, end), self.expected_counts(start, end))
+        start, end = date(2025, 6, 3), date(2025, 6, 20)
+        self.assertEqual(get_status_counts(self.employees[:1], start, end), {
+            self.employees[0].id: self.expected_counts(start, end)[self.employees[0].id]
+        })
+
+    def test_statistics_page(self):
+        start, end = date(2025, 5, 15), date(2025, 7, 10)
+        expected = self.expected_counts(start, end)
+        response = self.client.get('/statistics/', {'start_date': start.isoformat(), 'end_date': end.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        employee_stats = response.context['pharmacy_stats'][0]['employee_stats']
+        self.assertEqual(len(employee_stats), len(self.employees))
+        for stats in employee_stats:
+            status_counts = dict(expected[stats['employee'].id], **{'': 0})
+            self.assertEqual(stats['status_counts'], status_counts)
+            self.assertEqual(stats['missing_days'], count_working_days(start, end) - sum(status_counts.values()))
+        self.assertEqual(
+            sum(response.context['total_stats'].values()),
+            sum(sum(counts.values()) for counts in expected.values())
+        )
+
+
+class TimesheetMatrixTests(TestCase):
+    """Табель аптек за период: ячейки дней и счетчики строк"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.branch = create_pharmacy('Филиал', self.pharmacy)
+        self.manager = create_employee('manager', self.pharmacy, 'Заведующий', last_name='Б', is_manager=True)
+        self.employee = create_employee('employee', self.pharmacy, last_name='А')
+        self.branch_employee = create_employee('branch', self.branch, 'Сотрудник филиала')
+        # 01.06.2025 - воскресенье, 12.06.2025 - праздник
+        for user, day, status in [
+            (self.employee, 2, 'full'), (self.employee, 3, 'sick'), (self.employee, 1, 'full'),
+            (self.employee, 12, 'full'), (self.branch_employee, 2, 'half'),
+        ]:
+            Attendance.objects.create(user=user, date=date(2025, 6, day), status=status)
+        self.client.force_login(self.manager.user)
+
+    def test_month_rows(self):
+        matrix = TimesheetMatrix([self.pharmacy, self.branch], date(2025, 6, 1), date(2025, 6, 30))
+        rows = matrix.month_rows(self.pharmacy, 2025, 6)
+        self.assertEqual([row['employee'] for row in rows], [self.employee, self.manager])
+
+        cells = rows[0]['daily_status']
+        self.assertEqual(len(cells), 30)
+        self.assertEqual(cells[0], {'status': 'weekend', 'is_working': False, 'is_weekend': True, 'is_holiday': False})
+        self.assertEqual(cells[11], {'status': 'holiday', 'is_working': False, 'is_weekend': False, 'is_holiday': True})
+        self.assertEqual([cells[1]['status'], cells[2]['status'], cells[3]['status']], ['full', 'sick', None])
+        self.assertEqual(rows[0]['total_working_days'], 20)
+        # Записи в выходной и праздник не считаются заполненными рабочими днями
+        self.assertEqual(rows[0]['filled_working_days'], 2)
+        self.assertEqual(rows[0]['attendance_percentage'], 10)
+        self.assertEqual(rows[1]['filled_working_days'], 0)
+
+        branch_rows = matrix.month_rows(self.branch, 2025, 6)
+        self.assertEqual([row['employee'] for row in branch_rows], [self.branch_employee])
+        self.assertEqual(branch_rows[0]['daily_status'][1]['status'], 'half')
+
+    def test_year_timesheet_in_one_pass(self):
+        Attendance.objects.create(user=self.employee, date=date(2025, 2, 3), status='vacation')
+        with self.assertNumQueries(2):
+            months = build_year_timesheet(self.pharmacy, 2025, 6)
+        self.assertEqual([month['period'] for month in months][::5], ['Январь 2025', 'Июнь 2025'])
+        self.assertEqual(months[1]['days_in_month'], list(range(1, 29)))
+        self.assertNotIn(23, months[1]['working_days_set'])
+
+        # Месяцы года совпадают с табелем, построенным за каждый месяц отдельно
+        for month in months:
+            first_day, last_day = month_bounds(2025, month['month_number'])
+            matrix = TimesheetMatrix([self.pharmacy], first_day, last_day)
+            self.assertEqual(month['employees'], matrix.month_rows(self.pharmacy, 2025, month['month_number']))
+        self.assertEqual(months[1]['employees'][0]['daily_status'][2]['status'], 'vacation')
+
+    def test_manager_timesheet_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/manager/timesheet/', {'year': 2025, 'month': 6})
+        self.assertEqual(response.status_code, 200)
+        timesheet_data = response.context['timesheet_data']
+        self.assertEqual([item['pharmacy'] for item in timesheet_data], [self.pharmacy, self.branch])
+        self.assertEqual(timesheet_data[0]['employees'][0]['filled_working_days'], 2)
+        self.assertEqual(timesheet_data[1]['employees'][0]['filled_working_days'], 1)
+
+        # Число запросов не зависит от числа сотрудников
+        for i, pharmacy in enumerate([self.pharmacy, self.branch] * 3):
+            employee = create_employee(f'extra{i}', pharmacy, f'Сотрудник {i}')
+            Attendance.objects.create(user=employee, date=date(2025, 6, 4), status='full')
+        clear_caches()
+        with self.assertNumQueries(len(queries)):
+            self.client.post('/manager/timesheet/', {'year': 2025, 'month': 6})
+
+
+class AttendanceRollupTests(TestCase):
+    """Помесячная сводка: обновление при записи и пересборка"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.employees = [create_employee(f'employee{i}', self.pharmacy, f'Сотрудник {i}') for i in range(3)]
+
+    def rollup(self):
+        return set(AttendanceRollup.objects.values_list(
+            'user_id', 'pharmacy_id', 'month', 'status', 'days_count', 'working_days_count'
+        ))
+
+    def test_rollup_follows_writes(self):
+        employee = self.employees[0]
+        # 01.06.2025 - воскресенье
+        for day, status in [(1, 'full'), (2, 'full'), (3, 'full'), (4, 'sick'), (3, 'sick'), (4, '')]:
+            save_attendance_status(employee.id, date(2025, 6, day), status)
+        upsert_attendances([(employee.id, date(2025, 7, 1), 'vacation')])
+
+        june, july = date(2025, 6, 1), date(2025, 7, 1)
+        self.assertEqual(self.rollup(), {
+            (employee.id, self.pharmacy.id, june, 'full', 2, 1),
+            (employee.id, self.pharmacy.id, june, 'sick', 1, 1),
+            (employee.id, self.pharmacy.id, july, 'vacation', 1, 1),
+        })
+
+    def test_rebuild_matches_maintained_rollup(self):
+        rng = random.Random(1)
+        entries = [
+            (employee.id, date(2025, 5, 25) + timedelta(days=offset), rng.choice(['full', 'half', 'sick', '']))
+            for employee in self.employees
+            for offset in range(45)
+        ]
+        upsert_attendances(entries)
+        maintained = self.rollup()
+        self.assertTrue(maintained)
+
+        call_command('rebuild_attendance_rollup', stdout=StringIO())
+        self.assertEqual(self.rollup(), maintained)
+        # Пересборка малыми порциями (по целым сотрудникам) дает ту же сводку
+        rebuild_attendance_rollup(batch_size=1)
+        self.assertEqual(self.rollup(), maintained)
+
+
+class DashboardDayTests(TestCase):
+    """Записи дня на панели заведующего"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.employees = [create_employee(f'employee{i}', self.pharmacy, f'Сотрудник {i}') for i in range(4)]
+        self.day = date(2025, 6, 2)
+        Attendance.objects.create(user=self.employees[1], date=self.day, status='sick')
+
+    def test_missing_rows_are_created_in_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            attendances = get_day_attendances(self.employees, self.day)
+        self.assertEqual([attendance.user for attendance in attendances], self.employees)
+        self.assertEqual([attendance.status for attendance in attendances], ['', 'sick', '', ''])
+        self.assertEqual(sum(1 for query in queries if query['sql'].startswith('INSERT')), 1)
+        self.assertEqual(Attendance.objects.filter(date=self.day, pharmacy=self.pharmacy).count(), 4)
+        self.assertEqual(Attendance.objects.get(user=self.employees[1], date=self.day).status, 'sick')
+
+        # Повторное открытие дня ничего не создает и не перезаписывает
+        save_attendance_status(self.employees[0].id, self.day, 'full')
+        with CaptureQueriesContext(connection) as queries:
+            attendances = get_day_attendances(self.employees, self.day)
+        self.assertFalse(any(query['sql'].startswith('INSERT') for query in queries))
+        self.assertEqual([attendance.status for attendance in attendances], ['full', 'sick', '', ''])
+
+    @override_settings(KADR_DASHBOARD_VIRTUAL_ROWS=True)
+    def test_virtual_rows_are_not_saved(self):
+        attendances = get_day_attendances(self.employees, self.day)
+        self.assertEqual([attendance.status for attendance in attendances], ['', 'sick', '', ''])
+        self.assertEqual(Attendance.objects.filter(date=self.day).count(), 1)
+
+
+class AttendanceBatchSaveTests(TestCase):
+    """Пакетное сохранение посещаемости заведующим"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.employee = create_employee('employee', self.pharmacy)
+        self.stranger = create_employee('stranger', create_pharmacy('Другая'), 'Чужой')
+        manager = create_employee('manager', self.pharmacy, 'Заведующий', is_manager=True)
+        self.client.force_login(manager.user)
+        self.day = timezone.now().date()
+
+    def save(self, *entries):
+        return self.client.post(
+            '/attendance/ajax/save-batch/', {'entries': list(entries)}, content_type='application/json'
+        ).json()
+
+    def test_upsert_and_foreign_employee(self):
+        entry = {'user_id': self.employee.user_id, 'date': self.day.isoformat(), 'status': 'full'}
+        self.assertTrue(self.save(entry)['success'])
+        result = self.save(dict(entry, status='sick'), {'user_id': self.stranger.user_id, 'status': 'full'})
+        self.assertFalse(result['success'])
+        self.assertEqual([row['success'] for row in result['results']], [True, False])
+        self.assertEqual(Attendance.objects.get(user=self.employee, date=self.day).status, 'sick')
+        self.assertFalse(Attendance.objects.filter(user=self.stranger).exists())
+
+    def test_upsert_is_one_statement_and_last_status_wins(self):
+        other_day = self.day + timedelta(days=1)
+        Attendance.objects.create(user=self.employee, date=self.day, status='full')
+        with CaptureQueriesContext(connection) as queries:
+            upsert_attendances([
+                (self.employee.id, self.day, 'half'),
+                (self.employee.id, other_day, 'full'),
+                (self.employee.id, other_day, 'sick'),
+            ])
+        inserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT INTO "kadr_attendance"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertIn('ON CONFLICT', inserts[0])
+        self.assertEqual(
+            dict(Attendance.objects.filter(user=self.employee).values_list('date', 'status')),
+            {self.day: 'half', other_day: 'sick'}
+        )
+
+    @override_settings(KADR_BATCH_SAVE_MAX_ENTRIES=2)
+    def test_entries_are_capped_and_dates_limited_to_dashboard_window(self):
+        entry = {'user_id': self.employee.user_id, 'status': 'full'}
+        result = self.save(entry, entry, entry)
+        self.assertFalse(result['success'])
+        self.assertNotIn('results', result)
+
+        result = self.save(dict(entry, date=(self.day - timedelta(days=30)).isoformat()), entry)
+        self.assertEqual([row['success'] for row in result['results']], [False, True])
+        self.assertEqual(list(Attendance.objects.values_list('date', flat=True)), [self.day])
+
+    def test_dashboard_rejects_foreign_employee(self):
+        with self.assertLogs('kadr.views', level='WARNING'):
+            response = self.client.post('/manager/', {
+                'save_status': '1', 'user_id': self.stranger.id, f'{self.stranger.id}-status': 'full'
+            })
+        self.assertRedirects(response, '/access-denied/', fetch_redirect_response=False)
+        self.assertFalse(Attendance.objects.filter(user=self.stranger).exclude(status='').exists())
+
+    def test_write_error_is_logged_not_returned(self):
+        entry = {'user_id': self.employee.user_id, 'date': self.day.isoformat(), 'status': 'full'}
+        with mock.patch('kadr.views.run_write', side_effect=RuntimeError('секрет базы')), \
+                self.assertLogs('kadr.views', level='ERROR'):
+            result = self.save(entry)
+        self.assertFalse(result['success'])
+        self.assertNotIn('секрет', result['error'])
+
+
+# Хэши паролей, которые команда считает на каждый запуск, - быстрым алгоритмом
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class GenerateTestDataTests(TestCase):
+    """Команда generate_test_data: размер сети, иерархия и воспроизводимость"""
+
+    def generate(self, **options):
+        call_command('generate_test_data', stdout=StringIO(), **dict({
+            'pharmacies': 5, 'networks': 2, 'depth': 2, 'employees': 2, 'seed': 7, 'batch_size': 7,
+        }, **options))
+        return sorted(
+            Attendance.objects.values_list('user__user__username', 'date', 'status')
+        )
+
+    def test_options(self):
+        attendances = self.generate(password='secret')
+
+        roots = Pharmacy.objects.filter(main_pharmacy__isnull=True).order_by('id')
+        self.assertEqual(Pharmacy.objects.count(), 5)
+        self.assertEqual(len(roots), 2)
+        # Оставшиеся 3 аптеки - по уровням подчинения первой сети: 1 филиал и 2 его филиала
+        self.assertEqual(Pharmacy.objects.filter(main_pharmacy=roots[0]).count(), 1)
+        self.assertEqual(Pharmacy.objects.filter(main_pharmacy__main_pharmacy=roots[0]).count(), 2)
+
+        self.assertEqual(UserProfile.objects.filter(pharmacy__isnull=False).count(), 5 * 3)
+        self.assertTrue(User.objects.get(username='manager_1').check_password('secret'))
+
+        end_date = date.today()
+        weekdays = sum(1 for offset in range(31) if (end_date - timedelta(days=offset)).weekday() < 5)
+        self.assertEqual(len(attendances), 5 * 3 * weekdays)
+        self.assertEqual(
+            Attendance.objects.filter(pharmacy=F('user__pharmacy')).count(), len(attendances)
+        )
+
+        # Помесячная сводка совпадает с пересобранной
+        rollup = set(AttendanceRollup.objects.values_list('user_id', 'pharmacy_id', 'month', 'status', 'days_count'))
+        rebuild_attendance_rollup()
+        self.assertEqual(set(AttendanceRollup.objects.values_list('user_id', 'pharmacy_id', 'month', 'status', 'days_count')), rollup)
+
+    def test_seed_reproduces_data_with_any_workers(self):
+        attendances = self.generate()
+        self.assertEqual(self.generate(workers=2), attendances)
+        self.assertNotEqual(self.generate(seed=8), attendances)
+
+
+@tag('benchmark')
+class ViewBenchmarkTests(TestCase):
+    """Производительность основных представлений: запросы, время и память"""
+
+    def test_query_count_does_not_grow_with_headcount(self):
+        results = {headcount: run_benchmarks(headcount) for headcount in SCALES}
+
+        for name in results[SCALES[0]]:
+            with self.subTest(view=name):
+                counts = {headcount: results[headcount][name]['queries'] for headcount in SCALES}
+                self.assertEqual(
+                    len(set(counts.values())), 1,
+                    f'{name}: число запросов зависит от числа сотрудников {counts}'
+                )
+
+    def test_against_baseline(self):
+        headcount = SCALES[-1]
+        results = run_benchmarks(headcount)
+
+        if os.environ.get('KADR_BENCHMARK_UPDATE'):
+            BASELINE_PATH.write_text(
+                json.dumps({'headcount': headcount, 'views': results}, indent=2, ensure_ascii=False) + '\n',
+                encoding='utf-8'
+            )
+            return
+
+        if not BASELINE_PATH.exists():
+            self.skipTest('нет сохраненных замеров, запустите с KADR_BENCHMARK_UPDATE=1')
+        baseline = json.loads(BASELINE_PATH.read_text(encoding='utf-8'))['views']
+
+        for name, result in results.items():
+            expected = baseline.get(name)
+            if expected is None:
+                continue
+            with self.subTest(view=name):
+                self.assertLessEqual(
+                    result['queries'], expected['queries'],
+                    f'{name}: запросов {result["queries"]}, в базовых замерах {expected["queries"]}'
+                )
+                self.assertLessEqual(
+                    result['time_ms'], expected['time_ms'] * TOLERANCE + TIME_SLACK_MS,
+                    f'{name}: {result["time_ms"]} мс, в базовых замерах {expected["time_ms"]} мс'
+                )
+                self.assertLessEqual(
+                    result['peak_kb'], expected['peak_kb'] * TOLERANCE + MEMORY_SLACK_KB,
+                    f'{name}: пик памяти {result["peak_kb"]} КБ, в базовых замерах {expected["peak_kb"]} КБ'
+                )
+
+
+class RequestTimingMiddlewareTests(TestCase):
+    """Заголовок Server-Timing и лог медленных запросов"""
+
+    def test_server_timing_header(self):
+        response = self.client.get('/leader-statistics/')
+        self.assertRegex(response['Server-Timing'], r'^total;dur=[\d.]+;desc="leader_statistics", db;dur=[\d.]+;desc="SQL x0", tpl;dur=[\d.]+')
+
+    def test_template_and_sql_time_are_counted(self):
+        user = User.objects.create(username='leader')
+        UserProfile.objects.create(user=user, full_name='Руководитель', is_leader=True)
+        self.client.force_login(user)
+        response = self.client.get('/leader-statistics/')
+        self.assertNotIn('SQL x0', response['Server-Timing'])
+        self.assertNotRegex(response['Server-Timing'], r'tpl;dur=0\.0;')
+
+    @override_settings(KADR_SLOW_REQUEST_MS=0)
+    def test_slow_request_is_logged(self):
+        with self.assertLogs('kadr.performance.slow', level='WARNING') as logs:
+            self.client.get('/access-denied/')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'access_denied')
+        self.assertEqual(record['status'], 200)
+
+    @override_settings(KADR_SERVER_TIMING=False)
+    def test_server_timing_can_be_disabled(self):
+        response = self.client.get('/access-denied/')
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_cold_start_is_logged(self):
+        create_pharmacy()
+        with self.assertLogs('kadr.performance.startup', level='INFO') as logs:
+            self.assertNotIn('steps', log_cold_start(time.perf_counter()))
+            with override_settings(KADR_WARMUP=True):
+                record = log_cold_start(time.perf_counter())
+        self.assertEqual(json.loads(logs.records[-1].getMessage()), record)
+        self.assertEqual(record['steps']['database']['result'], 1)
+        self.assertEqual(record['steps']['hierarchy']['result'], 0)
+        self.assertEqual(record['steps']['calendar']['result'], 3)
+        self.assertGreater(record['steps']['templates']['result'], 10)
+        self.assertGreater(record['steps']['urls']['result'], 0)
+
+    @mock.patch('kadr.middleware._first_request_logged', False)
+    def test_first_request_is_logged_once_per_process(self):
+        with self.assertLogs('kadr.performance.startup', level='INFO') as logs:
+            self.client.get('/access-denied/')
+            # Новый экземпляр middleware (например, в другом обработчике) не пишет строку повторно
+            self.client.handler.load_middleware()
+            self.client.get('/access-denied/')
+            logging.getLogger('kadr.performance.startup').info('end')
+        self.assertEqual([json.loads(line.getMessage())['event'] for line in logs.records[:-1]], ['first_request'])
+
+
+class FragmentCacheTests(TestCase):
+    """Кэш фрагментов отчетов и его сброс при изменении данных аптеки"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.employee = UserProfile.objects.create(
+            user=User.objects.create(username='employee'), full_name='Сотрудник', pharmacy=self.pharmacy
+        )
+        self.manager = UserProfile.objects.create(
+            user=User.objects.create(username='manager'), full_name='Заведующий',
+            pharmacy=self.pharmacy, is_manager=True
+        )
+        leader = User.objects.create(username='leader')
+        UserProfile.objects.create(user=leader, full_name='Руководитель', is_leader=True)
+        self.client.force_login(leader)
+        self.day = date(BENCH_YEAR, 6, 2)  # понедельник
+        self.params = {'pharmacy': self.pharmacy.id, 'start_date': self.day, 'end_date': self.day}
+
+    def get_statistics(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/leader/statistics/ajax/', self.params, **XHR)
+        return response.json(), len(queries)
+
+    def test_repeat_request_is_served_from_cache(self):
+        first, first_queries = self.get_statistics()
+        second, second_queries = self.get_statistics()
+        self.assertEqual(first, second)
+        self.assertLess(second_queries, first_queries)
+
+    def test_attendance_change_invalidates_cache(self):
+        before, _ = self.get_statistics()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            save_attendance_status(self.employee.id, self.day, 'sick')
+
+        after, _ = self.get_statistics()
+        self.assertNotEqual(before['html'], after['html'])
+        self.assertNotIn('title="Больничный: 1"', before['html'])
+        self.assertIn('title="Больничный: 1"', after['html'])
+
+    def test_profile_change_invalidates_cache(self):
+        self.get_statistics()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.employee.full_name = 'Переименованный Сотрудник'
+            self.employee.save()
+
+        after, _ = self.get_statistics()
+        self.assertIn('Переименованный Сотрудник', after['html'])
+
+    def test_versions_survive_fragment_eviction(self):
+        key = fragment_key('test', 'leader', [self.pharmacy.id])
+        # Вытеснение фрагментов (переполнение кэша) не меняет версии аптек
+        get_cache().clear()
+        self.assertEqual(fragment_key('test', 'leader', [self.pharmacy.id]), key)
+
+    def wait_in_thread(self, key):
+        """Запускает ожидание фрагмента в другом потоке (как параллельный запрос)"""
+        results = []
+
+        def wait():
+            results.append(get_fragment(key, wait=True))
+            release_build_locks()
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        return thread, results
+
+    def test_concurrent_request_waits_for_first_build(self):
+        key = fragment_key('test', 'leader', [self.pharmacy.id])
+        self.assertIsNone(get_fragment(key, wait=True))  # первый запрос строит фрагмент
+
+        thread, results = self.wait_in_thread(key)
+        time.sleep(0.2)
+        self.assertTrue(thread.is_alive())
+        set_fragment(key, {'html': 'готово'})
+        thread.join(5)
+        self.assertEqual(results, [{'html': 'готово'}])
+
+    def test_failed_build_lets_waiting_request_build(self):
+        key = fragment_key('test', 'leader', [self.pharmacy.id])
+        self.assertIsNone(get_fragment(key, wait=True))
+
+        thread, results = self.wait_in_thread(key)
+        time.sleep(0.2)
+        # Запрос завершился без сохранения фрагмента - ожидающий строит сам
+        release_build_locks()
+        thread.join(5)
+        self.assertEqual(results, [None])
+
+    def test_lost_lock_does_not_release_new_builder(self):
+        key = fragment_key('test', 'leader', [self.pharmacy.id])
+        lock_key = f'{LOCK_KEY_PREFIX}{key}'
+        self.assertIsNone(get_fragment(key, wait=True))
+        # Блокировка хранится вне кэша фрагментов и не вытесняется вместе с ними
+        get_cache().clear()
+        self.assertIsNotNone(get_state_cache().get(lock_key))
+
+        # Блокировка пропала посреди построения (истек срок): следующий запрос
+        # берет ее и строит сам, а первый, сохранив фрагмент, не снимает чужую
+        get_state_cache().delete(lock_key)
+        taken = threading.Event()
+        finish = threading.Event()
+        results = []
+
+        def second_builder():
+            results.append(get_fragment(key, wait=True))
+            taken.set()
+            finish.wait(5)
+            release_build_locks()
+
+        thread = threading.Thread(target=second_builder)
+        thread.start()
+        self.assertTrue(taken.wait(5))
+        second_token = get_state_cache().get(lock_key)
+        set_fragment(key, {'html': 'первый'})
+        self.assertEqual(get_state_cache().get(lock_key), second_token)
+        finish.set()
+        thread.join(5)
+        self.assertEqual(results, [None])
+        self.assertIsNone(get_state_cache().get(lock_key))
+        self.assertEqual(get_fragment(key, wait=True), {'html': 'первый'})
+
+
+class ProfileCacheTests(TestCase):
+    """request.kadr_profile и вход сразу на страницу роли"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.user = User.objects.create_user(username='manager', password='secret-password')
+        UserProfile.objects.create(user=self.user, full_name='Заведующий', pharmacy=self.pharmacy, is_manager=True)
+
+    def test_ajax_login_returns_role_url(self):
+        response = self.client.post(
+            '/ajax-login/', {'username': 'manager', 'password': 'secret-password'}, content_type='application/json'
+        )
+        self.assertEqual(response.json(), {'success': True, 'redirect_url': '/manager/'})
+
+    def test_profile_is_cached_and_invalidated_on_pharmacy_change(self):
+        self.client.force_login(self.user)
+        self.client.get('/manager/timesheet/')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/manager/timesheet/')
+        self.assertFalse(any('WHERE "kadr_userprofile"."user_id" =' in query['sql'] for query in queries.captured_queries))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_pharmacy('Новый филиал', self.pharmacy)
+        response = self.client.get('/manager/timesheet/')
+        self.assertContains(response, 'Новый филиал')
+
+    def test_bulk_update_invalidates_profiles(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/leader-statistics/').status_code, 302)
+        # Массовое изменение ролей (действие админки) не вызывает post_save
+        with self.captureOnCommitCallbacks(execute=True):
+            UserProfile.objects.filter(user=self.user).update(is_manager=False, is_leader=True)
+        self.assertEqual(self.client.get('/leader-statistics/').status_code, 200)
+
+    def test_warmup_fills_profile_cache(self):
+        branch = create_pharmacy('Филиал', self.pharmacy)
+        create_pharmacy('Филиал филиала', branch)
+        create_pharmacy('Другая сеть')
+        leader = create_employee('leader', None, 'Руководитель', is_leader=True)
+        users = [self.user, leader.user]
+        expected = [[pharmacy.id for pharmacy in load_profile(user).branch_pharmacies] for user in users]
+        clear_caches()
+
+        self.assertEqual(warm_hierarchy(), 2)
+        for user, branch_ids in zip(users, expected):
+            with self.assertNumQueries(0):
+                profile = load_profile(user)
+            self.assertEqual([pharmacy.id for pharmacy in profile.branch_pharmacies], branch_ids)
+
+    def test_tests_do_not_use_shared_cache(self):
+        self.assertEqual(settings.CACHES['default']['BACKEND'], 'django.core.cache.backends.locmem.LocMemCache')
+
+
+class PharmacyHierarchyTests(TestCase):
+    """Материализованные пути аптек и выборки по поддереву"""
+
+    def create(self, name, parent=None):
+        return Pharmacy.objects.create(name=name, address='ул. Центральная, 1', main_pharmacy=parent)
+
+    def setUp(self):
+        self.region = self.create('Регион')
+        self.city = self.create('Город', self.region)
+        self.branch = self.create('Филиал', self.city)
+        self.other = self.create('Другая сеть')
+
+    def names(self, queryset):
+        return sorted(pharmacy.name for pharmacy in queryset)
+
+    def test_paths_and_subtree(self):
+        self.assertEqual(self.branch.path, f'/{self.region.id}/{self.city.id}/{self.branch.id}/')
+        self.assertEqual(self.names(get_pharmacies_under(self.region)), ['Город', 'Регион', 'Филиал'])
+        self.assertEqual(self.names(get_pharmacies_under(self.city, include_self=False)), ['Филиал'])
+
+        profile = UserProfile.objects.create(
+            user=User.objects.create(username='employee'), full_name='Сотрудник', pharmacy=self.branch
+        )
+        self.assertEqual(list(get_employees_under(self.region)), [profile])
+        self.assertEqual(list(get_employees_under(self.other)), [])
+
+    def test_moving_pharmacy_moves_subtree(self):
+        self.city.main_pharmacy = self.other
+        self.city.save()
+
+        self.branch.refresh_from_db()
+        self.assertEqual(self.branch.path, f'/{self.other.id}/{self.city.id}/{self.branch.id}/')
+        self.assertEqual(self.names(get_pharmacies_under(self.region)), ['Регион'])
+
+    def test_cycle_is_rejected(self):
+        self.region.main_pharmacy = self.branch
+        with self.assertRaises(ValueError):
+            self.region.save()
+
+    def test_three_level_tree_passes_full_clean(self):
+        parent = None
+        for name in ('Сеть', 'Филиал', 'Филиал филиала'):
+            pharmacy = Pharmacy(name=name, address='ул. Центральная, 1', is_main=parent is None, main_pharmacy=parent)
+            pharmacy.full_clean()
+            pharmacy.save()
+            parent = pharmacy
+        self.assertEqual(parent.path.count('/'), 4)
+
+        # Цикл отклоняется и валидацией: аптека не подчиняется себе и своим филиалам
+        for new_parent in (self.city, self.branch):
+            self.city.main_pharmacy = new_parent
+            with self.assertRaises(ValidationError):
+                self.city.full_clean()
+
+    def test_deleting_pharmacy_makes_branches_roots(self):
+        self.city.delete()
+        self.branch.refresh_from_db()
+        self.assertEqual(self.branch.path, f'/{self.branch.id}/')
+
+
+class ConditionalGetTests(TestCase):
+    """ETag и Last-Modified отчетов: 304 без построения отчета"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.employee = UserProfile.objects.create(
+            user=User.objects.create(username='employee'), full_name='Сотрудник', pharmacy=self.pharmacy
+        )
+        self.manager = UserProfile.objects.create(
+            user=User.objects.create(username='manager'), full_name='Заведующий',
+            pharmacy=self.pharmacy, is_manager=True
+        )
+        self.client.force_login(self.manager.user)
+        self.day = date(BENCH_YEAR, 6, 2)  # понедельник
+        self.params = {'start_date': self.day, 'end_date': self.day}
+
+    def test_repeat_request_is_not_modified(self):
+        response = self.client.get('/statistics/', self.params)
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        with CaptureQueriesContext(connection) as queries:
+            repeat = self.client.get('/statistics/', self.params, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(repeat.status_code, 304)
+        self.assertEqual(repeat['ETag'], response['ETag'])
+        self.assertFalse(any('kadr_attendance' in query['sql'] for query in queries.captured_queries))
+
+        # Другой период или формат ответа - другой ETag
+        other = self.client.get('/statistics/', self.params, HTTP_IF_NONE_MATCH=response['ETag'], **XHR)
+        self.assertEqual(other.status_code, 200)
+
+    def test_attendance_change_invalidates_etag(self):
+        etag = self.client.get('/statistics/', self.params)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            save_attendance_status(self.employee.id, self.day, 'sick')
+        response = self.client.get('/statistics/', self.params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_depends_on_user(self):
+        etag = self.client.get('/statistics/', self.params)['ETag']
+        other_manager = User.objects.create(username='manager2')
+        UserProfile.objects.create(user=other_manager, full_name='Заведующий 2', pharmacy=self.pharmacy, is_manager=True)
+        self.client.force_login(other_manager)
+        response = self.client.get('/statistics/', self.params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class AttendanceWriterTests(TransactionTestCase):
+    """Поток записи: параллельные записи объединяются в пачки"""
+
+    def setUp(self):
+        pharmacy = create_pharmacy()
+        self.profiles = [
+            UserProfile.objects.create(
+                user=User.objects.create(username=f'employee_{i}'), full_name=f'Сотрудник {i}', pharmacy=pharmacy
+            )
+            for i in range(8)
+        ]
+        self.day = date(BENCH_YEAR, 6, 2)
+
+    def test_concurrent_writes_are_coalesced(self):
+        writer = AttendanceWriter(max_delay=0.2)
+        barrier = threading.Barrier(len(self.profiles))
+        errors = []
+
+        def save(profile):
+            barrier.wait()
+            try:
+                writer.submit(upsert_attendances, [(profile.id, self.day, 'full')], timeout=10)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=save, args=(profile,)) for profile in self.profiles]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLess(writer.batches, len(self.profiles))
+        self.assertEqual(Attendance.objects.filter(date=self.day, status='full').count(), len(self.profiles))
+
+    def test_failed_write_does_not_cancel_batch(self):
+        writer = AttendanceWriter(max_delay=0.2)
+        barrier = threading.Barrier(2)
+        errors = {}
+
+        def save(profile_id):
+            barrier.wait()
+            try:
+                writer.submit(upsert_attendances, [(profile_id, self.day, 'sick')], timeout=10)
+            except Exception as e:
+                errors[profile_id] = e
+
+        # Профиля 0 нет: его запись нарушает внешний ключ
+        threads = [threading.Thread(target=save, args=(profile_id,)) for profile_id in (0, self.profiles[0].id)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(list(errors), [0])
+        self.assertEqual(Attendance.objects.get(user=self.profiles[0], date=self.day).status, 'sick')
+
+    def test_timed_out_write_is_cancelled_or_pending(self):
+        writer = AttendanceWriter(max_delay=0)
+        done = []
+
+        def slow_write(seconds):
+            time.sleep(seconds)
+            done.append(seconds)
+
+        # Поток занят долгой записью: ее запрос получает WritePending,
+        # а запись из очереди за ней отменяется и не выполняется
+        with self.assertRaises(WritePending):
+            writer.submit(slow_write, 0.3, timeout=0.05)
+        with self.assertRaises(WriteTimeout):
+            writer.submit(slow_write, 0, timeout=0.05)
+        writer.submit(slow_write, 0.01, timeout=5)
+        self.assertEqual(done, [0.3, 0.01])
+
+    def test_wal_only_for_working_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            other = DatabaseWrapper(
+                dict(connection.settings_dict, NAME=os.path.join(directory, 'other.sqlite3')), alias='other'
+            )
+            working = DatabaseWrapper(
+                dict(connection.settings_dict, NAME=os.path.join(directory, 'working.sqlite3')), alias='default'
+            )
+            try:
+                with override_settings(KADR_SQLITE_WAL=True):
+                    for wrapper, journal_mode in ((other, 'delete'), (working, 'wal')):
+                        with wrapper.cursor() as cursor:
+                            cursor.execute('PRAGMA journal_mode')
+                            self.assertEqual(cursor.fetchone()[0], journal_mode)
+            finally:
+                other.close()
+                working.close()
+        self.assertFalse(settings.KADR_SQLITE_WAL)
+
+
+class NetworkStatisticsTests(TestCase):
+    """Сводка руководителя по всем аптекам сети"""
+
+    def setUp(self):
+        clear_caches()
+        leader = User.objects.create(username='leader')
+        UserProfile.objects.create(user=leader, full_name='Руководитель', is_leader=True)
+        self.client.force_login(leader)
+        self.day = date(BENCH_YEAR, 6, 2)  # понедельник
+        self.params = {'start_date': self.day, 'end_date': self.day}
+
+    def add_pharmacy(self, name, statuses):
+        pharmacy = Pharmacy.objects.create(name=name, address='ул. Центральная, 1')
+        for i, status in enumerate(statuses):
+            profile = UserProfile.objects.create(
+                user=User.objects.create(username=f'{name}_{i}'), full_name=f'{name} {i}', pharmacy=pharmacy
+            )
+            Attendance.objects.create(user=profile, date=self.day, status=status)
+        return pharmacy
+
+    def get_statistics(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/leader-statistics/', self.params)
+        return response, len(queries)
+
+    def test_per_pharmacy_and_network_totals(self):
+        first = self.add_pharmacy('Первая', ['full', 'sick'])
+        second = self.add_pharmacy('Вторая', ['full', 'full', 'vacation', ''])
+        response, _ = self.get_statistics()
+
+        stats = {stat['pharmacy']: stat for stat in response.context['network_stats']}
+        self.assertEqual(stats[first]['status_counts'], {'full': 1, 'half': 0, 'vacation': 0, 'sick': 1})
+        self.assertEqual(stats[second]['total_employees'], 4)
+        self.assertEqual(stats[second]['missing_days'], 1)
+        self.assertEqual(stats[second]['attendance_percentage'], 75)
+
+        network = response.context['pharmacy_stats']
+        self.assertEqual(network['total_employees'], 6)
+        self.assertEqual(network['status_counts'], {'full': 3, 'half': 0, 'vacation': 1, 'sick': 1})
+
+    def test_query_count_does_not_grow_with_network(self):
+        self.add_pharmacy('Первая', ['full'])
+        self.get_statistics()  # прогрев: производственный календарь
+        _, small_queries = self.get_statistics()
+        for i in range(5):
+            self.add_pharmacy(f'Аптека {i}', ['full', 'half', 'sick'])
+        _, large_queries = self.get_statistics()
+        self.assertEqual(small_queries, large_queries)
+
+
+class ReportDataFormatTests(TestCase):
+    """Компактный формат AJAX-ответов (format=data)"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.employee = UserProfile.objects.create(
+            user=User.objects.create(username='employee'), full_name='Сотрудник', pharmacy=self.pharmacy
+        )
+        self.day = date(BENCH_YEAR, 6, 2)  # понедельник
+        Attendance.objects.create(user=self.employee, date=self.day, status='sick')
+        leader = User.objects.create(username='leader')
+        UserProfile.objects.create(user=leader, full_name='Руководитель', is_leader=True)
+        self.client.force_login(leader)
+
+    def test_timesheet_codes_and_calendar_mask(self):
+        params = {'pharmacy': self.pharmacy.id, 'year': BENCH_YEAR, 'month': 6, 'period_type': 'year'}
+        html = self.client.post('/leader/timesheet-report/ajax/', params, **XHR)
+        data = self.client.post('/leader/timesheet-report/ajax/', dict(params, format='data'), **XHR)
+        self.assertLess(len(data.content) * 5, len(html.content))
+
+        timesheet = data.json()['timesheet']
+        self.assertEqual(timesheet['employees'], [['Сотрудник', False]])
+        june = timesheet['months'][5]
+        self.assertEqual(len(june['mask']), 30)
+        self.assertEqual(june['mask'][self.day.day - 1], '0')
+        self.assertEqual(june['codes'][0][self.day.day - 1], str(timesheet['status_codes']['sick']))
+
+    def test_leader_statistics_rows(self):
+        params = {'pharmacy': self.pharmacy.id, 'start_date': self.day, 'end_date': self.day, 'format': 'data'}
+        data = self.client.get('/leader/statistics/ajax/', params, **XHR).json()
+        self.assertEqual(data['total_working_days'], 1)
+        self.assertEqual(data['statuses'], ['full', 'half', 'vacation', 'sick'])
+        self.assertEqual(data['employees'], [['Сотрудник', False, 0, 0, 0, 1]])
+
+
+class ExportTests(TestCase):
+    """Потоковая выгрузка табеля и статистики"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.employee = UserProfile.objects.create(
+            user=User.objects.create(username='employee'), full_name='Сотрудник', pharmacy=self.pharmacy
+        )
+        self.manager = UserProfile.objects.create(
+            user=User.objects.create(username='manager'), full_name='Заведующий',
+            pharmacy=self.pharmacy, is_manager=True
+        )
+        self.day = date(BENCH_YEAR, 6, 2)  # понедельник
+        Attendance.objects.create(user=self.employee, date=self.day, status='full')
+        Attendance.objects.create(user=self.employee, date=self.day + timedelta(days=1), status='sick')
+
+    def read_csv(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertTrue(content.startswith('﻿'))
+        return [line.split(';') for line in content[1:].splitlines()]
+
+    def test_manager_timesheet_csv(self):
+        self.client.force_login(self.manager.user)
+        response = self.client.get('/export/timesheet/', {'year': BENCH_YEAR, 'month': 6})
+        self.assertIn(f'timesheet_pharmacy_{self.pharmacy.id}_{BENCH_YEAR}_06.csv', response['Content-Disposition'])
+
+        header, *rows = self.read_csv(response)
+        self.assertEqual(header[:4], ['Аптека', 'Сотрудник', 'Месяц', '1'])
+        employee_row = next(row for row in rows if row[1] == 'Сотрудник')
+        self.assertEqual(employee_row[4:6], ['Я', 'Б'])
+        self.assertEqual(employee_row[-2], '2')
+
+    def test_leader_statistics_csv_for_all_pharmacies(self):
+        leader = User.objects.create(username='leader')
+        UserProfile.objects.create(user=leader, full_name='Руководитель', is_leader=True)
+        self.client.force_login(leader)
+
+        response = self.client.get('/export/statistics/', {'start_date': self.day, 'end_date': self.day})
+        header, *rows = self.read_csv(response)
+        self.assertEqual(len(header), len(rows[0]))
+        self.assertEqual(sorted(row[1] for row in rows), ['Заведующий', 'Сотрудник'])
+
+    @skipUnless(Workbook, 'не установлен openpyxl')
+    def test_manager_timesheet_xlsx(self):
+        from openpyxl import load_workbook
+
+        self.client.force_login(self.manager.user)
+        response = self.client.get('/export/timesheet/', {'year': BENCH_YEAR, 'month': 6, 'format': 'xlsx'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'timesheet_pharmacy_{self.pharmacy.id}_{BENCH_YEAR}_06.xlsx', response['Content-Disposition'])
+
+        sheet = load_workbook(BytesIO(b''.join(response.streaming_content)), read_only=True).active
+        header, *rows = sheet.iter_rows(values_only=True)
+        self.assertEqual(header[:4], ('Аптека', 'Сотрудник', 'Месяц', '1'))
+        employee_row = next(row for row in rows if row[1] == 'Сотрудник')
+        self.assertEqual(employee_row[4:6], ('Я', 'Б'))
+        self.assertEqual(employee_row[-2], 2)
+
+    @mock.patch('kadr.exports.EXPORT_CHUNK_SIZE', 1)
+    def test_chunked_export_keeps_order(self):
+        branch = create_pharmacy('Филиал', self.pharmacy)
+        UserProfile.objects.create(
+            user=User.objects.create(username='branch'), full_name='Сотрудник филиала', pharmacy=branch
+        )
+        rows = list(statistics_rows(None, self.day, self.day))[1:]
+        self.assertEqual(
+            [row[:2] for row in rows],
+            [['Аптека', 'Сотрудник'], ['Аптека', 'Заведующий'], ['Филиал', 'Сотрудник филиала']]
+        )
+
+    def test_employee_has_no_access(self):
+        self.client.force_login(self.employee.user)
+        response = self.client.get('/export/timesheet/')
+        self.assertRedirects(response, '/access-denied/', fetch_redirect_response=False)
+
+    def test_manager_without_pharmacy_has_no_access(self):
+        manager = create_employee('manager_without_pharmacy', None, 'Заведующий', is_manager=True)
+        self.client.force_login(manager.user)
+        response = self.client.get('/export/statistics/', {'start_date': self.day, 'end_date': self.day})
+        self.assertRedirects(response, '/access-denied/', fetch_redirect_response=False)
+
+    def test_unknown_pharmacy_is_not_found(self):
+        leader = create_employee('leader', None, 'Руководитель', is_leader=True)
+        self.client.force_login(leader.user)
+        for pharmacy_id in ('abc', self.pharmacy.id + 100):
+            response = self.client.get('/export/timesheet/', {'year': BENCH_YEAR, 'month': 6, 'pharmacy': pharmacy_id})
+            self.assertEqual(response.status_code, 404)
+
+
+class ReportJobTests(TestCase):
+    """Фоновые отчеты: постановка, выполнение обработчиком и повторное использование"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.employee = UserProfile.objects.create(
+            user=User.objects.create(username='employee'), full_name='Сотрудник', pharmacy=self.pharmacy
+        )
+        Attendance.objects.create(user=self.employee, date=date(BENCH_YEAR, 6, 2), status='full')
+        self.leader = User.objects.create(username='leader')
+        UserProfile.objects.create(user=self.leader, full_name='Руководитель', is_leader=True)
+        self.params = {'year': BENCH_YEAR, 'month': 6, 'period_type': 'month', 'pharmacy': '', 'format': 'csv'}
+
+    def submit(self, **params):
+        response = self.client.post('/leader/reports/', dict(self.params, **params))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_job_lifecycle_and_reuse(self):
+        self.client.force_login(self.leader)
+        job = self.submit()
+        self.assertEqual(job['status'], ReportJob.PENDING)
+        # Тот же отчет до выполнения - то же задание
+        self.assertEqual(self.submit()['job_id'], job['job_id'])
+
+        call_command('run_report_jobs', workers=0, once=True, stdout=StringIO())
+        status = self.client.get(job['status_url']).json()
+        self.assertEqual(status['status'], ReportJob.DONE)
+        response = self.client.get(status['result_url'])
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertIn('Сотрудник', response.content.decode('utf-8'))
+
+        # Готовый результат выдается повторно, пока данные аптеки не менялись
+        self.assertEqual(self.submit()['job_id'], job['job_id'])
+        with self.captureOnCommitCallbacks(execute=True):
+            upsert_attendances([(self.employee.id, date(BENCH_YEAR, 6, 3), 'sick')])
+        self.assertNotEqual(self.submit()['job_id'], job['job_id'])
+
+    def test_html_for_all_pharmacies(self):
+        branch = create_pharmacy('Филиал', self.pharmacy)
+        self.client.force_login(self.leader)
+        job = self.submit(format='html', period_type='year')
+        call_command('run_report_jobs', workers=0, once=True, stdout=StringIO())
+        html = self.client.get(self.client.get(job['status_url']).json()['result_url']).content.decode('utf-8')
+        self.assertIn(self.pharmacy.name, html)
+        self.assertIn(branch.name, html)
+
+    def test_invalid_params_and_access(self):
+        self.client.force_login(self.leader)
+        with self.assertLogs('kadr.views', level='WARNING'):
+            response = self.client.post('/leader/reports/', dict(self.params, month=13))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Некорректные параметры отчета')
+
+        self.client.force_login(self.employee.user)
+        self.assertEqual(self.client.post('/leader/reports/', self.params).status_code, 403)
+        self.assertFalse(ReportJob.objects.exists())
+
+    def test_failed_job_error_is_logged_not_returned(self):
+        self.client.force_login(self.leader)
+        job = self.submit()
+        with mock.patch('kadr.jobs.csv_stream', side_effect=RuntimeError('секрет базы')), \
+                self.assertLogs('kadr.jobs', level='ERROR'):
+            call_command('run_report_jobs', workers=0, once=True, stdout=StringIO())
+        status = self.client.get(job['status_url']).json()
+        self.assertEqual(status['status'], ReportJob.FAILED)
+        self.assertEqual(status['error'], 'Не удалось построить отчет')
+        self.assertNotIn('секрет', ReportJob.objects.get(id=job['job_id']).error)
+
+    def test_jobs_are_visible_to_their_owner_only(self):
+        self.client.force_login(self.leader)
+        job = self.submit()
+        call_command('run_report_jobs', workers=0, once=True, stdout=StringIO())
+        result_url = self.client.get(job['status_url']).json()['result_url']
+
+        other = User.objects.create(username='other_leader')
+        UserProfile.objects.create(user=other, full_name='Другой руководитель', is_leader=True)
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(job['status_url']).status_code, 404)
+        self.assertEqual(self.client.get(result_url).status_code, 404)
+        # Готовое задание другого пользователя не переиспользуется
+        self.assertNotEqual(self.submit()['job_id'], job['job_id'])
+
+    @override_settings(KADR_REPORT_BACKGROUND_COST=0)
+    def test_heavy_ajax_reports_go_to_background(self):
+        self.client.force_login(self.leader)
+        response = self.client.get('/leader/statistics/ajax/', {
+            'start_date': f'{BENCH_YEAR}-01-01', 'end_date': f'{BENCH_YEAR}-12-31'
+        }, **XHR)
+        statistics_job = response.json()
+        self.assertTrue(statistics_job['background'])
+        self.assertFalse(response.has_header('ETag'))
+
+        timesheet_job = self.client.post('/leader/timesheet-report/ajax/', {
+            'pharmacy': self.pharmacy.id, 'year': BENCH_YEAR, 'month': 6, 'period_type': 'year', 'format': 'data'
+        }, **XHR).json()
+        self.assertTrue(timesheet_job['background'])
+        self.assertEqual(ReportJob.objects.filter(user=self.leader).count(), 2)
+
+        # Результаты в формате обычного ответа: HTML статистики и данные табеля
+        call_command('run_report_jobs', workers=0, once=True, stdout=StringIO())
+        result_url = self.client.get(statistics_job['status_url']).json()['result_url']
+        self.assertIn(self.pharmacy.name, self.client.get(result_url).content.decode('utf-8'))
+        result_url = self.client.get(timesheet_job['status_url']).json()['result_url']
+        data = self.client.get(result_url).json()
+        self.assertEqual(data['timesheets'][0]['employees'], [['Сотрудник', False]])
+
+
+class ReportAdmissionTests(TestCase):
+    """Допуск отчетов за произвольный период: по дням, по агрегатам или отказ"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.employee = UserProfile.objects.create(
+            user=User.objects.create(username='employee'), full_name='Сотрудник', pharmacy=self.pharmacy
+        )
+        Attendance.objects.bulk_create([
+            Attendance(user=self.employee, date=date(BENCH_YEAR - 1, 1, 1) + timedelta(days=offset), status=status)
+            for offset, status in zip(range(0, 700, 3), ['full', 'half', 'vacation', 'sick'] * 100)
+        ])
+        rebuild_attendance_rollup()
+        self.leader = User.objects.create(username='leader')
+        UserProfile.objects.create(user=self.leader, full_name='Руководитель', is_leader=True)
+        self.period = {'start_date': f'{BENCH_YEAR - 1}-01-15', 'end_date': f'{BENCH_YEAR}-11-20'}
+
+    def employee_stat(self):
+        response = self.client.get('/employee-statistics/', self.period)
+        self.assertEqual(response.status_code, 200)
+        return response.context['employee_stats'][0]
+
+    def test_expensive_period_uses_aggregates(self):
+        self.client.force_login(self.employee.user)
+        inline = self.employee_stat()
+        self.assertFalse(inline['aggregated'])
+        with override_settings(KADR_REPORT_INLINE_COST=100):
+            aggregated = self.employee_stat()
+        self.assertTrue(aggregated['aggregated'])
+        self.assertEqual(aggregated['attendances'], [])
+        self.assertEqual(aggregated['status_counts'], inline['status_counts'])
+
+    def test_too_long_period_is_rejected(self):
+        self.client.force_login(self.leader)
+        period = {'start_date': '1900-01-01', 'end_date': '2100-12-31'}
+        self.assertEqual(self.client.get('/leader-statistics/', period).status_code, 400)
+        response = self.client.get(
+            '/leader/statistics/ajax/', period, headers={'x-requested-with': 'XMLHttpRequest'}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json()['success'])
+        self.assertIn('error', response.json())
+
+        # Дорогой отчет по сети отклоняется по стоимости, а не по длине периода
+        with override_settings(KADR_REPORT_MAX_COST=100):
+            self.assertEqual(self.client.get('/leader-statistics/', self.period).status_code, 400)
+        self.assertEqual(self.client.get('/leader-statistics/', self.period).status_code, 200)
+
+    def test_period_at_calendar_end(self):
+        self.client.force_login(self.employee.user)
+        response = self.client.get('/employee-statistics/', {'start_date': '9999-12-01', 'end_date': '9999-12-31'})
+        self.assertEqual(response.status_code, 200)
+
+
+class AttendanceStorageTests(TestCase):
+    """Помесячное хранение посещаемости и перенос между режимами"""
+
+    def setUp(self):
+        clear_caches()
+        self.pharmacy = create_pharmacy()
+        self.profiles = [
+            UserProfile.objects.create(
+                user=User.objects.create(username=f'employee_{i}'), full_name=f'Сотрудник {i}', pharmacy=self.pharmacy
+            )
+            for i in range(2)
+        ]
+        self.first_day = date(BENCH_YEAR, 5, 20)
+        self.last_day = date(BENCH_YEAR, 6, 10)
+        rng = random.Random(1)
+        upsert_attendances([
+            (profile.id, self.first_day + timedelta(days=offset), rng.choice(['', 'full', 'half', 'sick']))
+            for profile in self.profiles
+            for offset in range(0, (self.last_day - self.first_day).days + 1, 2)
+        ])
+
+    def snapshot(self):
+        return (
+            read_codes(self.first_day, self.last_day, user__pharmacy=self.pharmacy),
+            get_status_counts(UserProfile.objects.all(), date(BENCH_YEAR, 5, 25), self.last_day),
+            [
+                [[cell['status'] for cell in row['daily_status']] for row in month['employees']]
+                for month in build_year_timesheet(self.pharmacy, BENCH_YEAR, 6)
+            ],
+        )
+
+    def test_reports_match_after_round_trip(self):
+        rows = sorted(Attendance.objects.values_list('user_id', 'date', 'status'))
+        daily = self.snapshot()
+
+        self.assertEqual(convert_storage(MONTHLY), 4)  # 2 сотрудника x 2 месяца
+        self.assertFalse(Attendance.objects.exists())
+        with override_settings(KADR_ATTENDANCE_STORAGE=MONTHLY):
+            self.assertEqual(self.snapshot(), daily)
+
+        convert_storage(DAILY)
+        self.assertFalse(AttendanceMonth.objects.exists())
+        self.assertEqual(sorted(Attendance.objects.values_list('user_id', 'date', 'status')), rows)
+
+    @override_settings(KADR_ATTENDANCE_STORAGE=MONTHLY)
+    def test_monthly_writes(self):
+        convert_storage(MONTHLY)
+        profile = self.profiles[0]
+        day = date(BENCH_YEAR, 6, 3)  # вторник, записи еще нет
+
+        with self.captureOnCommitCallbacks(execute=True):
+            open_attendance_day(self.profiles, day)
+            _, created = save_attendance_status(profile.id, day, 'vacation')
+        self.assertFalse(created)
+        self.assertEqual(read_day(day, user__pharmacy=self.pharmacy), {profile.id: 'vacation', self.profiles[1].id: ''})
+
+        # Открытие дня не затирает сохраненные статусы
+        open_attendance_day(self.profiles, day)
+        self.assertEqual(read_day(day, user_id=profile.id), {profile.id: 'vacation'})
+        self.assertEqual(AttendanceMonth.objects.filter(user=profile).count(), 2)
+        self.assertTrue(AttendanceRollup.objects.filter(
+            user=profile, month=date(BENCH_YEAR, 6, 1), status='vacation', working_days_count=1
+        ).exists())
+
+    def test_benchmark_command_keeps_data(self):
+        rows_count = Attendance.objects.count()
+        output = StringIO()
+        call_command('benchmark_attendance_storage', year=BENCH_YEAR, repeat=1, stdout=output)
+        self.assertIn('monthly', output.getvalue())
+        self.assertEqual(Attendance.objects.count(), rows_count)
+        self.assertFalse(AttendanceMonth.objects.exists())
+
+    def test_numpy_aggregation_matches_python(self):
+        codes = read_codes(self.first_day, self.last_day)
+        day_types = period_day_types(self.first_day, self.last_day)
+        rows = list(Attendance.objects.values_list('user_id', 'date', 'status'))
+        results = []
+        for enabled in (True, False):
+            with override_settings(KADR_NUMPY_AGGREGATION=enabled):
+                results.append((
+                    count_working_codes(codes, day_types),
+                    count_working_codes(codes, day_types, {user_id: 'all' for user_id in codes}),
+                    dict(count_monthly_rows(rows)),
+                ))
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(results[0][2])
+
+
+def query_plans(queries, table):
+    """Планы SQLite (EXPLAIN QUERY PLAN) выполненных запросов к таблице"""
+    plans = []
+    with connection.cursor() as cursor:
+        for query in queries:
+            if f'FROM "{table}"' in query['sql']:
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                plans.append(' | '.join(row[-1] for row in cursor.fetchall()))
+    return plans
+
+
+class AttendancePharmacyTests(TestCase):
+    """Аптека записи посещаемости и индексы отчетов"""
+
+    def setUp(self):
+        clear_caches()
+        self.old_pharmacy = create_pharmacy('Аптека 1')
+        self.new_pharmacy = create_pharmacy('Аптека 2')
+        self.employee = UserProfile.objects.create(
+            user=User.objects.create(username='employee'), full_name='Сотрудник', pharmacy=self.old_pharmacy
+        )
+        self.old_day = date(BENCH_YEAR, 6, 2)
+        self.new_day = date(BENCH_YEAR, 6, 3)
+        upsert_attendances([(self.employee.id, self.old_day, 'full')])
+        self.employee.pharmacy = self.new_pharmacy
+        self.employee.save()
+        upsert_attendances([(self.employee.id, self.new_day, 'sick')])
+
+    def test_transfer_keeps_past_days_in_old_pharmacy(self):
+        self.assertEqual(
+            dict(Attendance.objects.values_list('date', 'pharmacy_id')),
+            {self.old_day: self.old_pharmacy.id, self.new_day: self.new_pharmacy.id}
+        )
+        # Исправление прошлого дня не переносит его в новую аптеку
+        upsert_attendances([(self.employee.id, self.old_day, 'half')])
+        self.assertEqual(Attendance.objects.get(date=self.old_day).pharmacy, self.old_pharmacy)
+
+        matrix = TimesheetMatrix([self.old_pharmacy, self.new_pharmacy], self.old_day, self.new_day)
+        for pharmacy, codes in ((self.old_pharmacy, [3, 0]), (self.new_pharmacy, [0, 5])):
+            self.assertEqual(matrix.get_employees(pharmacy), [self.employee])
+            self.assertEqual(list(matrix.employee_codes(pharmacy, self.employee)), codes)
+
+    def test_transfer_keeps_past_days_in_old_pharmacy_counts(self):
+        expected = {
+            self.old_pharmacy.id: dict(dict.fromkeys(FILLED_STATUSES, 0), full=1),
+            self.new_pharmacy.id: dict(dict.fromkeys(FILLED_STATUSES, 0), sick=1),
+        }
+        self.assertEqual(
+            set(AttendanceRollup.objects.values_list('pharmacy_id', 'status')),
+            {(self.old_pharmacy.id, 'full'), (self.new_pharmacy.id, 'sick')}
+        )
+        month_end = date(BENCH_YEAR, 6, 30)
+        # Неполный месяц - по посещаемости, полный - по сводке (и после ее пересборки)
+        self.assertEqual(get_pharmacy_status_counts(self.old_day, self.new_day), expected)
+        self.assertEqual(get_pharmacy_status_counts(self.old_day.replace(day=1), month_end), expected)
+        rebuild_attendance_rollup()
+        self.assertEqual(get_pharmacy_status_counts(self.old_day.replace(day=1), month_end), expected)
+
+        statistics = list(statistics_rows([self.old_pharmacy.id, self.new_pharmacy.id], self.old_day, month_end))
+        self.assertEqual(
+            [row[:2] + row[3:3 + len(FILLED_STATUSES)] for row in statistics[1:]],
+            [['Аптека 1', 'Сотрудник', 1, 0, 0, 0], ['Аптека 2', 'Сотрудник', 0, 0, 0, 1]]
+        )
+        timesheet = list(timesheet_rows([self.old_pharmacy.id, self.new_pharmacy.id], BENCH_YEAR, [6]))
+        self.assertEqual(
+            [row[:2] + row[4:6] for row in timesheet[1:]],
+            [['Аптека 1', 'Сотрудник', 'Я', ''], ['Аптека 2', 'Сотрудник', '', 'Б']]
+        )
+
+    def test_transfer_keeps_past_days_in_old_pharmacy_statistics(self):
+        def counts(**statuses):
+            return dict(dict.fromkeys(FILLED_STATUSES, 0), **statuses)
+
+        def manager_counts(**statuses):
+            # Счетчики статистики заведующего включают пустой статус
+            return dict(counts(**statuses), **{'': 0})
+
+        params = {'start_date': self.old_day, 'end_date': self.new_day}
+        manager = create_employee('manager', self.old_pharmacy, full_name='Заведующий', is_manager=True)
+        self.client.force_login(manager.user)
+        response = self.client.get('/statistics/', params)
+        [old_stats] = response.context['pharmacy_stats']
+        self.assertEqual(
+            [(stat['employee'], stat['status_counts']) for stat in old_stats['employee_stats']],
+            [(self.employee, manager_counts(full=1)), (manager, manager_counts())]
+        )
+        self.assertEqual(response.context['total_stats'], manager_counts(full=1))
+
+        leader = create_employee('leader', None, full_name='Руководитель', is_leader=True)
+        self.client.force_login(leader.user)
+        for pharmacy, expected in ((self.old_pharmacy, counts(full=1)), (self.new_pharmacy, counts(sick=1))):
+            response = self.client.get('/leader-statistics/', dict(params, pharmacy=pharmacy.id))
+            self.assertEqual(
+                [(stat['employee'], stat['status_counts']) for stat in response.context['employee_stats']
+                 if stat['employee'] == self.employee],
+                [(self.employee, expected)]
+            )
+            self.assertEqual(response.context['pharmacy_stats']['status_counts'], expected)
+
+    @override_settings(KADR_ATTENDANCE_STORAGE=MONTHLY)
+    def test_monthly_storage_counts_by_month_pharmacy(self):
+        convert_storage(MONTHLY)
+        # При помесячном хранении месяц относится к аптеке его первой записи
+        self.assertEqual(
+            get_pharmacy_status_counts(self.old_day, self.new_day),
+            {self.old_pharmacy.id: dict(dict.fromkeys(FILLED_STATUSES, 0), full=1, sick=1)}
+        )
+
+    @skipUnless(connection.vendor == 'sqlite', 'планы запросов SQLite')
+    def test_report_queries_use_indexes(self):
+        with CaptureQueriesContext(connection) as context:
+            TimesheetMatrix([self.old_pharmacy], self.old_day, self.new_day)
+        self.assertIn('kadr_att_pharmacy_date_idx', query_plans(context.captured_queries, 'kadr_attendance')[0])
+
+        with CaptureQueriesContext(connection) as context:
+            get_pharmacy_status_counts(self.old_day, self.new_day)
+        self.assertIn('kadr_att_date_status_idx', query_plans(context.captured_queries, 'kadr_attendance')[0])
@@ -0,0 +1,164 @@
+from datetime import date
+from calendar import monthrange
+from django.db.models import Q
+from .models import UserProfile
+from .storage import CODE_NONE, CODE_STATUSES, read_codes
+from .utils import get_calendar, DAY_WEEKEND, DAY_HOLIDAY
+
+MONTH_NAMES = {
+    1: 'Январь', 2: 'Февраль', 3: 'Март', 4: 'Апрель',
+    5: 'Май', 6: 'Июнь', 7: 'Июль', 8: 'Август',
+    9: 'Сентябрь', 10: 'Октябрь', 11: 'Ноябрь', 12: 'Декабрь'
+}
+
+# Общие (неизменяемые) ячейки табеля, на которые ссылаются строки всех сотрудников
+WORKING_CELLS = {
+    code: {'status': status, 'is_working': True, 'is_weekend': False, 'is_holiday': False}
+    for code, status in CODE_STATUSES.items()
+}
+NON_WORKING_CELLS = {
+    day_flags: {
+        'status': 'weekend' if day_flags & DAY_WEEKEND else 'holiday',
+        'is_working': False,
+        'is_weekend': bool(day_flags & DAY_WEEKEND),
+        'is_holiday': bool(day_flags & DAY_HOLIDAY),
+    }
+    for day_flags in (DAY_WEEKEND, DAY_HOLIDAY, DAY_WEEKEND | DAY_HOLIDAY)
+}
+
+
+def month_bounds(year, month):
+    """Первый и последний день месяца"""
+    return date(year, month, 1), date(year, month, monthrange(year, month)[1])
+
+
+def month_day_types(year, month):
+    """Вектор типов дней месяца (0 - рабочий, иначе флаги выходного/праздника)"""
+    calendar = get_calendar(year)
+    first_day, last_day = month_bounds(year, month)
+    start = calendar.day_index(first_day)
+    return calendar.flags[start:start + last_day.day]
+
+
+def period_day_types(start_date, end_date):
+    """Вектор типов дней произвольного периода (как month_day_types)"""
+    day_types = bytearray()
+    for year in range(start_date.year, end_date.year + 1):
+        calendar = get_calendar(year)
+        start = calendar.day_index(max(start_date, date(year, 1, 1)))
+        end = calendar.day_index(min(end_date, date(year, 12, 31))) + 1
+        day_types += calendar.flags[start:end]
+    return day_types
+
+
+def group_employees_by_pharmacy(pharmacy_ids, recorded_keys):
+    """Сотрудники аптек отчета: {id аптеки: [сотрудники в порядке табеля]}.
+
+    recorded_keys - пары (id аптеки записи, id профиля), у которых есть
+    записи за период. В аптеке - ее текущие сотрудники и переведенные,
+    у которых есть в ней записи; сотрудники читаются одним запросом.
+    """
+    recorded_pharmacies = {}
+    for pharmacy_id, user_id in recorded_keys:
+        recorded_pharmacies.setdefault(user_id, set()).add(pharmacy_id)
+
+    employees_by_pharmacy = {}
+    employees = UserProfile.objects.filter(
+        Q(pharmacy__in=pharmacy_ids) | Q(id__in=list(recorded_pharmacies))
+    ).order_by('user__last_name', 'id')
+    for employee in employees:
+        employee_pharmacies = recorded_pharmacies.get(employee.id, set())
+        if employee.pharmacy_id in pharmacy_ids:
+            employee_pharmacies = employee_pharmacies | {employee.pharmacy_id}
+        for pharmacy_id in employee_pharmacies:
+            employees_by_pharmacy.setdefault(pharmacy_id, []).append(employee)
+    return employees_by_pharmacy
+
+
+class TimesheetMatrix:
+    """Табель набора аптек за период.
+
+    Посещаемость и сотрудники загружаются двумя запросами на весь блок
+    аптек и дат (посещаемость - через kadr.storage в любом режиме хранения),
+    а статусы хранятся компактно: по одному байту-коду на день.
+
+    Дни относятся к аптеке записи (Attendance.pharmacy): в табеле аптеки
+    есть ее текущие сотрудники и переведенные, у которых есть дни в этой
+    аптеке за период, - каждый только с днями, отработанными в ней.
+    """
+
+    def __init__(self, pharmacies, first_day, last_day):
+        self.first_day = first_day
+        self.last_day = last_day
+        self.empty_codes = bytes((last_day - first_day).days + 1)
+        pharmacy_ids = {pharmacy.id for pharmacy in pharmacies}
+
+        # {(id аптеки, id профиля): коды}
+        self.codes = read_codes(first_day, last_day, by_pharmacy=True, pharmacy__in=pharmacy_ids)
+        self.employees_by_pharmacy = group_employees_by_pharmacy(pharmacy_ids, self.codes)
+
+    def employee_codes(self, pharmacy, employee):
+        """Коды статусов сотрудника за период по дням в данной аптеке"""
+        return self.codes.get((pharmacy.id, employee.id), self.empty_codes)
+
+    def get_employees(self, pharmacy):
+        """Сотрудники аптеки в порядке табеля"""
+        return self.employees_by_pharmacy.get(pharmacy.id if pharmacy else None, [])
+
+    def month_rows(self, pharmacy, year, month):
+        """Строки табеля сотрудников аптеки за месяц"""
+        first_day, last_day = month_bounds(year, month)
+        day_types = month_day_types(year, month)
+        total_working_days = day_types.count(0)
+        start = (first_day - self.first_day).days
+        end = start + last_day.day
+
+        rows = []
+        for employee in self.get_employees(pharmacy):
+            codes = self.employee_codes(pharmacy, employee)[start:end]
+            daily_status = [
+                NON_WORKING_CELLS[day_flags] if day_flags else WORKING_CELLS[code]
+                for code, day_flags in zip(codes, day_types)
+            ]
+            filled_working_days = sum(
+                1 for code, day_flags in zip(codes, day_types)
+                if not day_flags and code != CODE_NONE
+            )
+            rows.append({
+                'employee': employee,
+                'daily_status': daily_status,
+                'total_days': last_day.day,
+                'total_working_days': total_working_days,
+                'filled_working_days': filled_working_days,
+                'attendance_percentage': (filled_working_days / total_working_days * 100) if total_working_days > 0 else 0
+            })
+        return rows
+
+
+def build_year_timesheet(pharmacy, year, last_month=12, matrix=None):
+    """Табель аптеки за год по месяцам (с января по last_month).
+
+    Состав и посещаемость за весь период загружаются одним проходом
+    и раскладываются по месяцам в памяти; matrix - уже загруженный
+    TimesheetMatrix за этот период, общий для нескольких аптек.
+    """
+    first_day = date(year, 1, 1)
+    last_day = month_bounds(year, last_month)[1]
+    if matrix is None:
+        matrix = TimesheetMatrix([pharmacy], first_day, last_day)
+    calendar = get_calendar(year)
+
+    timesheet_data = []
+    for month in range(1, last_month + 1):
+        working_days, non_working_days = calendar.get_working_days(month)
+        timesheet_data.append({
+            'pharmacy': pharmacy,
+            'is_main': pharmacy.main_pharmacy_id is None,
+            'employees': matrix.month_rows(pharmacy, year, month),
+            'period': f"{MONTH_NAMES[month]} {year}",
+            'month_number': month,
+            'year': year,
+            'working_days_set': set(working_days),
+            'days_in_month': list(range(1, monthrange(year, month)[1] + 1))
+        })
+    return timesheet_data
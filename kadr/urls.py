@@ -13,7 +13,13 @@ urlpatterns = [
     path('leader-statistics/', views.leader_statistics, name='leader_statistics'),
     path('leader/statistics/ajax/', views.leader_statistics_ajax, name='leader_statistics_ajax'),
     path('attendance/ajax/save/', views.save_attendance_ajax, name='save_attendance_ajax'),
+    path('attendance/ajax/save-batch/', views.save_attendance_batch_ajax, name='save_attendance_batch_ajax'),
     path('manager/timesheet/', views.manager_timesheet, name='manager_timesheet'),
     path('leader/timesheet-report/', views.leader_timesheet_report, name='leader_timesheet_report'),
     path('leader/timesheet-report/ajax/', views.leader_timesheet_report_ajax, name='leader_timesheet_report_ajax'),
+    path('leader/reports/', views.report_job_submit, name='report_job_submit'),
+    path('leader/reports/<int:job_id>/', views.report_job_status, name='report_job_status'),
+    path('leader/reports/<int:job_id>/result/', views.report_job_result, name='report_job_result'),
+    path('export/timesheet/', views.timesheet_export, name='timesheet_export'),
+    path('export/statistics/', views.statistics_export, name='statistics_export'),
 ]
\ No newline at end of file
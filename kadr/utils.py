@@ -1,5 +1,7 @@
 from datetime import date, timedelta
-from calendar import monthrange
+from array import array
+from calendar import monthrange, isleap
+from functools import lru_cache
 from dateutil.easter import easter
 from dateutil.relativedelta import relativedelta
 
@@ -43,8 +45,7 @@ class RussianHolidays:
     @staticmethod
     def is_holiday(check_date):
         """Проверяет, является ли дата праздничным днем"""
-        holidays = RussianHolidays.get_holidays(check_date.year)
-        return check_date in holidays
+        return get_calendar(check_date.year).is_holiday(check_date)
     
     @staticmethod
     def is_weekend(check_date):
@@ -54,26 +55,122 @@ class RussianHolidays:
     @staticmethod
     def is_working_day(check_date):
         """Проверяет, является ли дата рабочим днем"""
-        return not (RussianHolidays.is_weekend(check_date) or RussianHolidays.is_holiday(check_date))
+        return get_calendar(check_date.year).is_working_day(check_date)
+
+
+# Флаги дня в битовой карте производственного календаря
+DAY_WEEKEND = 1
+DAY_HOLIDAY = 2
+
+
+class ProductionCalendar:
+    """Скомпилированный производственный календарь на один год.
+
+    Хранит битовую карту дней года (выходной/праздник) и префиксные суммы
+    рабочих дней, поэтому проверка дня и подсчет рабочих дней в диапазоне
+    выполняются за O(1).
+    """
+
+    def __init__(self, year):
+        self.year = year
+        self.first_ordinal = date(year, 1, 1).toordinal()
+        self.days_count = 366 if isleap(year) else 365
+
+        holidays = set(RussianHolidays.get_holidays(year))
+        self.holiday_dates = sorted(holidays)
+
+        # flags[i] - флаги i-го дня года (0 - рабочий день)
+        self.flags = bytearray(self.days_count)
+        # prefix[i] - количество рабочих дней среди первых i дней года
+        self.prefix = array('H', [0]) * (self.days_count + 1)
+
+        # Праздники - по номерам дней года (без перебора дат, чтобы не выйти за 31.12.9999)
+        holiday_indexes = {holiday.toordinal() - self.first_ordinal for holiday in holidays}
+        weekday = date(year, 1, 1).weekday()
+        for index in range(self.days_count):
+            day_flags = 0
+            if weekday in (5, 6):
+                day_flags |= DAY_WEEKEND
+            if index in holiday_indexes:
+                day_flags |= DAY_HOLIDAY
+            self.flags[index] = day_flags
+            self.prefix[index + 1] = self.prefix[index] + (0 if day_flags else 1)
+            weekday = (weekday + 1) % 7
+
+        self._months = {}
+
+    def day_index(self, check_date):
+        """Порядковый номер дня в году (с нуля)"""
+        return check_date.toordinal() - self.first_ordinal
+
+    def is_weekend(self, check_date):
+        return bool(self.flags[self.day_index(check_date)] & DAY_WEEKEND)
+
+    def is_holiday(self, check_date):
+        return bool(self.flags[self.day_index(check_date)] & DAY_HOLIDAY)
+
+    def is_working_day(self, check_date):
+        return not self.flags[self.day_index(check_date)]
+
+    def count_working_days(self, start, end):
+        """Количество рабочих дней в диапазоне [start, end] внутри года"""
+        start_index = max(self.day_index(start), 0)
+        end_index = min(self.day_index(end), self.days_count - 1)
+        if start_index > end_index:
+            return 0
+        return self.prefix[end_index + 1] - self.prefix[start_index]
+
+    def get_working_days(self, month):
+        """Рабочие и нерабочие дни месяца (вычисляются один раз на месяц)"""
+        if month not in self._months:
+            offset = date(self.year, month, 1).toordinal() - self.first_ordinal
+            working_days = []
+            non_working_days = []
+            for day in range(1, monthrange(self.year, month)[1] + 1):
+                day_flags = self.flags[offset + day - 1]
+                if not day_flags:
+                    working_days.append(day)
+                else:
+                    non_working_days.append({
+                        'day': day,
+                        'is_weekend': bool(day_flags & DAY_WEEKEND),
+                        'is_holiday': bool(day_flags & DAY_HOLIDAY)
+                    })
+            self._months[month] = (tuple(working_days), tuple(non_working_days))
+        return self._months[month]
+
+
+@lru_cache(maxsize=256)
+def get_calendar(year):
+    """Возвращает скомпилированный календарь года (кэшируется на процесс).
+
+    Размер кэша ограничен: запросы за произвольные годы не раздувают память процесса.
+    """
+    return ProductionCalendar(year)
+
+
+def count_working_days(start, end):
+    """Количество рабочих дней (без выходных и праздников) в диапазоне [start, end]"""
+    if start > end:
+        return 0
+    total = 0
+    for year in range(start.year, end.year + 1):
+        total += get_calendar(year).count_working_days(start, end)
+    return total
+
+
+def get_holiday_dates(start, end):
+    """Список праздничных дней в диапазоне [start, end]"""
+    holiday_dates = []
+    for year in range(start.year, end.year + 1):
+        holiday_dates.extend(
+            holiday for holiday in get_calendar(year).holiday_dates
+            if start <= holiday <= end
+        )
+    return holiday_dates
+
 
 def get_working_days(year, month):
     """Возвращает список рабочих дней для указанного месяца"""
-    first_day = date(year, month, 1)
-    last_day = date(year, month, 1) + relativedelta(months=1) - timedelta(days=1)
-    
-    working_days = []
-    non_working_days = []
-    
-    current_date = first_day
-    while current_date <= last_day:
-        if RussianHolidays.is_working_day(current_date):
-            working_days.append(current_date.day)
-        else:
-            non_working_days.append({
-                'day': current_date.day,
-                'is_weekend': RussianHolidays.is_weekend(current_date),
-                'is_holiday': RussianHolidays.is_holiday(current_date)
-            })
-        current_date += timedelta(days=1)
-    
-    return working_days, non_working_days
\ No newline at end of file
+    working_days, non_working_days = get_calendar(year).get_working_days(month)
+    return list(working_days), [dict(day) for day in non_working_days]
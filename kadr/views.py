@@ -1,22 +1,52 @@
 import json
+import logging
+from django.conf import settings
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.utils import timezone
+from django.db import transaction
 from datetime import date, timedelta, datetime
 from django.db.models import Count, Q, Case, When, IntegerField
-from .models import User, UserProfile,  Pharmacy, Attendance, ATTENDANCE_CHOICES
+from .models import User, UserProfile,  Pharmacy, Attendance, ReportJob, ATTENDANCE_CHOICES
 from .forms import AttendanceForm, DateRangeForm, PharmacySelectForm, LeaderDateRangeForm, MonthYearForm, LeaderTimesheetForm
 from django.utils.timezone import now
-from django.http import JsonResponse
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, JsonResponse, HttpResponseBadRequest
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 from django.utils.decorators import method_decorator
 from calendar import monthrange
 from dateutil.easter import easter
 from dateutil.relativedelta import relativedelta
-from .utils import get_working_days, RussianHolidays
+from .utils import get_working_days, count_working_days
+from .reports import (
+    get_status_counts, get_pharmacy_employee_status_counts, empty_status_counts, collect_employee_statistics,
+    collect_network_statistics, count_network_employees
+)
+from .timesheet import (
+    TimesheetMatrix, build_year_timesheet, group_employees_by_pharmacy, month_bounds, period_day_types, MONTH_NAMES
+)
+from .attendance import get_day_attendances, upsert_attendances, save_attendance_status
+from .writer import WritePending, run_write
+from .storage import encode_digits, read_attendances
+from .aggregation import count_working_codes
+from .fragment_cache import fragment_key, get_fragment, set_fragment
+from .conditional import check_not_modified, conditional_report
+from .profiles import get_request_profile, get_scope_employees, load_profile, role_redirect_url
+from .hierarchy import get_pharmacies_under, subtree_q
+from .exports import export_response, statistics_rows, timesheet_rows
+from .jobs import submit_report_job
+from .admission import AGGREGATED, REJECTED, admit_report, needs_background
+from .report_data import (
+    DATA_FORMAT, wants_data, timesheet_data as build_timesheet_data, period_mask,
+    employee_stats_data, network_stats_data, status_row, statistics_data
+)
 from django.template.loader import render_to_string
+from django.urls import reverse
+
+logger = logging.getLogger('kadr.views')
+
 
 def home(request):
     """Главная страница - перенаправляет аутентифицированных пользователей"""
@@ -42,9 +72,10 @@ def ajax_login(request):
             
             if user is not None:
                 login(request, user)
+                # Сразу отдаем страницу по роли, без промежуточного /redirect/
                 return JsonResponse({
                     'success': True,
-                    'redirect_url': '/redirect/'
+                    'redirect_url': role_redirect_url(load_profile(user))
                 })
             else:
                 return JsonResponse({
@@ -71,7 +102,7 @@ def save_attendance_ajax(request):
         user_id = data.get('user_id')
         status = data.get('status')
         
-        print(f"Received data: user_id={user_id}, status={status}")  # Для отладки
+        logger.debug('Сохранение статуса: user_id=%s, status=%s', user_id, status)
         
         if not all([user_id, status]):
             return JsonResponse({'success': False, 'error': 'Не все данные предоставлены'})
@@ -85,12 +116,18 @@ def save_attendance_ajax(request):
         except UserProfile.DoesNotExist:
             return JsonResponse({'success': False, 'error': 'Профиль пользователя не найден'})
         
-        # Создаем или обновляем запись посещаемости
-        attendance, created = Attendance.objects.update_or_create(
-            user=user_profile,  # Теперь передаем UserProfile
-            date=date,
-            defaults={'status': status}
-        )
+        # Создаем или обновляем запись посещаемости вместе с месячной сводкой
+        # (через поток записи: ответ - после фиксации транзакции)
+        try:
+            attendance, created = run_write(save_attendance_status, user_profile.id, date, status)
+        except WritePending:
+            # Запись уже выполняется и не отменяется - это не ошибка сохранения
+            return JsonResponse({
+                'success': True,
+                'pending': True,
+                'status': status,
+                'status_display': dict(ATTENDANCE_CHOICES).get(status, status),
+            })
         
         return JsonResponse({
             'success': True,
@@ -99,38 +136,116 @@ def save_attendance_ajax(request):
             'created': created
         })
         
-    except Exception as e:
-        print(f"Error in save_attendance_ajax: {e}")  # Для отладки
-        return JsonResponse({'success': False, 'error': str(e)})
+    except Exception:
+        logger.exception('Ошибка сохранения статуса посещаемости')
+        return JsonResponse({'success': False, 'error': 'Не удалось сохранить данные, повторите попытку'})
+
+@require_POST
+@login_required
+def save_attendance_batch_ajax(request):
+    """Пакетное сохранение посещаемости: {"entries": [{"user_id", "date", "status"}, ...]}
+    
+    user_id - id пользователя (как в save_attendance_ajax), date - YYYY-MM-DD
+    (по умолчанию сегодня, не дальше KADR_BATCH_SAVE_DATE_WINDOW дней от сегодня).
+    В пачке не больше KADR_BATCH_SAVE_MAX_ENTRIES строк. Результат возвращается
+    по каждой строке.
+    """
+    try:
+        profile = get_request_profile(request)
+    except UserProfile.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'Доступ запрещен'})
+    if not profile.is_manager or not profile.pharmacy_id:
+        return JsonResponse({'success': False, 'error': 'Доступ запрещен'})
+    
+    try:
+        entries = json.loads(request.body).get('entries')
+    except (ValueError, AttributeError):
+        entries = None
+    if not isinstance(entries, list) or not entries:
+        return JsonResponse({'success': False, 'error': 'Не все данные предоставлены'})
+    if len(entries) > getattr(settings, 'KADR_BATCH_SAVE_MAX_ENTRIES', 500):
+        return JsonResponse({'success': False, 'error': 'Слишком много записей в одном запросе'})
+    
+    # Панель заведующего редактирует только сегодняшний день; окно в несколько
+    # дней покрывает разницу часовых поясов клиента и сервера
+    today = timezone.now().date()
+    date_window = timedelta(days=getattr(settings, 'KADR_BATCH_SAVE_DATE_WINDOW', 1))
+    status_names = dict(ATTENDANCE_CHOICES)
+    
+    # Разбираем строки, ошибки формата фиксируем по каждой строке
+    results = []
+    parsed = []
+    for entry in entries:
+        result = {'user_id': entry.get('user_id') if isinstance(entry, dict) else None, 'success': False}
+        results.append(result)
+        try:
+            user_id = int(entry['user_id'])
+            entry_date = datetime.strptime(entry['date'], '%Y-%m-%d').date() if entry.get('date') else today
+            status = entry['status']
+        except (KeyError, TypeError, ValueError):
+            result['error'] = 'Некорректные данные'
+            continue
+        result['date'] = entry_date.strftime('%Y-%m-%d')
+        if abs(entry_date - today) > date_window:
+            result['error'] = 'Дата недоступна для редактирования'
+            continue
+        if not status or status not in status_names:
+            result['error'] = 'Некорректный статус'
+            continue
+        parsed.append((result, user_id, entry_date, status))
+    
+    # Проверяем сотрудников по аптекам заведующего одним запросом
+    allowed_profiles = dict(
+        UserProfile.objects.filter(
+            user_id__in={user_id for _, user_id, _, _ in parsed}
+        ).filter(
+            subtree_q(profile.pharmacy.path, field='pharmacy__path')
+        ).values_list('user_id', 'id')
+    )
+    
+    to_save = []
+    for result, user_id, entry_date, status in parsed:
+        if user_id not in allowed_profiles:
+            result['error'] = 'Сотрудник не найден в ваших аптеках'
+            continue
+        to_save.append((allowed_profiles[user_id], entry_date, status))
+        result.update({
+            'success': True,
+            'status': status,
+            'status_display': status_names[status]
+        })
+    
+    pending = False
+    try:
+        run_write(upsert_attendances, to_save)
+    except WritePending:
+        # Пачка уже выполняется потоком записи и не отменяется
+        pending = True
+    except Exception:
+        logger.exception('Ошибка пакетного сохранения посещаемости (заведующий %s)', profile.id)
+        return JsonResponse({'success': False, 'error': 'Не удалось сохранить данные, повторите попытку'})
+    
+    return JsonResponse({
+        'success': all(result['success'] for result in results),
+        'saved': len(to_save),
+        'pending': pending,
+        'results': results
+    })
 
 @login_required
 def redirect_based_on_role(request):
     """Перенаправляет пользователя в зависимости от роли"""
     try:
-        # Проверяем, существует ли профиль
-        if not hasattr(request.user, 'userprofile'):
-            return redirect('access_denied')
-            
-        profile = request.user.userprofile
-        
-        # Проверяем роли в порядке приоритета
-        if profile.is_manager:
-            return redirect('manager_dashboard')
-        elif profile.is_leader:
-            return redirect('leader_statistics')
-        else:
-            # Все остальные - обычные сотрудники
-            return redirect('statistics_employee')
-            
-    except Exception as e:
-        # Логируем ошибку для debugging
-        print(f"Redirect error: {e}")
-        return redirect('access_denied')
+        # Профиль уже загружен (request.kadr_profile); без профиля - отказ в доступе
+        profile = get_request_profile(request)
+    except UserProfile.DoesNotExist:
+        profile = None
+    return redirect(role_redirect_url(profile))
 
 @login_required
 def manager_dashboard(request):
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = get_request_profile(request)
         if not profile.is_manager:
             return redirect('access_denied')
         
@@ -138,25 +253,14 @@ def manager_dashboard(request):
         
         # Получаем все аптеки: основная и все подчиненные
         main_pharmacy = profile.pharmacy
-        branch_pharmacies = Pharmacy.objects.filter(main_pharmacy=main_pharmacy)
-        all_pharmacies = [main_pharmacy] + list(branch_pharmacies)
-        
-        # Получаем всех сотрудников всех аптек
-        employees = UserProfile.objects.filter(pharmacy__in=all_pharmacies)
-        
-        # Создаем или получаем записи посещаемости на сегодня с ПУСТЫМ статусом
-        for employee in employees:
-            Attendance.objects.get_or_create(
-                user=employee,
-                date=today,
-                defaults={'status': ''}  # Пустой статус по умолчанию
-            )
+        all_pharmacies = [main_pharmacy] + profile.branch_pharmacies
+        
+        # Получаем всех сотрудников всех аптек вместе с пользователями и аптеками
+        employees = list(get_scope_employees(profile).select_related('user', 'pharmacy'))
         
-        # Получаем актуальные данные на сегодня
-        attendances = Attendance.objects.filter(
-            user__in=employees,
-            date=today
-        ).select_related('user', 'user__pharmacy')
+        # Записи посещаемости на сегодня: недостающие пустые записи создаются
+        # одним запросом (или не создаются вовсе в режиме виртуальных строк)
+        attendances = get_day_attendances(employees, today)
         
         # Группируем сотрудников по аптекам
         pharmacy_groups = {}
@@ -181,25 +285,31 @@ def manager_dashboard(request):
         if request.method == 'POST':
             if 'save_status' in request.POST:
                 user_id = request.POST.get('user_id')
+                # Статус сохраняется только сотрудникам аптек заведующего
+                if user_id not in {str(employee.id) for employee in employees}:
+                    logger.warning('Сотрудник вне аптек заведующего: user_id=%s', user_id)
+                    return redirect('access_denied')
                 try:
-                    attendance = Attendance.objects.get(
-                        user_id=user_id,
-                        date=today
-                    )
+                    # Форма только проверяет статус, запись сохраняет save_attendance_status
+                    attendance = Attendance(user_id=user_id, date=today)
                     form = AttendanceForm(request.POST, instance=attendance, prefix=user_id)
                     if form.is_valid():
-                        form.save()
-                        print(f"Status saved for user {user_id}: {form.cleaned_data['status']}")
+                        try:
+                            run_write(save_attendance_status, attendance.user_id, today, form.cleaned_data['status'])
+                        except WritePending:
+                            # Запись уже выполняется - после перенаправления панель покажет результат
+                            pass
+                        logger.info('Статус сохранен: user_id=%s, status=%s', user_id, form.cleaned_data['status'])
                         return redirect('manager_dashboard')
                     else:
-                        print("Form errors:", form.errors)
-                except Exception as e:
-                    print(f"Error: {e}")
+                        logger.warning('Ошибки формы статуса (user_id=%s): %s', user_id, form.errors.as_json())
+                except Exception:
+                    logger.exception('Ошибка сохранения статуса на панели заведующего (user_id=%s)', user_id)
         
         context = {
             'pharmacy_groups': forms_data,
             'main_pharmacy': main_pharmacy,
-            'branch_pharmacies': branch_pharmacies,
+            'branch_pharmacies': profile.branch_pharmacies,
             'pharmacy': profile.pharmacy,
             'today': today,
         }
@@ -208,10 +318,35 @@ def manager_dashboard(request):
     except UserProfile.DoesNotExist:
         return redirect('access_denied')
 
+def report_rejected(request, admission):
+    """Ответ на отклоненный отчет: JSON с ошибкой для AJAX, иначе 400 с сообщением"""
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return JsonResponse({'success': False, 'error': admission.message}, status=400)
+    return HttpResponseBadRequest(admission.message)
+
+
+def background_report_response(request, report, data):
+    """Тяжелый AJAX-отчет ставится в фоновую очередь (kadr.jobs) вместо построения в запросе.
+
+    Ответ - состояние задания (background: true): клиент опрашивает его
+    и забирает результат в том же формате, что и обычный ответ (данные или HTML).
+    Состояние задания меняется, поэтому ответ не получает валидаторов (ETag).
+    """
+    request.kadr_validators = None
+    try:
+        job = submit_report_job(
+            request.user, report, 'json' if wants_data(request) else 'html', data, timezone.now().date()
+        )
+    except ValueError:
+        logger.warning('Некорректные параметры фонового отчета', exc_info=True)
+        return JsonResponse({'success': False, 'error': 'Некорректные параметры отчета'}, status=400)
+    return JsonResponse(dict(report_job_payload(job), background=True))
+
 @login_required
+@conditional_report
 def statistics(request):
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = get_request_profile(request)
         if not profile.is_manager:
             return redirect('access_denied')
         
@@ -253,6 +388,11 @@ def statistics(request):
         if start_date > end_date:
             start_date, end_date = end_date, start_date
         
+        # Слишком длинный период отклоняется до запросов к базе
+        admission = admit_report(start_date, end_date)
+        if admission.mode == REJECTED:
+            return report_rejected(request, admission)
+        
         # Инициализируем форму с текущими датами
         form = DateRangeForm(initial={
             'start_date': start_date,
@@ -261,79 +401,89 @@ def statistics(request):
         
         # Получаем все аптеки: основная и все подчиненные
         main_pharmacy = profile.pharmacy
-        branch_pharmacies = Pharmacy.objects.filter(main_pharmacy=main_pharmacy)
-        all_pharmacies = [main_pharmacy] + list(branch_pharmacies)
+        all_pharmacies = [main_pharmacy] + profile.branch_pharmacies
+        
+        # Повторный AJAX-запрос за тот же период отдаем из кэша, пока данные аптек не менялись
+        is_ajax = request.headers.get('x-requested-with') == 'XMLHttpRequest'
+        data_mode = is_ajax and wants_data(request)
+        if main_pharmacy:
+            # Повторная загрузка без изменений в данных - 304 до построения отчета
+            not_modified = check_not_modified(
+                request, 'statistics', [pharmacy.id for pharmacy in all_pharmacies],
+                start_date, end_date, today, data_mode
+            )
+            if not_modified:
+                return not_modified
+        
+        cache_key = None
+        if is_ajax and main_pharmacy:
+            cache_key = fragment_key(
+                'statistics', 'manager', [pharmacy.id for pharmacy in all_pharmacies],
+                main_pharmacy.id, start_date, end_date, today, data_mode
+            )
+            payload = get_fragment(cache_key, wait=True)
+            if payload is not None:
+                return JsonResponse(payload)
         
-        # Получаем всех сотрудников всех аптек
-        employees = UserProfile.objects.filter(pharmacy__in=all_pharmacies)
-        
-        # Функция для подсчета рабочих дней (исключая выходные и праздники)
-        def get_working_days_count(start, end):
-            working_days = 0
-            current_date = start
-            
-            while current_date <= end:
-                if RussianHolidays.is_working_day(current_date):
-                    working_days += 1
-                current_date += timedelta(days=1)
-            
-            return working_days
+        # Стоимость отчета по числу сотрудников и аптек; сам отчет
+        # всегда строится по агрегатам (сводка по месяцам и групповые запросы)
+        pharmacy_ids = [pharmacy.id for pharmacy in all_pharmacies if pharmacy]
+        admission = admit_report(start_date, end_date, get_scope_employees(profile).count(), len(all_pharmacies))
+        if admission.mode == REJECTED:
+            return report_rejected(request, admission)
         
         # Подсчитываем рабочие дни для всего периода
-        total_working_days = get_working_days_count(start_date, end_date)
+        total_working_days = count_working_days(start_date, end_date)
+        
+        # Статусы за рабочие дни по аптеке записи - один групповой запрос;
+        # переведенный сотрудник остается в прежней аптеке с ее днями
+        status_counts_by_key = get_pharmacy_employee_status_counts(pharmacy_ids, start_date, end_date)
+        employees_by_pharmacy = group_employees_by_pharmacy(pharmacy_ids, status_counts_by_key)
         
         # Группируем статистику по аптекам
         pharmacy_stats = []
-        total_stats = {choice[0]: 0 for choice in ATTENDANCE_CHOICES}
-        total_employees_count = 0
+        total_stats = empty_status_counts()
+        employee_ids = set()
         
         for pharmacy in all_pharmacies:
             # Сотрудники текущей аптеки
-            pharmacy_employees = employees.filter(pharmacy=pharmacy)
-            total_employees_count += pharmacy_employees.count()
+            pharmacy_employees = employees_by_pharmacy.get(pharmacy.id if pharmacy else None, [])
+            employee_ids.update(employee.id for employee in pharmacy_employees)
             
             # Статистика для текущей аптеки
             pharmacy_employee_stats = []
-            pharmacy_total_stats = {choice[0]: 0 for choice in ATTENDANCE_CHOICES}
+            pharmacy_total_stats = empty_status_counts()
             
             for employee in pharmacy_employees:
-                # Получаем все записи посещаемости сотрудника за период
-                attendances = Attendance.objects.filter(
-                    user=employee,
-                    date__range=[start_date, end_date]
-                ).order_by('date')
-                
                 # Считаем статистику по статусам
-                status_counts = {choice[0]: 0 for choice in ATTENDANCE_CHOICES}
-                for attendance in attendances:
-                    if attendance.status and RussianHolidays.is_working_day(attendance.date):  # Учитываем только рабочие дни
-                        status_counts[attendance.status] += 1
-                        pharmacy_total_stats[attendance.status] += 1
-                        total_stats[attendance.status] += 1
+                status_counts = empty_status_counts()
+                status_counts.update(status_counts_by_key.get((pharmacy.id, employee.id), {}))
+                for status, count in status_counts.items():
+                    pharmacy_total_stats[status] += count
+                    total_stats[status] += count
                 
-                # Считаем количество рабочих дней для сотрудника
-                employee_working_days = get_working_days_count(start_date, end_date)
-                missing_days = employee_working_days - sum(status_counts.values())
+                filled_days = sum(status_counts.values())
+                missing_days = total_working_days - filled_days
                 
                 pharmacy_employee_stats.append({
                     'employee': employee,
-                    'attendances': attendances,
                     'status_counts': status_counts,
-                    'total_working_days': employee_working_days,
+                    'total_working_days': total_working_days,
                     'missing_days': missing_days,
-                    'attendance_percentage': (sum(status_counts.values()) / employee_working_days * 100) if employee_working_days > 0 else 0
+                    'attendance_percentage': (filled_days / total_working_days * 100) if total_working_days > 0 else 0
                 })
             
             pharmacy_stats.append({
                 'pharmacy': pharmacy,
                 'employee_stats': pharmacy_employee_stats,
                 'total_stats': pharmacy_total_stats,
-                'employees_count': pharmacy_employees.count(),
+                'employees_count': len(pharmacy_employees),
                 'is_main': pharmacy == main_pharmacy
             })
         
         # Сортируем: сначала главная аптека, потом подчиненные
         pharmacy_stats.sort(key=lambda x: not x['is_main'])
+        total_employees_count = len(employee_ids)
         
         context = {
             'form': form,
@@ -348,20 +498,37 @@ def statistics(request):
             'today': today,
         }
         
-        if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        if data_mode:
+            # Компактные данные для отрисовки на клиенте
+            payload = statistics_data(
+                total_working_days,
+                period_text=f"{start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}",
+                pharmacies=[{
+                    'id': stats['pharmacy'].id,
+                    'name': stats['pharmacy'].name,
+                    'is_main': stats['is_main'],
+                    'employees': employee_stats_data(stats['employee_stats']),
+                } for stats in pharmacy_stats]
+            )
+            if cache_key:
+                set_fragment(cache_key, payload)
+            return JsonResponse(payload)
+        
+        if is_ajax:
             # Для AJAX запросов возвращаем JSON с данными для обновления
-            from django.http import JsonResponse
-            from django.template.loader import render_to_string
             
             # Рендерим HTML контент
             html_content = render_to_string('includes/manager_statistics_results.html', context)
             
-            return JsonResponse({
+            payload = {
                 'success': True,
                 'html': html_content,
                 'period_text': f"{start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}",
                 'total_working_days': total_working_days
-            })
+            }
+            if cache_key:
+                set_fragment(cache_key, payload)
+            return JsonResponse(payload)
         else:
             # Для обычных запросов возвращаем полную страницу
             return render(request, 'statistics.html', context)
@@ -377,9 +544,10 @@ def statistics_ajax(request):
     return statistics(request)
 
 @login_required
+@conditional_report
 def statistics_employee(request):
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = get_request_profile(request)
                 
         today = date.today()
         
@@ -423,41 +591,61 @@ def statistics_employee(request):
         if start_date > end_date:
             start_date, end_date = end_date, start_date
         
+        # Слишком длинный период отклоняется до запросов к базе
+        admission = admit_report(start_date, end_date)
+        if admission.mode == REJECTED:
+            return report_rejected(request, admission)
+        
         # Инициализируем форму с текущими датами
         form = DateRangeForm(initial={
             'start_date': start_date,
             'end_date': end_date
         })
         
+        # Повторный AJAX-запрос за тот же период отдаем из кэша, пока данные аптеки не менялись
+        is_ajax = request.headers.get('x-requested-with') == 'XMLHttpRequest'
+        data_mode = is_ajax and wants_data(request)
+        if profile.pharmacy_id:
+            not_modified = check_not_modified(
+                request, 'statistics_employee', [profile.pharmacy_id],
+                profile.id, start_date, end_date, today, data_mode
+            )
+            if not_modified:
+                return not_modified
+        
+        cache_key = None
+        if is_ajax and profile.pharmacy_id:
+            cache_key = fragment_key(
+                'statistics_employee', 'employee', [profile.pharmacy_id],
+                profile.id, start_date, end_date, today, data_mode
+            )
+            payload = get_fragment(cache_key, wait=True)
+            if payload is not None:
+                return JsonResponse(payload)
+        
         # ТОЛЬКО ТЕКУЩИЙ СОТРУДНИК
         employee = profile
         
-        # Функция для подсчета рабочих дней (исключая выходные и праздники)
-        def get_working_days_count(start, end):
-            working_days = 0
-            current_date = start
-            
-            while current_date <= end:
-                if RussianHolidays.is_working_day(current_date):
-                    working_days += 1
-                current_date += timedelta(days=1)
-            
-            return working_days
-        
         # Подсчитываем рабочие дни для периода
-        total_working_days = get_working_days_count(start_date, end_date)
-        
-        # Получаем все записи посещаемости сотрудника за период
-        attendances = Attendance.objects.filter(
-            user=employee,
-            date__range=[start_date, end_date]
-        ).order_by('date')
+        total_working_days = count_working_days(start_date, end_date)
         
-        # Считаем статистику по статусам (только для рабочих дней)
+        # Длинный период считается только по агрегатам (помесячная сводка
+        # и групповой запрос по неполным месяцам), без записей по дням
+        aggregated = admit_report(start_date, end_date, 1, 1).mode == AGGREGATED
         status_counts = {choice[0]: 0 for choice in ATTENDANCE_CHOICES}
-        for attendance in attendances:
-            if attendance.status and RussianHolidays.is_working_day(attendance.date):
-                status_counts[attendance.status] += 1
+        if aggregated:
+            attendances, employee_codes = [], None
+            status_counts.update(get_status_counts([employee], start_date, end_date).get(employee.id, {}))
+            filled_days = sum(status_counts.values())
+        else:
+            # Получаем все записи посещаемости сотрудника за период
+            attendances, employee_codes = read_attendances(employee, start_date, end_date)
+            
+            # Считаем статистику по статусам (только для рабочих дней)
+            status_counts.update(count_working_codes(
+                {employee.id: employee_codes}, period_day_types(start_date, end_date)
+            ).get(employee.id, {}))
+            filled_days = len(attendances)
         
         # Считаем пропущенные рабочие дни
         missing_days = total_working_days - sum(status_counts.values())
@@ -466,6 +654,8 @@ def statistics_employee(request):
         employee_stats = [{
             'employee': employee,
             'attendances': attendances,
+            'filled_days': filled_days,
+            'aggregated': aggregated,
             'status_counts': status_counts,
             'total_working_days': total_working_days,
             'missing_days': missing_days,
@@ -487,22 +677,42 @@ def statistics_employee(request):
             'page_title': "Моя статистика посещаемости",
         }
         
-        if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        if data_mode:
+            # Компактные данные: счетчики и по символу на каждый день периода
+            # (для агрегированного отчета - только счетчики)
+            days_data = {'aggregated': True} if aggregated else {
+                'mask': period_mask(start_date, end_date),
+                'codes': encode_digits(employee_codes),
+            }
+            payload = statistics_data(
+                total_working_days,
+                period_text=f"{start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}",
+                start_date=start_date.strftime('%Y-%m-%d'),
+                end_date=end_date.strftime('%Y-%m-%d'),
+                status_counts=status_row(status_counts),
+                **days_data
+            )
+            if cache_key:
+                set_fragment(cache_key, payload)
+            return JsonResponse(payload)
+        
+        if is_ajax:
             # Для AJAX запросов возвращаем JSON
-            from django.http import JsonResponse
-            from django.template.loader import render_to_string
             
             # Рендерим HTML контент
             html_content = render_to_string('statistics_employee.html', context)
             
-            return JsonResponse({
+            payload = {
                 'success': True,
                 'html': html_content,
                 'period_text': f"{start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}",
                 'start_date': start_date.strftime('%Y-%m-%d'),
                 'end_date': end_date.strftime('%Y-%m-%d'),
                 'total_working_days': total_working_days
-            })
+            }
+            if cache_key:
+                set_fragment(cache_key, payload)
+            return JsonResponse(payload)
         else:
             # Для обычных запросов возвращаем полную страницу
             return render(request, 'statistics_employee.html', context)
@@ -511,9 +721,10 @@ def statistics_employee(request):
         return redirect('access_denied')
 
 @login_required
+@conditional_report
 def leader_statistics(request):
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = get_request_profile(request)
         if not profile.is_leader:
             return redirect('access_denied')
         
@@ -567,88 +778,123 @@ def leader_statistics(request):
         if start_date > end_date:
             start_date, end_date = end_date, start_date
         
+        # Слишком длинный период отклоняется до запросов к базе
+        admission = admit_report(start_date, end_date)
+        if admission.mode == REJECTED:
+            return report_rejected(request, admission)
+        
+        # Статистика по выбранной аптеке или по всему ее поддереву филиалов
+        include_branches = bool(request.GET.get('include_branches') or request.POST.get('include_branches'))
+        
+        # Повторный AJAX-запрос по той же аптеке и периоду отдаем из кэша
+        is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+        data_mode = is_ajax and wants_data(request)
+        cache_key = None
+        # Без выбранной аптеки показывается сводка по всей сети
+        network_pharmacies = None if selected_pharmacy else list(Pharmacy.objects.order_by('path'))
+        if not selected_pharmacy:
+            scope_ids = [pharmacy.id for pharmacy in network_pharmacies]
+        elif include_branches:
+            scope_ids = list(get_pharmacies_under(selected_pharmacy).order_by('path').values_list('id', flat=True))
+        else:
+            scope_ids = [selected_pharmacy.id]
+        
+        not_modified = check_not_modified(
+            request, 'leader_statistics', scope_ids,
+            selected_pharmacy.id if selected_pharmacy else None,
+            start_date, end_date, today, include_branches, data_mode
+        )
+        if not_modified:
+            return not_modified
+        
+        if is_ajax:
+            cache_key = fragment_key(
+                'leader_statistics', 'leader', scope_ids, start_date, end_date, today, include_branches, data_mode
+            )
+            payload = get_fragment(cache_key, wait=True)
+            if payload is not None:
+                return JsonResponse(payload)
+        
         # Рассчитываем рабочие дни для периода
-        working_days_count = 0
-        current_date = start_date
-        while current_date <= end_date:
-            if RussianHolidays.is_working_day(current_date):
-                working_days_count += 1
-            current_date += timedelta(days=1)
+        working_days_count = count_working_days(start_date, end_date)
         
         # Если аптека выбрана, получаем статистику
         employee_stats = []
-        pharmacy_stats = {
-            'total_employees': 0,
-            'total_days': working_days_count,
-            'status_counts': {'full': 0, 'half': 0, 'vacation': 0, 'sick': 0},
-            'attendance_percentage': 0
-        }
+        network_stats = []
         
         if selected_pharmacy:
-            # Получаем всех сотрудников выбранной аптеки
-            employees = UserProfile.objects.filter(pharmacy=selected_pharmacy)
-            pharmacy_stats['total_employees'] = employees.count()
-            
-            total_attendances = 0
-            total_possible_days = 0
+            # Сотрудники выбранной аптеки (с филиалами - аптеки поддерева);
+            # их дни считаются по аптеке записи
+            employees_count = UserProfile.objects.filter(pharmacy__in=scope_ids).count()
+            admission = admit_report(start_date, end_date, employees_count, len(scope_ids))
+            if is_ajax and needs_background(admission):
+                return background_report_response(request, 'statistics', {
+                    'pharmacy': selected_pharmacy.id,
+                    'include_branches': include_branches,
+                    'start_date': start_date.isoformat(),
+                    'end_date': end_date.isoformat(),
+                })
+            if admission.mode == REJECTED:
+                return report_rejected(request, admission)
             
-            # Собираем статистику по каждому сотруднику
-            for employee in employees:
-                # Получаем все записи посещаемости сотрудника за период
-                attendances = Attendance.objects.filter(
-                    user=employee,
-                    date__range=[start_date, end_date]
-                ).order_by('date')
-                
-                # Считаем только рабочие дни с заполненными статусами
-                filled_working_days = 0
-                status_counts = {'full': 0, 'half': 0, 'vacation': 0, 'sick': 0}
-                
-                for attendance in attendances:
-                    # Проверяем, что это рабочий день и статус заполнен
-                    if (attendance.status and 
-                        attendance.status in status_counts and 
-                        RussianHolidays.is_working_day(attendance.date)):
-                        status_counts[attendance.status] += 1
-                        pharmacy_stats['status_counts'][attendance.status] += 1
-                        filled_working_days += 1
-                
-                total_attendances += filled_working_days
-                total_possible_days += working_days_count
-                
-                employee_stats.append({
-                    'employee': employee,
-                    'status_counts': status_counts,
-                    'total_days': working_days_count,
-                    'missing_days': working_days_count - filled_working_days,
-                    'attendance_count': filled_working_days,
-                    'attendance_percentage': (filled_working_days / working_days_count * 100) if working_days_count > 0 else 0
+            employee_stats, pharmacy_stats = collect_employee_statistics(
+                scope_ids, start_date, end_date, working_days_count
+            )
+        else:
+            # Вся сеть: счетчики сотрудников и статусов сгруппированы по аптекам в базе
+            employee_counts = count_network_employees()
+            admission = admit_report(
+                start_date, end_date, sum(employee_counts.values()), len(network_pharmacies)
+            )
+            if is_ajax and needs_background(admission):
+                return background_report_response(request, 'statistics', {
+                    'start_date': start_date.isoformat(),
+                    'end_date': end_date.isoformat(),
                 })
+            if admission.mode == REJECTED:
+                return report_rejected(request, admission)
             
-            # Общий процент присутствия по аптеке
-            if total_possible_days > 0:
-                pharmacy_stats['attendance_percentage'] = (total_attendances / total_possible_days * 100)
+            network_stats, pharmacy_stats = collect_network_statistics(
+                network_pharmacies, employee_counts, start_date, end_date, working_days_count
+            )
         
         context = {
             'pharmacy_form': pharmacy_form,
             'start_date': start_date,
             'end_date': end_date,
             'employee_stats': employee_stats,
+            'network_stats': network_stats,
             'pharmacy_stats': pharmacy_stats,
             'selected_pharmacy': selected_pharmacy,
+            'include_branches': include_branches,
             'today': today,
             'working_days_count': working_days_count,
         }
         
+        if data_mode:
+            # Компактные данные: сотрудники выбранной аптеки или аптеки сети
+            payload = statistics_data(
+                working_days_count,
+                pharmacy_name=selected_pharmacy.name if selected_pharmacy else None,
+                employees=employee_stats_data(employee_stats),
+                pharmacies=network_stats_data(network_stats)
+            )
+            if cache_key:
+                set_fragment(cache_key, payload)
+            return JsonResponse(payload)
+        
         # Если это AJAX запрос, возвращаем JSON
-        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        if is_ajax:
             html_content = render_to_string('includes/leader_statistics_results.html', context)
-            return JsonResponse({
+            payload = {
                 'success': True,
                 'html': html_content,
                 'pharmacy_name': selected_pharmacy.name if selected_pharmacy else None,
-                'has_data': bool(selected_pharmacy and employee_stats)
-            })
+                'has_data': bool(employee_stats or network_stats)
+            }
+            if cache_key:
+                set_fragment(cache_key, payload)
+            return JsonResponse(payload)
         
         return render(request, 'leader_statistics.html', context)
     
@@ -664,15 +910,10 @@ def leader_statistics_ajax(request):
 
 
 @login_required
-@csrf_exempt
-def leader_statistics_ajax(request):
-    """AJAX обработчик для статистики"""
-    return leader_statistics(request)
-
-@login_required
+@conditional_report
 def manager_timesheet(request):
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = get_request_profile(request)
         if not profile.is_manager:
             return redirect('access_denied')
         
@@ -706,87 +947,32 @@ def manager_timesheet(request):
         
         # Получаем все аптеки: основная и подчиненные
         main_pharmacy = profile.pharmacy
-        branch_pharmacies = Pharmacy.objects.filter(main_pharmacy=main_pharmacy)
-        all_pharmacies = [main_pharmacy] + list(branch_pharmacies)
+        all_pharmacies = [main_pharmacy] + profile.branch_pharmacies
         
-        # Собираем данные для табеля
+        if main_pharmacy:
+            not_modified = check_not_modified(
+                request, 'manager_timesheet', [pharmacy.id for pharmacy in all_pharmacies],
+                selected_year, selected_month, today
+            )
+            if not_modified:
+                return not_modified
+        
+        # Собираем данные для табеля: все аптеки и весь месяц за два запроса
+        matrix = TimesheetMatrix(all_pharmacies, first_day, last_day)
         timesheet_data = []
         
         for pharmacy in all_pharmacies:
-            # Получаем сотрудников аптеки
-            employees = UserProfile.objects.filter(pharmacy=pharmacy).order_by('user__last_name')
-            
-            pharmacy_data = {
+            timesheet_data.append({
                 'pharmacy': pharmacy,
                 'is_main': pharmacy == main_pharmacy,
-                'employees': []
-            }
-            
-            for employee in employees:
-                # Получаем посещаемость сотрудника за месяц
-                attendances = Attendance.objects.filter(
-                    user=employee,
-                    date__range=[first_day, last_day]
-                ).order_by('date')
-                
-                # Создаем список статусов для каждого дня
-                daily_status = []
-                attendance_dict = {att.date.day: att.status for att in attendances}
-                
-                for day in range(1, last_day.day + 1):
-                    current_date = date(selected_year, selected_month, day)
-                    
-                    # Проверяем, рабочий ли это день
-                    if day in working_days_set:
-                        # Рабочий день - показываем статус посещения
-                        status = attendance_dict.get(day)
-                        daily_status.append({
-                            'status': status,
-                            'is_working': True,
-                            'is_weekend': False,
-                            'is_holiday': False
-                        })
-                    else:
-                        # Нерабочий день - автоматически заполняем
-                        is_weekend = RussianHolidays.is_weekend(current_date)
-                        is_holiday = RussianHolidays.is_holiday(current_date)
-                        
-                        daily_status.append({
-                            'status': 'weekend' if is_weekend else 'holiday',
-                            'is_working': False,
-                            'is_weekend': is_weekend,
-                            'is_holiday': is_holiday
-                        })
-                
-                # Считаем только рабочие дни для статистики
-                total_working_days = len(working_days_set)
-                filled_working_days = sum(1 for day_status in daily_status 
-                                        if day_status['is_working'] and day_status['status'] is not None)
-                
-                # Создаем данные для сотрудника
-                employee_data = {
-                    'employee': employee,
-                    'daily_status': daily_status,
-                    'total_days': (last_day - first_day).days + 1,
-                    'total_working_days': total_working_days,
-                    'filled_working_days': filled_working_days,
-                    'attendance_percentage': (filled_working_days / total_working_days * 100) if total_working_days > 0 else 0
-                }
-                
-                pharmacy_data['employees'].append(employee_data)
-            
-            timesheet_data.append(pharmacy_data)
+                'employees': matrix.month_rows(pharmacy, selected_year, selected_month)
+            })
         
         # Генерируем список дней месяца
         days_in_month = list(range(1, last_day.day + 1))
         
         # Получаем название месяца на русском
-        month_names = {
-            1: 'Январь', 2: 'Февраль', 3: 'Март', 4: 'Апрель',
-            5: 'Май', 6: 'Июнь', 7: 'Июль', 8: 'Август',
-            9: 'Сентябрь', 10: 'Октябрь', 11: 'Ноябрь', 12: 'Декабрь'
-        }
-        selected_month_name = month_names.get(selected_month, '')
+        selected_month_name = MONTH_NAMES.get(selected_month, '')
         
         context = {
             'form': form,
@@ -809,31 +995,79 @@ def manager_timesheet(request):
 
 @login_required
 @csrf_exempt
+@conditional_report
 def leader_timesheet_report_ajax(request):
     """AJAX обработчик для загрузки табелей"""
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = get_request_profile(request)
         if not (profile.is_leader or profile.is_operator):
             return JsonResponse({'success': False, 'error': 'Доступ запрещен'})
         
         today = timezone.now().date()
         
-        # Обрабатываем POST данные
-        selected_year = int(request.POST.get('year', today.year))
-        selected_month = int(request.POST.get('month', today.month))
-        period_type = request.POST.get('period_type', 'month')
-        pharmacy_id = request.POST.get('pharmacy')
+        # Параметры табеля: GET (с поддержкой условных запросов) или POST
+        params = request.GET if request.method == 'GET' else request.POST
+        selected_year = int(params.get('year', today.year))
+        selected_month = int(params.get('month', today.month))
+        period_type = params.get('period_type', 'month')
+        pharmacy_id = params.get('pharmacy')
+        
+        data_mode = wants_data(request)
         
         timesheet_data = []
         working_days_set = set()
         days_in_month = []
         selected_pharmacy = None
+        cache_key = None
         
         if pharmacy_id:
             try:
                 selected_pharmacy = Pharmacy.objects.get(id=pharmacy_id)
                 
+                not_modified = check_not_modified(
+                    request, 'leader_timesheet_report', [selected_pharmacy.id],
+                    period_type, selected_year, selected_month, today, data_mode
+                )
+                if not_modified:
+                    return not_modified
+                
+                # Табель той же аптеки за тот же период отдаем из кэша, пока ее данные не менялись
+                cache_key = fragment_key(
+                    'leader_timesheet_report', 'leader', [selected_pharmacy.id],
+                    period_type, selected_year, selected_month, today, data_mode
+                )
+                payload = get_fragment(cache_key, wait=True)
+                if payload is not None:
+                    return JsonResponse(payload)
+                
+                # Табель большой аптеки за долгий период строится в фоне
                 if period_type == 'month':
+                    period_months = [selected_month]
+                else:
+                    period_months = list(range(1, (today.month if selected_year == today.year else 12) + 1))
+                admission = admit_report(
+                    month_bounds(selected_year, period_months[0])[0],
+                    month_bounds(selected_year, period_months[-1])[1],
+                    UserProfile.objects.filter(pharmacy=selected_pharmacy).count(), 1
+                )
+                if needs_background(admission):
+                    return background_report_response(request, 'timesheet', params)
+                
+                if data_mode:
+                    # Компактные данные: маска календаря и строка кодов на сотрудника и месяц
+                    if period_type == 'month':
+                        first_day = date(selected_year, selected_month, 1)
+                        last_day = date(selected_year, selected_month, monthrange(selected_year, selected_month)[1])
+                        timesheet_data = build_timesheet_data(
+                            selected_pharmacy, selected_year, [selected_month],
+                            period=f"{first_day.strftime('%d.%m.%Y')} - {last_day.strftime('%d.%m.%Y')}"
+                        )
+                    else:
+                        last_month = today.month if selected_year == today.year else 12
+                        timesheet_data = build_timesheet_data(
+                            selected_pharmacy, selected_year, list(range(1, last_month + 1))
+                        )
+                elif period_type == 'month':
                     # Обработка месяца
                     first_day = date(selected_year, selected_month, 1)
                     last_day = date(selected_year, selected_month, monthrange(selected_year, selected_month)[1])
@@ -842,141 +1076,34 @@ def leader_timesheet_report_ajax(request):
                     working_days_set = set(working_days)
                     days_in_month = list(range(1, last_day.day + 1))
                     
-                    employees = UserProfile.objects.filter(pharmacy=selected_pharmacy).order_by('user__last_name')
+                    matrix = TimesheetMatrix([selected_pharmacy], first_day, last_day)
                     
-                    pharmacy_data = {
+                    timesheet_data.append({
                         'pharmacy': selected_pharmacy,
                         'is_main': selected_pharmacy.main_pharmacy is None,
-                        'employees': [],
+                        'employees': matrix.month_rows(selected_pharmacy, selected_year, selected_month),
                         'period': f"{first_day.strftime('%d.%m.%Y')} - {last_day.strftime('%d.%m.%Y')}"
-                    }
-                    
-                    for employee in employees:
-                        attendances = Attendance.objects.filter(
-                            user=employee,
-                            date__range=[first_day, last_day]
-                        ).order_by('date')
-                        
-                        daily_status = []
-                        attendance_dict = {att.date.day: att.status for att in attendances}
-                        
-                        for day in range(1, last_day.day + 1):
-                            current_date = date(selected_year, selected_month, day)
-                            
-                            if day in working_days_set:
-                                status = attendance_dict.get(day)
-                                daily_status.append({
-                                    'status': status,
-                                    'is_working': True,
-                                    'is_weekend': False,
-                                    'is_holiday': False
-                                })
-                            else:
-                                is_weekend = RussianHolidays.is_weekend(current_date)
-                                is_holiday = RussianHolidays.is_holiday(current_date)
-                                daily_status.append({
-                                    'status': 'weekend' if is_weekend else 'holiday',
-                                    'is_working': False,
-                                    'is_weekend': is_weekend,
-                                    'is_holiday': is_holiday
-                                })
-                        
-                        total_working_days = len(working_days_set)
-                        filled_working_days = sum(1 for day_status in daily_status 
-                                                if day_status['is_working'] and day_status['status'] is not None)
-                        
-                        employee_data = {
-                            'employee': employee,
-                            'daily_status': daily_status,
-                            'total_working_days': total_working_days,
-                            'filled_working_days': filled_working_days,
-                            'attendance_percentage': (filled_working_days / total_working_days * 100) if total_working_days > 0 else 0
-                        }
-                        
-                        pharmacy_data['employees'].append(employee_data)
-                    
-                    timesheet_data.append(pharmacy_data)
+                    })
                     
                 else:
-                    # Обработка года
-                    for month in range(1, 13):
-                        if selected_year == today.year and month > today.month:
-                            break
-                        
-                        first_day = date(selected_year, month, 1)
-                        last_day = date(selected_year, month, monthrange(selected_year, month)[1])
-                        
-                        working_days, non_working_days = get_working_days(selected_year, month)
-                        current_working_days_set = set(working_days)
-                        current_days_in_month = list(range(1, last_day.day + 1))
-                        
-                        employees = UserProfile.objects.filter(pharmacy=selected_pharmacy).order_by('user__last_name')
-                        
-                        month_names = {
-                            1: 'Январь', 2: 'Февраль', 3: 'Март', 4: 'Апрель',
-                            5: 'Май', 6: 'Июнь', 7: 'Июль', 8: 'Август',
-                            9: 'Сентябрь', 10: 'Октябрь', 11: 'Ноябрь', 12: 'Декабрь'
-                        }
-                        
-                        pharmacy_data = {
-                            'pharmacy': selected_pharmacy,
-                            'is_main': selected_pharmacy.main_pharmacy is None,
-                            'employees': [],
-                            'period': f"{month_names[month]} {selected_year}",
-                            'month_number': month,
-                            'working_days_set': current_working_days_set,
-                            'days_in_month': current_days_in_month
-                        }
-                        
-                        for employee in employees:
-                            attendances = Attendance.objects.filter(
-                                user=employee,
-                                date__range=[first_day, last_day]
-                            ).order_by('date')
-                            
-                            daily_status = []
-                            attendance_dict = {att.date.day: att.status for att in attendances}
-                            
-                            for day in range(1, last_day.day + 1):
-                                current_date = date(selected_year, month, day)
-                                
-                                if day in current_working_days_set:
-                                    status = attendance_dict.get(day)
-                                    daily_status.append({
-                                        'status': status,
-                                        'is_working': True,
-                                        'is_weekend': False,
-                                        'is_holiday': False
-                                    })
-                                else:
-                                    is_weekend = RussianHolidays.is_weekend(current_date)
-                                    is_holiday = RussianHolidays.is_holiday(current_date)
-                                    daily_status.append({
-                                        'status': 'weekend' if is_weekend else 'holiday',
-                                        'is_working': False,
-                                        'is_weekend': is_weekend,
-                                        'is_holiday': is_holiday
-                                    })
-                            
-                            total_working_days = len(current_working_days_set)
-                            filled_working_days = sum(1 for day_status in daily_status 
-                                                    if day_status['is_working'] and day_status['status'] is not None)
-                            
-                            employee_data = {
-                                'employee': employee,
-                                'daily_status': daily_status,
-                                'total_working_days': total_working_days,
-                                'filled_working_days': filled_working_days,
-                                'attendance_percentage': (filled_working_days / total_working_days * 100) if total_working_days > 0 else 0
-                            }
-                            
-                            pharmacy_data['employees'].append(employee_data)
-                        
-                        timesheet_data.append(pharmacy_data)
+                    # Обработка года - весь год одним проходом
+                    last_month = today.month if selected_year == today.year else 12
+                    timesheet_data = build_year_timesheet(selected_pharmacy, selected_year, last_month)
                         
             except Pharmacy.DoesNotExist:
                 return JsonResponse({'success': False, 'error': 'Аптека не найдена'})
         
+        if data_mode:
+            payload = {
+                'success': True,
+                'format': DATA_FORMAT,
+                'timesheet': timesheet_data or None,
+                'pharmacy_name': selected_pharmacy.name if selected_pharmacy else ''
+            }
+            if cache_key:
+                set_fragment(cache_key, payload)
+            return JsonResponse(payload)
+        
         # Рендерим HTML шаблон
         html_content = render_to_string('includes/timesheet_results.html', {
             'timesheet_data': timesheet_data,
@@ -985,22 +1112,23 @@ def leader_timesheet_report_ajax(request):
             'days_in_month': days_in_month,
         })
         
-        return JsonResponse({
+        payload = {
             'success': True,
             'html': html_content,
             'pharmacy_name': selected_pharmacy.name if selected_pharmacy else ''
-        })
+        }
+        if cache_key:
+            set_fragment(cache_key, payload)
+        return JsonResponse(payload)
         
-    except Exception as e:
-        import traceback
-        print(f"Error in AJAX view: {e}")
-        print(traceback.format_exc())
-        return JsonResponse({'success': False, 'error': str(e)})
+    except Exception:
+        logger.exception('Ошибка построения табеля руководителя')
+        return JsonResponse({'success': False, 'error': 'Не удалось построить табель'})
 
 @login_required
 def leader_timesheet_report(request):
     try:
-        profile = UserProfile.objects.get(user=request.user)
+        profile = get_request_profile(request)
         if not (profile.is_leader or profile.is_operator):
             return redirect('access_denied')
         
@@ -1008,9 +1136,9 @@ def leader_timesheet_report(request):
         
         # Форма выбора аптеки и периода
         if request.method == 'POST':
-            form = LeaderTimesheetForm(request.POST, user=request.user)
+            form = LeaderTimesheetForm(request.POST, user=request.user, profile=profile)
         else:
-            form = LeaderTimesheetForm(user=request.user, initial={
+            form = LeaderTimesheetForm(user=request.user, profile=profile, initial={
                 'year': today.year,
                 'month': today.month,
                 'period_type': 'month'
@@ -1042,146 +1170,21 @@ def leader_timesheet_report(request):
                 working_days_set = set(working_days)
                 days_in_month = list(range(1, last_day.day + 1))
                 
-                # Получаем сотрудников выбранной аптеки
-                employees = UserProfile.objects.filter(pharmacy=selected_pharmacy).order_by('user__last_name')
+                # Сотрудники и посещаемость выбранной аптеки за месяц
+                matrix = TimesheetMatrix([selected_pharmacy], first_day, last_day)
                 
-                pharmacy_data = {
+                timesheet_data.append({
                     'pharmacy': selected_pharmacy,
                     'is_main': selected_pharmacy.main_pharmacy is None,
-                    'employees': [],
+                    'employees': matrix.month_rows(selected_pharmacy, selected_year, selected_month),
                     'period': f"{first_day.strftime('%d.%m.%Y')} - {last_day.strftime('%d.%m.%Y')}"
-                }
-                
-                for employee in employees:
-                    attendances = Attendance.objects.filter(
-                        user=employee,
-                        date__range=[first_day, last_day]
-                    ).order_by('date')
-                    
-                    daily_status = []
-                    attendance_dict = {att.date.day: att.status for att in attendances}
-                    
-                    for day in range(1, last_day.day + 1):
-                        current_date = date(selected_year, selected_month, day)
-                        
-                        if day in working_days_set:
-                            status = attendance_dict.get(day)
-                            daily_status.append({
-                                'status': status,
-                                'is_working': True,
-                                'is_weekend': False,
-                                'is_holiday': False
-                            })
-                        else:
-                            is_weekend = RussianHolidays.is_weekend(current_date)
-                            is_holiday = RussianHolidays.is_holiday(current_date)
-                            daily_status.append({
-                                'status': 'weekend' if is_weekend else 'holiday',
-                                'is_working': False,
-                                'is_weekend': is_weekend,
-                                'is_holiday': is_holiday
-                            })
-                    
-                    total_working_days = len(working_days_set)
-                    filled_working_days = sum(1 for day_status in daily_status 
-                                            if day_status['is_working'] and day_status['status'] is not None)
-                    
-                    employee_data = {
-                        'employee': employee,
-                        'daily_status': daily_status,
-                        'total_working_days': total_working_days,
-                        'filled_working_days': filled_working_days,
-                        'attendance_percentage': (filled_working_days / total_working_days * 100) if total_working_days > 0 else 0
-                    }
-                    
-                    pharmacy_data['employees'].append(employee_data)
-                
-                timesheet_data.append(pharmacy_data)
+                })
                 
             else:
-                # Режим года - показываем все месяцы с января по текущий
-                for month in range(1, 13):
-                    if selected_year == today.year and month > today.month:
-                        break  # Не показываем будущие месяцы
-                    
-                    first_day = date(selected_year, month, 1)
-                    last_day = date(selected_year, month, monthrange(selected_year, month)[1])
-                    
-                    working_days, non_working_days = get_working_days(selected_year, month)
-                    current_working_days_set = set(working_days)
-                    current_days_in_month = list(range(1, last_day.day + 1))
-                    
-                    employees = UserProfile.objects.filter(pharmacy=selected_pharmacy).order_by('user__last_name')
-                    
-                    # Получаем название месяца
-                    month_names = {
-                        1: 'Январь', 2: 'Февраль', 3: 'Март', 4: 'Апрель',
-                        5: 'Май', 6: 'Июнь', 7: 'Июль', 8: 'Август',
-                        9: 'Сентябрь', 10: 'Октябрь', 11: 'Ноябрь', 12: 'Декабрь'
-                    }
-                    
-                    pharmacy_data = {
-                        'pharmacy': selected_pharmacy,
-                        'is_main': selected_pharmacy.main_pharmacy is None,
-                        'employees': [],
-                        'period': f"{month_names[month]} {selected_year}",
-                        'month_number': month,
-                        'year': selected_year,
-                        'working_days_set': current_working_days_set,
-                        'days_in_month': current_days_in_month
-                    }
-                    
-                    for employee in employees:
-                        attendances = Attendance.objects.filter(
-                            user=employee,
-                            date__range=[first_day, last_day]
-                        ).order_by('date')
-                        
-                        daily_status = []
-                        attendance_dict = {att.date.day: att.status for att in attendances}
-                        
-                        for day in range(1, last_day.day + 1):
-                            current_date = date(selected_year, month, day)
-                            
-                            if day in current_working_days_set:
-                                status = attendance_dict.get(day)
-                                daily_status.append({
-                                    'status': status,
-                                    'is_working': True,
-                                    'is_weekend': False,
-                                    'is_holiday': False
-                                })
-                            else:
-                                is_weekend = RussianHolidays.is_weekend(current_date)
-                                is_holiday = RussianHolidays.is_holiday(current_date)
-                                daily_status.append({
-                                    'status': 'weekend' if is_weekend else 'holiday',
-                                    'is_working': False,
-                                    'is_weekend': is_weekend,
-                                    'is_holiday': is_holiday
-                                })
-                        
-                        total_working_days = len(current_working_days_set)
-                        filled_working_days = sum(1 for day_status in daily_status 
-                                                if day_status['is_working'] and day_status['status'] is not None)
-                        
-                        employee_data = {
-                            'employee': employee,
-                            'daily_status': daily_status,
-                            'total_working_days': total_working_days,
-                            'filled_working_days': filled_working_days,
-                            'attendance_percentage': (filled_working_days / total_working_days * 100) if total_working_days > 0 else 0
-                        }
-                        
-                        pharmacy_data['employees'].append(employee_data)
-                    
-                    timesheet_data.append(pharmacy_data)
-        
-        month_names = {
-            1: 'Январь', 2: 'Февраль', 3: 'Март', 4: 'Апрель',
-            5: 'Май', 6: 'Июнь', 7: 'Июль', 8: 'Август',
-            9: 'Сентябрь', 10: 'Октябрь', 11: 'Ноябрь', 12: 'Декабрь'
-        }
+                # Режим года - показываем все месяцы с января по текущий,
+                # данные за год загружаются одним проходом
+                last_month = today.month if selected_year == today.year else 12
+                timesheet_data = build_year_timesheet(selected_pharmacy, selected_year, last_month)
         
         # Создаем контекст
         context = {
@@ -1189,9 +1192,9 @@ def leader_timesheet_report(request):
             'timesheet_data': timesheet_data,
             'selected_year': selected_year,
             'selected_month': selected_month,
-            'selected_month_name': month_names.get(selected_month, ''),
+            'selected_month_name': MONTH_NAMES.get(selected_month, ''),
             'period_type': period_type,
-            'month_names': month_names,
+            'month_names': MONTH_NAMES,
             'today': today,
         }
         
@@ -1205,6 +1208,176 @@ def leader_timesheet_report(request):
     except UserProfile.DoesNotExist:
         return redirect('access_denied')
 
+def report_job_payload(job):
+    """Состояние фонового отчета для опроса клиентом"""
+    payload = {
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'status_url': reverse('report_job_status', args=[job.id]),
+    }
+    if job.status == ReportJob.DONE:
+        payload['result_url'] = reverse('report_job_result', args=[job.id])
+    elif job.status == ReportJob.FAILED:
+        payload['error'] = job.error
+    return payload
+
+
+def get_report_job(request, job_id):
+    """Задание фонового отчета, заказанное этим пользователем, или None"""
+    try:
+        profile = get_request_profile(request)
+    except UserProfile.DoesNotExist:
+        return None
+    if not profile.is_leader:
+        return None
+    return ReportJob.objects.filter(id=job_id, user=request.user).first()
+
+
+@login_required
+@require_POST
+def report_job_submit(request):
+    """Постановка отчета в фоновую очередь; ответ - номер и состояние задания"""
+    try:
+        profile = get_request_profile(request)
+    except UserProfile.DoesNotExist:
+        profile = None
+    if profile is None or not profile.is_leader:
+        return JsonResponse({'success': False, 'error': 'Доступ запрещен'}, status=403)
+
+    try:
+        job = submit_report_job(
+            request.user,
+            request.POST.get('report', 'timesheet'),
+            request.POST.get('format', 'csv'),
+            request.POST,
+            timezone.now().date()
+        )
+    except ValueError:
+        logger.warning('Некорректные параметры фонового отчета', exc_info=True)
+        return JsonResponse({'success': False, 'error': 'Некорректные параметры отчета'}, status=400)
+    return JsonResponse(report_job_payload(job))
+
+
+@login_required
+def report_job_status(request, job_id):
+    job = get_report_job(request, job_id)
+    if job is None:
+        return JsonResponse({'success': False, 'error': 'Задание не найдено'}, status=404)
+    return JsonResponse(report_job_payload(job))
+
+
+@login_required
+def report_job_result(request, job_id):
+    """Готовый результат фонового отчета (CSV - файлом)"""
+    job = get_report_job(request, job_id)
+    if job is None or job.status != ReportJob.DONE:
+        return JsonResponse({'success': False, 'error': 'Отчет не готов'}, status=404)
+
+    response = HttpResponse(job.result, content_type=job.content_type)
+    if job.format == 'csv':
+        response['Content-Disposition'] = f'attachment; filename="{job.report}_{job.id}.csv"'
+    return response
+
+
+def get_export_scope(request, profile):
+    """Аптеки выгрузки: (id аптек или None для всех аптек, часть имени файла).
+    
+    Руководитель выбирает аптеку (с филиалами или без) или выгружает всю сеть,
+    заведующий - только свою аптеку со всеми филиалами. Заведующему без аптеки
+    выгрузка запрещена (PermissionDenied), неизвестная аптека - Http404.
+    """
+    if profile.is_manager and profile.pharmacy:
+        pharmacy_ids = [profile.pharmacy.id] + [pharmacy.id for pharmacy in profile.branch_pharmacies]
+        return pharmacy_ids, f'pharmacy_{profile.pharmacy.id}'
+    if not profile.is_leader:
+        raise PermissionDenied
+    
+    pharmacy_id = request.GET.get('pharmacy')
+    if not pharmacy_id:
+        return None, 'all'
+    try:
+        pharmacy = Pharmacy.objects.get(id=int(pharmacy_id))
+    except (ValueError, Pharmacy.DoesNotExist):
+        raise Http404('Аптека не найдена')
+    if request.GET.get('include_branches'):
+        return list(get_pharmacies_under(pharmacy).values_list('id', flat=True)), f'pharmacy_{pharmacy.id}'
+    return [pharmacy.id], f'pharmacy_{pharmacy.id}'
+
+
+@login_required
+def timesheet_export(request):
+    """Выгрузка табеля за месяц или год в CSV (потоком) или XLSX"""
+    try:
+        profile = get_request_profile(request)
+        if not (profile.is_leader or profile.is_manager):
+            return redirect('access_denied')
+        
+        today = timezone.now().date()
+        try:
+            selected_year = int(request.GET.get('year', today.year))
+            selected_month = int(request.GET.get('month') or today.month)
+            date(selected_year, selected_month, 1)
+        except ValueError:
+            return HttpResponseBadRequest('Некорректный период')
+        
+        if request.GET.get('period_type') == 'year':
+            last_month = today.month if selected_year == today.year else 12
+            months = list(range(1, last_month + 1))
+            period = f'{selected_year}'
+        else:
+            months = [selected_month]
+            period = f'{selected_year}_{selected_month:02d}'
+        
+        pharmacy_ids, scope_name = get_export_scope(request, profile)
+        return export_response(
+            timesheet_rows(pharmacy_ids, selected_year, months),
+            f'timesheet_{scope_name}_{period}',
+            request.GET.get('format', 'csv')
+        )
+    
+    except (UserProfile.DoesNotExist, PermissionDenied):
+        return redirect('access_denied')
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+
+@login_required
+def statistics_export(request):
+    """Выгрузка статистики посещаемости за период в CSV (потоком) или XLSX"""
+    try:
+        profile = get_request_profile(request)
+        if not (profile.is_leader or profile.is_manager):
+            return redirect('access_denied')
+        
+        today = timezone.now().date()
+        try:
+            start_date = datetime.strptime(request.GET['start_date'], '%Y-%m-%d').date()
+            end_date = datetime.strptime(request.GET['end_date'], '%Y-%m-%d').date()
+        except (KeyError, ValueError):
+            # По умолчанию - текущий месяц
+            start_date = date(today.year, today.month, 1)
+            end_date = today
+        if start_date > end_date:
+            start_date, end_date = end_date, start_date
+        admission = admit_report(start_date, end_date)
+        if admission.mode == REJECTED:
+            return HttpResponseBadRequest(admission.message)
+        
+        pharmacy_ids, scope_name = get_export_scope(request, profile)
+        return export_response(
+            statistics_rows(pharmacy_ids, start_date, end_date),
+            f'statistics_{scope_name}_{start_date:%Y%m%d}_{end_date:%Y%m%d}',
+            request.GET.get('format', 'csv')
+        )
+    
+    except (UserProfile.DoesNotExist, PermissionDenied):
+        return redirect('access_denied')
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+
 def access_denied(request):
     return render(request, 'access_denied.html')
 
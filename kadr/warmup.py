@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import time
+from datetime import date
+from pathlib import Path
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.template import TemplateSyntaxError, engines
+from django.urls import get_resolver
+from .utils import get_calendar
+
+# Прогрев процесса при загрузке WSGI (core/passenger_wsgi.py).
+#
+# Passenger часто запускает и останавливает процессы, и первый запрос нового
+# процесса платит за импорт представлений и разбор URL, компиляцию шаблонов,
+# первое соединение с базой, загрузку профиля с филиалами его аптеки и сборку
+# календаря. При KADR_WARMUP = True это делается при загрузке приложения,
+# до первого запроса. Время загрузки и прогрева (и время первого запроса,
+# см. kadr.middleware) пишется логгером kadr.performance.startup.
+
+logger = logging.getLogger('kadr.performance.startup')
+
+
+def warm_urls():
+    """Импорт URL-схемы со всеми представлениями и подготовка обратного разбора"""
+    resolver = get_resolver()
+    # Обращение к reverse_dict заполняет словари обратного разбора (reverse)
+    resolver.reverse_dict
+    return len(resolver.url_patterns)
+
+
+def warm_templates():
+    """Компилирует шаблоны проекта и приложения kadr в кэш загрузчика; возвращает число скомпилированных"""
+    engine = engines['django']
+    template_dirs = [Path(path) for path in engine.engine.dirs]
+    template_dirs.append(Path(apps.get_app_config('kadr').path) / 'templates')
+    count = 0
+    for template_dir in template_dirs:
+        for path in sorted(template_dir.rglob('*.html')):
+            name = path.relative_to(template_dir).as_posix()
+            try:
+                engine.get_template(name)
+            except TemplateSyntaxError as e:
+                # Неиспользуемый или сломанный шаблон не мешает прогреву остальных
+                logger.warning('Шаблон %s не компилируется: %s', name, e)
+                continue
+            count += 1
+    return count
+
+
+def warm_database():
+    """Открывает соединение (с настройкой SQLite, kadr.signals) и читает дерево аптек по индексу path"""
+    from .models import Pharmacy
+
+    connection.ensure_connection()
+    return len(Pharmacy.objects.order_by('path').values_list('id', 'path'))
+
+
+def warm_hierarchy():
+    """Кладет в кэш профили заведующих и руководителей с филиалами их аптек (kadr.profiles)"""
+    from .models import UserProfile
+    from .profiles import prime_profiles
+
+    return prime_profiles(
+        UserProfile.objects.select_related('pharmacy').filter(Q(is_manager=True) | Q(is_leader=True))
+    )
+
+
+def warm_calendar():
+    """Собирает календари прошлого, текущего и следующего года"""
+    year = date.today().year
+    for calendar_year in (year - 1, year, year + 1):
+        get_calendar(calendar_year)
+    return 3
+
+
+WARMUP_STEPS = [
+    ('urls', warm_urls),
+    ('templates', warm_templates),
+    ('database', warm_database),
+    ('hierarchy', warm_hierarchy),
+    ('calendar', warm_calendar),
+]
+
+
+def warm_up():
+    """Выполняет шаги прогрева; возвращает {шаг: (результат, мс)}.
+
+    Ошибка шага записывается в лог и не мешает запуску процесса: то, что
+    не прогрелось, подготовит первый запрос.
+    """
+    steps = {}
+    for name, step in WARMUP_STEPS:
+        started = time.perf_counter()
+        try:
+            result = step()
+        except Exception:
+            logger.exception('Ошибка прогрева: %s', name)
+            result = None
+        steps[name] = (result, round((time.perf_counter() - started) * 1000, 1))
+    return steps
+
+
+def log_cold_start(load_started):
+    """Прогрев (при KADR_WARMUP) и строка лога о запуске процесса.
+
+    load_started - time.perf_counter() в начале загрузки WSGI-модуля.
+    """
+    load_ms = (time.perf_counter() - load_started) * 1000
+    record = {
+        'event': 'startup',
+        'pid': os.getpid(),
+        'load_ms': round(load_ms, 1),
+        'warmup': getattr(settings, 'KADR_WARMUP', False),
+    }
+    if record['warmup']:
+        started = time.perf_counter()
+        steps = warm_up()
+        record['warmup_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        record['steps'] = {name: {'result': result, 'ms': ms} for name, (result, ms) in steps.items()}
+    logger.info(json.dumps(record, ensure_ascii=False))
+    return record
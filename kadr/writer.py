@@ -0,0 +1,177 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+# Поток записи посещаемости.
+#
+# SQLite допускает одну пишущую транзакцию на базу, и в часы открытия смены
+# параллельные сохранения заведующих ждут друг друга на блокировке базы.
+# Записи из запросов процесса ставятся в очередь и выполняются одним потоком
+# небольшими пачками: несколько записей - одна транзакция и одна фиксация.
+# Запрос получает ответ только после фиксации пачки, в которую попала его запись.
+# Подряд идущие вызовы функций с пометкой coalesce (см. coalesce_writes)
+# объединяются в один вызов со всеми строками сразу.
+# Между процессами записи разводит busy_timeout (см. kadr.signals.configure_sqlite).
+#
+# Если запрос не дождался фиксации (KADR_WRITER_TIMEOUT), его запись отменяется,
+# пока поток до нее не дошел (WriteTimeout - запись не сохранена). Запись,
+# которую поток уже выполняет, отменить нельзя: запрос получает WritePending -
+# запись будет сохранена (или не сохранена из-за ошибки) без его участия.
+
+
+class WriteTimeout(Exception):
+    """Запись не дождалась потока записи и отменена: данные не сохранены"""
+
+
+class WritePending(Exception):
+    """Запись уже выполняется потоком записи, но не успела зафиксироваться"""
+
+
+def coalesce_writes(func):
+    """Помечает функцию записи func(entries), вызовы которой можно объединять.
+
+    Объединенный вызов получает строки всех запросов в порядке поступления;
+    если он завершился ошибкой, запросы выполняются по одному.
+    """
+    func.coalesce = True
+    return func
+
+
+class AttendanceWriter:
+    """Очередь записей с фоновым потоком, выполняющим их пачками"""
+
+    def __init__(self, max_batch=50, max_delay=0.005):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # После fork (несколько процессов сервера) поток родителя недоступен
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='kadr-attendance-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, func, *args, timeout=None, **kwargs):
+        """Выполняет func(*args, **kwargs) в потоке записи и ждет фиксации пачки.
+
+        Возвращает результат func или пробрасывает ее исключение. Если фиксации
+        не дождались за timeout секунд, бросает WriteTimeout (запись отменена)
+        или WritePending (запись уже выполняется).
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            if future.cancel():
+                raise WriteTimeout('Сохранение не выполнено: база данных занята, повторите попытку')
+            raise WritePending('Сохранение выполняется')
+
+    def _run(self):
+        write_queue = self._queue
+        while True:
+            batch = [write_queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(write_queue.get(timeout=remaining) if remaining > 0 else write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            # Отмененные по таймауту записи пропускаются; остальные больше отменить нельзя
+            batch = [job for job in batch if job[0].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            # Как в потоках запросов: соединение, устаревшее (CONN_MAX_AGE) или
+            # сломанное ошибкой, закрывается и открывается заново
+            close_old_connections()
+            try:
+                self._flush(batch)
+            finally:
+                close_old_connections()
+
+    def _groups(self, batch):
+        """Делит пачку на группы: подряд идущие объединяемые вызовы одной функции"""
+        groups = []
+        for job in batch:
+            func = job[1]
+            if groups and getattr(func, 'coalesce', False) and groups[-1][0][1] is func:
+                groups[-1].append(job)
+            else:
+                groups.append([job])
+        return groups
+
+    def _execute(self, jobs, results):
+        """Выполняет записи в точках сохранения: ошибка одной не отменяет остальные"""
+        for future, func, args, kwargs in jobs:
+            try:
+                with transaction.atomic():
+                    result = func(*args, **kwargs)
+            except Exception as e:
+                results.append((future, None, e))
+            else:
+                results.append((future, result, None))
+
+    def _flush(self, batch):
+        results = []
+        try:
+            with transaction.atomic():
+                for jobs in self._groups(batch):
+                    if len(jobs) == 1:
+                        self._execute(jobs, results)
+                        continue
+                    func = jobs[0][1]
+                    try:
+                        with transaction.atomic():
+                            result = func([entry for _, _, (entries,), _ in jobs for entry in entries])
+                    except Exception:
+                        self._execute(jobs, results)
+                    else:
+                        results.extend((future, result, None) for future, _, _, _ in jobs)
+        except Exception:
+            # Не удалась сама фиксация (например, отложенная проверка внешних
+            # ключей SQLite): пачка откатилась, записи выполняются по одной,
+            # каждая в своей транзакции
+            results = []
+            self._execute(batch, results)
+        finally:
+            self.batches += 1
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+writer = AttendanceWriter(
+    max_batch=getattr(settings, 'KADR_WRITER_MAX_BATCH', 50),
+    max_delay=getattr(settings, 'KADR_WRITER_MAX_DELAY_MS', 5) / 1000,
+)
+
+
+def run_write(func, *args, **kwargs):
+    """Выполняет запись посещаемости func(*args, **kwargs) в отдельной транзакции.
+
+    При KADR_ATTENDANCE_WRITER = True запись уходит в общий поток записи
+    и объединяется с параллельными записями других запросов. Внутри уже
+    открытой транзакции (и при выключенном потоке) запись выполняется сразу,
+    чтобы остаться частью этой транзакции.
+    """
+    if not getattr(settings, 'KADR_ATTENDANCE_WRITER', False) or transaction.get_connection().in_atomic_block:
+        with transaction.atomic():
+            return func(*args, **kwargs)
+    return writer.submit(func, *args, timeout=getattr(settings, 'KADR_WRITER_TIMEOUT', 30), **kwargs)